@@ -0,0 +1,95 @@
+# coding=utf-8
+
+"""Time binned locomotion analytics computed from the coordinate columns of a trial"""
+
+import numpy as np
+
+
+# Speed (pixels/sec) below which the mouse is considered immobile
+IMMOBILITY_SPEED = 20.0
+# Minimum duration (secs) a period of immobility must last to count as a bout
+IMMOBILITY_MIN_BOUT = 1.0
+# Column names of the _Summary.csv output
+SUMMARY_HEADER = ('Bin Start (s)', 'Bin End (s)', 'Frames Tracked', 'Distance (px)', 'Mean Speed (px/s)',
+                  'Time Immobile (s)', 'Immobility Bouts', 'Time in Target (s)', 'Target Occupancy (%)')
+
+
+class LocomotionSummary(object):
+    """Computes distance, speed, immobility and target occupancy per time bin.
+    All metrics are computed vectorized over whole trial arrays"""
+    def __init__(self, bin_width, immobility_speed=IMMOBILITY_SPEED, min_bout=IMMOBILITY_MIN_BOUT):
+        self.bin_width = float(bin_width)
+        self.immobility_speed = immobility_speed
+        self.min_bout = min_bout
+
+    def compute(self, times, xs, ys, in_targ, duration=None):
+        """Returns a list of summary rows (one per bin), followed by a row summarizing the whole trial
+        times: secs elapsed; xs, ys: coordinates with NaN where untracked; in_targ: bools"""
+        times = np.asarray(times, dtype='float64')
+        xs = np.asarray(xs, dtype='float64')
+        ys = np.asarray(ys, dtype='float64')
+        in_targ = np.asarray(in_targ, dtype='bool')
+        if not times.size:
+            end = duration or 0.0
+            return [self.format_row(0.0, end, 0, 0, 0, 0, 0, 0, end)] * 2
+        # Bin edges cover the full trial duration (or the last timestamp if trial was cut short)
+        end = max(duration or 0.0, times[-1])
+        num_bins = max(1, int(np.ceil(end / self.bin_width)))
+        # Frame intervals; each interval is assigned to the bin its starting frame belongs to
+        frame_bins = np.minimum((times / self.bin_width).astype('int64'), num_bins - 1)
+        frame_dt = np.diff(times, append=times[-1])
+        tracked = ~(np.isnan(xs) | np.isnan(ys))
+        frames_tracked = np.bincount(frame_bins[tracked], minlength=num_bins)
+        targ_time = np.bincount(frame_bins, weights=frame_dt * in_targ, minlength=num_bins)
+        # Path segments join consecutive tracked positions (same as the pathing map)
+        seg_t, seg_x, seg_y = times[tracked], xs[tracked], ys[tracked]
+        seg_bins = frame_bins[tracked][:-1]
+        seg_dt = np.diff(seg_t)
+        seg_dist = np.hypot(np.diff(seg_x), np.diff(seg_y))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            seg_speed = np.where(seg_dt > 0, seg_dist / seg_dt, 0.0)
+        distance = np.bincount(seg_bins, weights=seg_dist, minlength=num_bins)
+        moving_time = np.bincount(seg_bins, weights=seg_dt, minlength=num_bins)
+        # Immobility: runs of consecutive slow segments lasting at least min_bout secs
+        immobile = seg_speed < self.immobility_speed
+        immobile_time = np.bincount(seg_bins, weights=seg_dt * immobile, minlength=num_bins)
+        edges = np.diff(np.concatenate(([0], immobile.astype('int8'), [0])))
+        run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        elapsed = np.concatenate(([0.0], np.cumsum(seg_dt)))
+        is_bout = (elapsed[run_ends] - elapsed[run_starts]) >= self.min_bout
+        bouts = np.bincount(seg_bins[run_starts[is_bout]], minlength=num_bins)
+        # Assemble rows
+        bin_starts = np.arange(num_bins) * self.bin_width
+        bin_ends = np.minimum(bin_starts + self.bin_width, end)
+        bin_lengths = np.maximum(bin_ends - bin_starts, 0)
+        rows = []
+        for i in range(num_bins):
+            rows.append(self.format_row(bin_starts[i], bin_ends[i], frames_tracked[i], distance[i],
+                                        moving_time[i], immobile_time[i], bouts[i], targ_time[i], bin_lengths[i]))
+        rows.append(self.format_row(0.0, end, frames_tracked.sum(), distance.sum(), moving_time.sum(),
+                                    immobile_time.sum(), bouts.sum(), targ_time.sum(), end))
+        return rows
+
+    @staticmethod
+    def format_row(start, end, frames, distance, moving_time, immobile_time, bouts, targ_time, length):
+        """Rounds a summary row for output"""
+        speed = distance / moving_time if moving_time > 0 else 0.0
+        occupancy = targ_time / length * 100 if length > 0 else 0.0
+        return (round(float(start), 3), round(float(end), 3), int(frames), round(float(distance), 3),
+                round(float(speed), 3), round(float(immobile_time), 3), int(bouts),
+                round(float(targ_time), 3), round(float(occupancy), 3))
+
+    def save(self, file, rows):
+        """Writes summary to a .csv: parameters, whole trial summary, then per bin summaries"""
+        with open(file, 'w') as f:
+            # analysis parameters
+            for element in ('Bin Width (s)', 'Immobility Speed (px/s)', 'Min Immobility Bout (s)'):
+                f.write('{},'.format(element))
+            f.write('\n')
+            for element in (self.bin_width, self.immobility_speed, self.min_bout):
+                f.write('{},'.format(element))
+            f.write('\n')
+            # whole trial (last row), then each bin
+            for line in (SUMMARY_HEADER, rows[-1], SUMMARY_HEADER) + tuple(rows[:-1]):
+                f.write(''.join('{},'.format(element) for element in line))
+                f.write('\n')
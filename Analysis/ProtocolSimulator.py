@@ -0,0 +1,92 @@
+# coding=utf-8
+
+"""Replays recorded trials through a stimulation protocol, faster than real time
+
+Usage: python -m Analysis.ProtocolSimulator [TRIAL_STORE or DIRECTORY] ... [--protocol FILE.json] [--set KEY=VALUE]
+Trials are replayed with the protocol they were recorded with, unless a protocol file is given.
+--set overrides single protocol params, e.g. --set dwell=2.0 --set max_pulses=50"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from DirsSettings.TrialStore import TrialStore, find_trial_stores, STORE_SUFFIX
+from Concurrency.Protocols import simulate_protocol, protocol_params, PROTOCOL_STATES
+from Concurrency.Stimulation import PULSE_HEADER
+
+
+SIMULATION_ENDING = '_Simulated_Stims.csv'
+
+
+def load_trial(store):
+    """Times, coordinates (NaN where untracked) and region bitmasks of a stored trial"""
+    no_coord = store.metadata.get('no_coord', -1)
+    xs = np.asarray(store['x'], dtype='float64')
+    ys = np.asarray(store['y'], dtype='float64')
+    untracked = (xs == no_coord) | (ys == no_coord)
+    xs[untracked], ys[untracked] = np.nan, np.nan
+    # Trials recorded before multiple regions only know if mouse was in the target region
+    regions = store['regions'] if 'regions' in store else store['in_targ']
+    return np.asarray(store['time']), xs, ys, np.asarray(regions).astype('int64')
+
+
+def save_simulation(file, pulses, state_time):
+    """Writes time spent in each protocol state, then each simulated pulse"""
+    with open(file, 'w') as f:
+        stim_time = (pulses['commanded_off'] - pulses['commanded_on']).sum()
+        state_header = tuple('Time {} (s)'.format(state) for state in PROTOCOL_STATES)
+        state_row = tuple(round(state_time[state], 3) for state in PROTOCOL_STATES)
+        lines = [('Num Pulses', 'Total Stim Time (s)') + state_header,
+                 (pulses.shape[0], round(float(stim_time), 3)) + state_row,
+                 PULSE_HEADER]
+        lines.extend((round(float(pulse['commanded_on']), 4), round(float(pulse['actual_on']), 4),
+                      round(float(pulse['commanded_off']), 4), round(float(pulse['actual_off']), 4),
+                      round(float(pulse['period']), 4), bool(pulse['manual'])) for pulse in pulses)
+        for line in lines:
+            f.write(''.join('{},'.format(element) for element in line))
+            f.write('\n')
+
+
+def parse_overrides(settings):
+    """KEY=VALUE strings into a dict; values are parsed as JSON where possible"""
+    overrides = {}
+    for setting in settings:
+        key, value = setting.split('=', 1)
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded trials through a stimulation protocol')
+    parser.add_argument('paths', nargs='+', help='trial stores, or directories to search for trial stores')
+    parser.add_argument('--protocol', help='JSON file of protocol params')
+    parser.add_argument('--set', action='append', default=[], help='override a protocol param, KEY=VALUE')
+    parser.add_argument('--save', action='store_true',
+                        help='write [trial]{} next to each trial'.format(SIMULATION_ENDING))
+    args = parser.parse_args()
+    protocol = None
+    if args.protocol:
+        with open(args.protocol, 'r') as file:
+            protocol = json.load(file)
+    overrides = parse_overrides(args.set)
+    stores = []
+    for path in args.paths:
+        stores.extend(find_trial_stores(path) if os.path.isdir(path) and not path.endswith(STORE_SUFFIX)
+                      else [TrialStore(path)])
+    for trial_store in stores:
+        trial_protocol = dict(protocol if protocol is not None else trial_store.metadata.get('stim_protocol', {}))
+        trial_protocol.update(overrides)
+        trial_protocol = protocol_params(trial_protocol)
+        trial = load_trial(trial_store)
+        sim_start = time.perf_counter()
+        trial_pulses, trial_state_time = simulate_protocol(trial_protocol, *trial)
+        sim_secs = time.perf_counter() - sim_start
+        trial_secs = float(trial[0][-1]) if trial[0].size else 0.0
+        print('{}: {} Pulses; {} Secs of Trial Simulated in {} Secs'.format(
+            trial_store.path, trial_pulses.shape[0], round(trial_secs, 1), round(sim_secs, 3)))
+        if args.save:
+            save_simulation(trial_store.path[:-len(STORE_SUFFIX)] + SIMULATION_ENDING, trial_pulses, trial_state_time)
@@ -0,0 +1,41 @@
+# coding=utf-8
+
+"""Rebuilds the outputs of an interrupted trial (.csv, store, summary, maps) from its coordinates log
+
+Usage: python -m Analysis.RecoverTrial [LOG_FILE or DIRECTORY] ...
+Directories are searched recursively for leftover _Coords.wal files"""
+
+import os
+import argparse
+from DirsSettings.CoordsLog import read_coords_log, LOG_ENDING
+from Concurrency.CoordsProc import save_trial_files
+
+
+def find_coords_logs(paths):
+    """Returns all log files in paths; directories are searched recursively"""
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                logs.extend(os.path.join(directory, f) for f in files if f.endswith(LOG_ENDING))
+        elif path.endswith(LOG_ENDING):
+            logs.append(path)
+    return sorted(logs)
+
+
+def recover_trial(log_file):
+    """Rebuilds trial outputs next to the log file. Returns the number of records recovered"""
+    data, metadata = read_coords_log(log_file)
+    # Save next to the log rather than at metadata['trial'], in case the files were moved since recording
+    save_name = log_file[:-len(LOG_ENDING)]
+    save_trial_files(save_name, data, metadata)
+    return data.shape[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recover trial outputs from coordinate logs')
+    parser.add_argument('paths', nargs='+', help='log files, or directories to search for log files')
+    args = parser.parse_args()
+    for log in find_coords_logs(args.paths):
+        num_records = recover_trial(log)
+        print('Recovered {} Records from: {}'.format(num_records, log))
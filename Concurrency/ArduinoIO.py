@@ -0,0 +1,470 @@
+# coding=utf-8
+
+"""Arduino I/O. A single long-lived worker thread owns the pyfirmata board and executes queued commands
+
+Also provides a pty backed stand-in Firmata device, so I/O timing can be benchmarked without hardware:
+python -m Concurrency.ArduinoIO [--pulses N]
+and a simulated arduino, for running without pyfirmata or a board (see create_arduino)"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import threading as thr
+from importlib.util import find_spec
+try:
+    import serial
+except ImportError:  # only the simulated arduino can be used
+    serial = None
+from Misc.CustomClasses import StopWatch
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Arduino backends, as selected in settings
+ARDUINO_FIRMATA = 'firmata'
+ARDUINO_SIMULATED = 'simulated'
+# Arduino Pin
+ARDPIN = 6
+# Thread names
+ARDUINO_IO = 'arduino_io'
+ARDUINO_DISCOVERY = 'arduino_discovery'
+FAKE_FIRMATA = 'fake_firmata'
+# I/O Commands
+IO_ATTACH = 'io_attach'
+IO_DETACH = 'io_detach'
+IO_WRITE = 'io_write'
+IO_PING = 'io_ping'
+IO_EXIT = 'io_exit'
+# Port the arduino was last found at; tried first when searching
+PORT_CACHE_FILE = os.path.join(os.path.expanduser('~'), 'MouseTrackArduinoPort.txt')
+# USB vendor IDs of arduinos and common arduino clone usb-serial chips (FTDI, CH340)
+ARDUINO_VIDS = (0x2341, 0x2A03, 0x1A86, 0x0403)
+# Linux device names of usb serial devices, in case port enumeration misses them
+LINUX_SERIAL_GLOBS = ('/dev/ttyACM*', '/dev/ttyUSB*')
+# Secs between unsuccessful searches; doubles after each search, up to the max
+DISCOVERY_BACKOFF = 1.0
+DISCOVERY_BACKOFF_MAX = 30.0
+# Max secs to wait for a write to complete when waiting on it
+WRITE_TIMEOUT = 0.1
+SERIAL_ERRORS = ((serial.serialutil.SerialTimeoutException, serial.serialutil.SerialException, AttributeError) if serial
+                 else (AttributeError,))
+# One record per executed write/ping. Times are time.perf_counter() values
+LATENCY_DTYPE = np.dtype([('queued', 'f8'), ('written', 'f8'), ('ping', '?'), ('value', 'i1')])
+LATENCY_HEADER = ('Queued (s)', 'Written (s)', 'Latency (ms)', 'Ping', 'Value')
+
+
+class IOCommand(object):
+    """A timestamped command for the I/O worker"""
+    __slots__ = ('command', 'value', 'queued', 'completed', 'done')
+
+    def __init__(self, command, value=None, wait=False):
+        self.command = command
+        self.value = value
+        self.queued = time.perf_counter()
+        self.completed = None
+        self.done = thr.Event() if wait else None
+
+    def complete(self):
+        self.completed = time.perf_counter()
+        if self.done:
+            self.done.set()
+
+
+class ArduinoDevice(object):
+    """Connects to external arduino hardware. All board I/O happens on the I/O worker thread"""
+    def __init__(self, ports=None):
+        self.main_pin = 'd:{}:o'.format(ARDPIN)  # digital, pin 6, output
+        self.test_pin = 'd:13:o'  # ask arduino for connection status. Added benefit of seeing LED 13 as visual aid
+        # Ports to search. None searches the serial devices present at the time of each search
+        self.ports = ports
+        self.ping_state = 0
+        self.ping_interval = 1
+        self.ping_timer = StopWatch()
+        self.ping_timer.start()
+        self.manual_mode = False
+        self.connected = False
+        self.board = None
+        self.commands = Queue.Queue()
+        self.thread = None
+        # Background search for the device
+        self.discovery_thread = None
+        self.searched = False  # has a full search been completed?
+        self._exiting = thr.Event()
+        self._latencies = []
+        self._latencies_lock = thr.Lock()
+
+    def start(self):
+        """Starts the I/O worker"""
+        self.thread = thr.Thread(target=self.arduino_io_worker, name=ARDUINO_IO, daemon=True)
+        self.thread.start()
+
+    def send_command(self, command, value=None, wait=False, timeout=None):
+        """Queues a command; optionally waits for it. Returns the time it completed, or None if not completed"""
+        io_command = IOCommand(command, value, wait)
+        self.commands.put_nowait(io_command)
+        if wait:
+            io_command.done.wait(timeout)
+        return io_command.completed
+
+    def connect(self):
+        """Searches for the device in the background until found; does nothing if already searching"""
+        if self.discovery_thread and self.discovery_thread.is_alive():
+            return
+        self.discovery_thread = thr.Thread(target=self.discovery_worker, name=ARDUINO_DISCOVERY, daemon=True)
+        self.discovery_thread.start()
+
+    def toggle_manual(self):
+        """Turns manual mode on or off"""
+        self.manual_mode = not self.manual_mode
+
+    def write(self, num, wait=False):
+        """Writes to arduino; optionally waits until written. Returns time written if waited"""
+        if not self.connected:
+            return None
+        return self.send_command(IO_WRITE, num, wait=wait, timeout=WRITE_TIMEOUT)
+
+    def exit(self):
+        """Close device cleanly"""
+        self._exiting.set()
+        if self.thread:
+            self.send_command(IO_EXIT)
+            self.thread.join()
+            self.thread = None
+
+    def ping(self):
+        """test if arduino is still connected"""
+        if self.ping_timer.elapsed() > self.ping_interval:
+            if self.connected:
+                self.send_command(IO_PING)
+            self.ping_timer.reset()
+            self.ping_timer.start()
+
+    def pop_latencies(self):
+        """Returns writes/pings executed since last called"""
+        with self._latencies_lock:
+            latencies, self._latencies = self._latencies, []
+        return np.array(latencies, dtype=LATENCY_DTYPE)
+
+    # I/O worker. Only these functions touch the board
+    def arduino_io_worker(self):
+        """a worker thread to execute queued commands in order. Pings already queued are batched into one"""
+        running = True
+        while running:
+            batch = [self.commands.get()]
+            try:
+                while True:
+                    batch.append(self.commands.get_nowait())
+            except Queue.Empty:
+                pass
+            last_ping = max([i for i, cmd in enumerate(batch) if cmd.command == IO_PING] or [None])
+            for i, cmd in enumerate(batch):
+                if cmd.command == IO_EXIT:
+                    self.exit_board()
+                    running = False
+                elif cmd.command == IO_ATTACH:
+                    self.attach_board(*cmd.value)
+                elif cmd.command == IO_DETACH:
+                    self.connected = False
+                    self.exit_board()
+                elif cmd.command == IO_WRITE:
+                    self.write_pin(self.main_output, cmd.value, cmd)
+                elif cmd.command == IO_PING and i == last_ping:
+                    self.ping_state ^= 1
+                    self.write_pin(self.test_output, self.ping_state, cmd)
+                cmd.complete()
+
+    def write_pin(self, pin, value, cmd):
+        """Writes to a pin while handling any serial errors; records the write latency"""
+        try:
+            pin.write(value)
+        except SERIAL_ERRORS:
+            self.connected = False
+        else:
+            with self._latencies_lock:
+                self._latencies.append((cmd.queued, time.perf_counter(), cmd.command == IO_PING, value))
+
+    def attach_board(self, board, port):
+        """Uses a board found by the discovery worker"""
+        self.exit_board()
+        self.board = board
+        try:
+            self.main_output = self.board.get_pin(self.main_pin)
+            self.test_output = self.board.get_pin(self.test_pin)
+        except SERIAL_ERRORS:
+            self.exit_board()
+            return
+        self.connected = True
+        print('Arduino Port Found at: {}'.format(port))
+
+    def exit_board(self):
+        try:
+            self.board.exit()
+        except SERIAL_ERRORS:
+            pass
+        self.board = None
+
+    # Discovery worker. Opening ports is slow (secs per port), so it never runs on the I/O worker
+    def discovery_worker(self):
+        """a worker thread to search for the device until found, backing off between searches"""
+        # Release the port of a lost board so it can be opened again
+        self.send_command(IO_DETACH, wait=True, timeout=WRITE_TIMEOUT)
+        backoff = DISCOVERY_BACKOFF
+        while not self._exiting.is_set():
+            ports = self.ports if self.ports else find_serial_ports()
+            for port in order_by_cache(ports):
+                if self._exiting.is_set():
+                    return
+                board = open_board(port)
+                if board:
+                    save_cached_port(port)
+                    self.send_command(IO_ATTACH, (board, port), wait=True)
+                    self.searched = True
+                    return
+            self.searched = True
+            self._exiting.wait(backoff)
+            backoff = min(backoff * 2, DISCOVERY_BACKOFF_MAX)
+
+
+class SimulatedPin(object):
+    def __init__(self, board, pin):
+        self.board = board
+        self.pin = pin
+
+    def write(self, value):
+        if self.board.write_secs:
+            time.sleep(self.board.write_secs)
+        self.board.values[self.pin] = value
+
+
+class SimulatedBoard(object):
+    """Stand-in pyfirmata board; its pins keep the last value written. write_secs: time each write takes"""
+    def __init__(self, write_secs=0.0):
+        self.write_secs = write_secs
+        self.values = {}
+
+    def get_pin(self, pin_def):
+        """pin_def as for pyfirmata, e.g. 'd:6:o'"""
+        return SimulatedPin(self, int(pin_def.split(':')[1]))
+
+    def exit(self):
+        pass
+
+
+class SimulatedArduinoDevice(ArduinoDevice):
+    """ArduinoDevice with a simulated board, found at once. Commands still go through the I/O worker, so its
+    latencies are recorded as with a real board"""
+    PORT = 'simulated'
+
+    def __init__(self, write_secs=0.0):
+        super(SimulatedArduinoDevice, self).__init__()
+        self.write_secs = write_secs
+
+    def discovery_worker(self):
+        self.send_command(IO_ATTACH, (SimulatedBoard(self.write_secs), self.PORT), wait=True)
+        self.searched = True
+
+
+def create_arduino(backend):
+    """Arduino device by backend name. pyfirmata is only imported once a board is opened; without it, the simulated
+    arduino is used instead"""
+    if backend not in (ARDUINO_FIRMATA, ARDUINO_SIMULATED):
+        raise ValueError('[{}] is not a valid arduino backend!'.format(backend))
+    if backend == ARDUINO_FIRMATA and (serial is None or find_spec('pyfirmata') is None):
+        print('pyfirmata is not installed; using the [{}] arduino'.format(ARDUINO_SIMULATED))
+        backend = ARDUINO_SIMULATED
+    return SimulatedArduinoDevice() if backend == ARDUINO_SIMULATED else ArduinoDevice()
+
+
+def open_board(port):
+    """Returns a board at port, or None if there is no device there"""
+    from pyfirmata import Arduino
+    try:
+        temp = serial.Serial(port)
+        temp.flush()
+        temp.close()
+        return Arduino(port)
+    except (serial.serialutil.SerialException, OSError):
+        return None
+
+
+def is_arduino(port_info):
+    """Does an enumerated port look like an arduino?"""
+    description = '{} {}'.format(port_info.description, port_info.manufacturer).lower()
+    return port_info.vid in ARDUINO_VIDS or 'arduino' in description
+
+
+def find_serial_ports():
+    """Serial devices present on this machine; likely arduinos first"""
+    from serial.tools import list_ports
+    port_infos = sorted(list_ports.comports(), key=lambda port_info: not is_arduino(port_info))
+    ports = [port_info.device for port_info in port_infos]
+    if sys.platform.startswith('linux'):
+        for pattern in LINUX_SERIAL_GLOBS:
+            ports.extend(port for port in sorted(glob.glob(pattern)) if port not in ports)
+    return ports
+
+
+def load_cached_port():
+    try:
+        with open(PORT_CACHE_FILE, 'r') as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def save_cached_port(port):
+    try:
+        with open(PORT_CACHE_FILE, 'w') as f:
+            f.write(port)
+    except (IOError, OSError):
+        pass
+
+
+def order_by_cache(ports):
+    """Ports to try, with the port last found at first (even if enumeration missed it)"""
+    cached = load_cached_port()
+    if not cached:
+        return list(ports)
+    return [cached] + [port for port in ports if port != cached]
+
+
+def latency_stats(latencies):
+    """Count, mean, sd and max (ms) of write latencies, for writes and pings"""
+    stats = []
+    for is_ping in (False, True):
+        selected = latencies[latencies['ping'] == is_ping]
+        latency = (selected['written'] - selected['queued']) * 1000
+        if not latency.size:
+            stats.append((0, 0.0, 0.0, 0.0))
+            continue
+        stats.append((latency.size, round(float(latency.mean()), 3), round(float(latency.std()), 3),
+                      round(float(latency.max()), 3)))
+    return stats
+
+
+def save_io_latencies(file, latencies, start_time=0.0):
+    """Writes I/O latencies to a .csv: stats for writes and pings, then each write/ping. Times relative to start"""
+    with open(file, 'w') as f:
+        lines = [('Command', 'Count', 'Mean Latency (ms)', 'SD Latency (ms)', 'Max Latency (ms)')]
+        for name, stats in zip(('Write', 'Ping'), latency_stats(latencies)):
+            lines.append((name,) + stats)
+        lines.append(LATENCY_HEADER)
+        lines.extend((round(float(cmd['queued'] - start_time), 4), round(float(cmd['written'] - start_time), 4),
+                      round(float(cmd['written'] - cmd['queued']) * 1000, 3), bool(cmd['ping']), int(cmd['value']))
+                     for cmd in latencies)
+        for line in lines:
+            f.write(''.join('{},'.format(element) for element in line))
+            f.write('\n')
+
+
+class FakeFirmataDevice(object):
+    """Stand-in Arduino on a pseudo terminal. Decodes the Firmata messages written to it and timestamps pin changes.
+    Pass port to ArduinoDevice(ports=[port]). POSIX only"""
+    # Firmata command bytes and their number of data bytes
+    DIGITAL_MESSAGE = 0x90
+    START_SYSEX = 0xF0
+    END_SYSEX = 0xF7
+    DATA_BYTES = {0x90: 2, 0xE0: 2, 0xC0: 1, 0xD0: 1, 0xF4: 2, 0xF5: 2, 0xF9: 2, 0xFF: 0}
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        # (time.perf_counter(), pin, value) of each digital pin change
+        self.pin_changes = []
+        self.pins = {}
+        self.thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self.thread = thr.Thread(target=self.firmata_reading_worker, name=FAKE_FIRMATA, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self._running = False
+        if self.thread:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def firmata_reading_worker(self):
+        """a worker thread to decode messages from the board's host"""
+        import select
+        message = []
+        while self._running:
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            received = time.perf_counter()
+            for byte in bytearray(os.read(self.master, 1024)):
+                if byte & 0x80 and byte != self.END_SYSEX:
+                    message = [byte]
+                elif message:
+                    message.append(byte)
+                else:
+                    continue
+                command = message[0] if message[0] >= 0xF0 else message[0] & 0xF0
+                if command == self.START_SYSEX:
+                    if byte == self.END_SYSEX:
+                        message = []
+                elif len(message) - 1 >= self.DATA_BYTES.get(command, 0):
+                    if command == self.DIGITAL_MESSAGE:
+                        self.digital_message(received, message[0] & 0x0F, message[1] | (message[2] << 7))
+                    message = []
+
+    def digital_message(self, received, port, mask):
+        """Records pins of port whose values changed"""
+        for bit in range(8):
+            pin, value = port * 8 + bit, (mask >> bit) & 1
+            if self.pins.get(pin, 0) != value:
+                self.pin_changes.append((received, pin, value))
+            self.pins[pin] = value
+
+
+def benchmark(num_pulses, pulse_secs):
+    """Sends pulses through the I/O worker to a fake device; reports write latency and arrival times at the device"""
+    device = FakeFirmataDevice()
+    device.start()
+    arduino = ArduinoDevice(ports=[device.port])
+    arduino.start()
+    arduino.connect()
+    arduino.discovery_thread.join()
+    if not arduino.connected:
+        print('Could not connect to fake device at: {}'.format(device.port))
+        return
+    sent = []
+    for _ in range(num_pulses):
+        for value in (1, 0):
+            queued = time.perf_counter()
+            arduino.write(value, wait=True)
+            sent.append(queued)
+            arduino.ping()
+            time.sleep(pulse_secs)
+    time.sleep(0.1)
+    arduino.exit()
+    device.close()
+    write_stats, ping_stats = latency_stats(arduino.pop_latencies())
+    print('Writes: {} | Latency (ms) Mean {} SD {} Max {}'.format(*write_stats))
+    print('Pings: {} | Latency (ms) Mean {} SD {} Max {}'.format(*ping_stats))
+    arrivals = [changed for changed, pin, _ in device.pin_changes if pin == ARDPIN]
+    if len(arrivals) == len(sent):
+        delays = (np.array(arrivals) - np.array(sent)) * 1000
+        print('Queued to Device (ms): Mean {} SD {} Max {}'.format(
+            round(delays.mean(), 3), round(delays.std(), 3), round(delays.max(), 3)))
+    else:
+        print('Device received {} of {} pin changes'.format(len(arrivals), len(sent)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark arduino I/O against a fake Firmata device')
+    parser.add_argument('--pulses', type=int, default=100, help='number of on/off pulses to send')
+    parser.add_argument('--pulse-secs', type=float, default=0.01, help='secs between writes')
+    args = parser.parse_args()
+    benchmark(args.pulses, args.pulse_secs)
@@ -8,12 +8,20 @@ import numpy as np
 import threading as thr
 import multiprocessing as mp
 from collections import deque
-from GUI.DataDisplays.SendRecvProtocols import SyncableMPArray
+from Misc.SharedArrays import SyncableMPArray
 from Misc.CustomClasses import *
-from Misc.GlobalVars import *
+from Misc.CoreVars import *
+from Misc.IPC import proc_handler_queue
+from Misc.TargetRegions import TargetRegionMask, REGION_CIRCLE, as_region, draw_region
 import queue as Queue
 
 
+# Frames waiting to be displayed; if the GUI falls behind, the oldest frames are dropped
+FRAME_BUFFER_SIZE = 8
+# Latest tracked coordinates drawn as a trail behind the mouse
+CONTRAIL_LENGTH = 32
+
+
 class CV2TargetAreaPerimeter(object):
     """Container for target area perimeter information"""
     def __init__(self):
@@ -25,6 +33,10 @@ class CV2TargetAreaPerimeter(object):
         self.radius = None
         self.x1, self.y1 = None, None
         self.x2, self.y2 = None, None
+        # Regions beyond the main target area; (shape, params) tuples as in Misc.TargetRegions
+        self.extra_regions = []
+        self.region_mask = None
+        self._mask_outdated = True
 
     def toggle_draw(self, params):
         """Update params and toggle draw or not draw"""
@@ -37,6 +49,7 @@ class CV2TargetAreaPerimeter(object):
             self.y2 = self.cy + self.radius
         else:
             self.draw = False
+        self._mask_outdated = True
 
     def update_radius(self, radius):
         """Sets new radius"""
@@ -48,18 +61,100 @@ class CV2TargetAreaPerimeter(object):
             self.y2 = self.cy + self.radius
         except TypeError:  # this occurs if we update radius before we receive x,y params to draw
             pass
+        self._mask_outdated = True
+
+    def set_extra_regions(self, regions):
+        """Sets regions in addition to the main target area"""
+        self.extra_regions = [as_region(region) for region in regions]
+        self._mask_outdated = True
+
+    def regions(self):
+        """All target regions; region 0 is the main target area. None if not drawing target areas"""
+        if not self.draw or self.cx is None or self.radius is None:
+            return []
+        return [(REGION_CIRCLE, (self.cx, self.cy, self.radius))] + self.extra_regions
+
+    def membership(self, coord):
+        """Bitmask of the target regions containing coord. Mask is only rasterised again if regions changed"""
+        if self._mask_outdated:
+            self._mask_outdated = False
+            mask = TargetRegionMask(VID_DIM)
+            mask.set_regions(self.regions())
+            self.region_mask = mask
+        return self.region_mask.lookup(*coord)
+
+
+# Drawing; also used to render the CV2 video offline from recorded frames and overlay events
+def crop_to_bounds(frame, bounds):
+    """Blanks frame outside the bounding coordinates"""
+    x1, y1 = bounds[0]
+    x2, y2 = bounds[1]
+    frame[:y1] = 0
+    frame[y2:] = 0
+    frame[:, :x1] = 0
+    frame[:, x2:] = 0
+
+
+def draw_tracking(frame, regions, bounds, contour, coord):
+    """Draws target regions, the mouse contour and coordinate, and the tracking bounds over a grayscale frame.
+    Returns the RGB image"""
+    disp_frame = np.dstack((frame, frame, frame))  # RGB Stack
+    for region in regions:
+        draw_region(disp_frame, region, (0, 255, 0), thickness=2)
+    if coord == (None, None):
+        cv2.putText(disp_frame, 'x, y: (NA, NA)', org=(10, 460), color=(255, 0, 0),
+                    fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=0.35)
+    else:
+        cv2.circle(disp_frame, coord, 3, (0, 0, 255), thickness=-1)
+        loc = 'x, y: ({}, {})'.format(*coord)
+        cv2.putText(disp_frame, loc, org=(10, 460), color=(255, 0, 0), fontFace=cv2.FONT_HERSHEY_COMPLEX,
+                    fontScale=0.35)
+    if contour is not None:
+        cv2.drawContours(disp_frame, [contour.reshape((-1, 1, 2))], 0, (0, 255, 0), 1)
+    if len(bounds) == 2:
+        cv2.rectangle(disp_frame, tuple(bounds[0]), tuple(bounds[1]), (255, 255, 255))
+    return disp_frame
+
+
+def draw_contrails(frame, contrail_coords):
+    """Draws the trail and movement direction of the latest tracked coordinates (newest first) over frame"""
+    size = len(contrail_coords)
+    # Generate contrails
+    for i in np.arange(1, size):
+        thickness = int(np.sqrt(32.0 / (i + 1)) * 2.5)
+        cv2.line(frame, contrail_coords[i - 1], contrail_coords[i], (255, 0, 0), thickness)
+    # Generate Movement Direction
+    if size >= 10:
+        curr = contrail_coords[0]
+        last = contrail_coords[-10]
+        dx = curr[0] - last[0]
+        dy = curr[1] - last[1]
+        dir_x, dir_y = '', ''
+        if np.abs(dx) > 20:
+            dir_x = 'Right' if np.sign(dx) == 1 else 'Left'
+        if np.abs(dy) > 20:
+            dir_y = 'Down' if np.sign(dy) == 1 else 'Up'
+        if dir_x and dir_y:
+            direction = '{}-{}'.format(dir_x, dir_y)
+        else:
+            direction = dir_x if dir_x else dir_y
+        cv2.putText(frame, direction, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.65,
+                    (255, 0, 0), 2)
+        cv2.putText(frame, 'dx, dy: ({}, {})'.format(dx, dy), (10, 470), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.35, (255, 0, 0), 1)
+    # Return processed frame
+    return frame
 
 
 class CV2Processor(StoppableProcess):
     """CV2 Operations on supplied image"""
-    def __init__(self, saved_bounds):
+    def __init__(self, saved_bounds, log_overlay=False):
         super(CV2Processor, self).__init__()
         self.name = PROC_CV2
         self.connected = True
-        self.rec_to_file_sync_event = mp.Event()
         # Communication
         self.input_msgs = mp.Queue()
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         # Input and Outputs
         self.cmrcv2_mp_array = SyncableMPArray(VID_DIM)
         self.cv2gui_mp_array = SyncableMPArray(VID_DIM_RGB)
@@ -69,7 +164,12 @@ class CV2Processor(StoppableProcess):
         self.has_background = False
         self.bounding_coords = [] if saved_bounds == DEFAULT_BOUNDS else saved_bounds
         self.show_only_tracked_space = False
-        self.contrail_coords = deque(maxlen=32)
+        self.contrail_coords = deque(maxlen=CONTRAIL_LENGTH)
+        self.num_backgrounds = 0
+        # Send each frame's contour and drawing state changes with its coordinate, so the CV2 video can be rendered
+        # offline (see Concurrency.OfflineRender)
+        self.log_overlay = log_overlay
+        self.overlay_state = None
         # CV2 Params
         self.num_calib_frames = 20
         self.accum_fn = np.mean
@@ -86,7 +186,7 @@ class CV2Processor(StoppableProcess):
         self.input_array = self.cmrcv2_mp_array.generate_np_array()
         self.output_array = self.cv2gui_mp_array.generate_np_array()
         self.targ_perim = CV2TargetAreaPerimeter()
-        self.frame_buffer = Queue.Queue()
+        self.frame_buffer = BoundedBuffer(FRAME_BUFFER_SIZE, DROP_OLDEST, name='display_frames')
 
     def run(self):
         """called by start(); spawns new process"""
@@ -121,11 +221,13 @@ class CV2Processor(StoppableProcess):
         """Polls for frames and sends to output np array"""
         while self.connected:
             if self.output_array.can_send_img():
-                data = self.frame_buffer.get()
+                try:
+                    data, frame_seq, capture_time = self.frame_buffer.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
                 self.output_array.send_img(data)
+                self.output_array.set_frame_info(frame_seq, capture_time)
                 self.output_array.set_can_recv_img()
-                # Inform CV2VidRecProcess that it can record a frame
-                self.rec_to_file_sync_event.set()
             else:
                 time.sleep(1.0 / 1000.0)
 
@@ -139,7 +241,9 @@ class CV2Processor(StoppableProcess):
             CMD_GET_BG: lambda val: self.get_new_bg(),
             CMD_TARG_DRAW: lambda params: self.targ_perim.toggle_draw(params),
             CMD_TARG_RADIUS: lambda radius: self.targ_perim.update_radius(radius),
-            MSG_ERROR: lambda val: self.display_error_img()
+            CMD_TARG_REGIONS: lambda regions: self.targ_perim.set_extra_regions(regions),
+            MSG_ERROR: lambda val: self.display_error_img(),
+            CMD_REPORT_BUFFER_STATS: lambda trial: self.report_buffer_stats(trial)
         }
 
     def process_message(self, msg):
@@ -151,6 +255,12 @@ class CV2Processor(StoppableProcess):
         msg = NewMessage(dev=self.name, cmd=cmd, val=val)
         self.output_msgs.put_nowait(msg)
 
+    def report_buffer_stats(self, trial):
+        """Sends buffer counters since last report to be saved with trial (if any); then resets them"""
+        if trial:
+            self.msg_proc_handler(cmd=MSG_BUFFER_STATS, val=(trial, [self.frame_buffer.stats()]))
+        self.frame_buffer.reset_stats()
+
     def msg_polling(self):
         """Run on separate thread. Listens to input_msgs queue for messages"""
         while self.connected:
@@ -171,11 +281,15 @@ class CV2Processor(StoppableProcess):
         """Acquire one image per call"""
         if self.input_array.can_recv_img():
             frame = self.image_iterator()
-            frame, coord = self.track_mouse(frame=frame)
+            frame_seq, capture_time = self.input_array.get_frame_info()
+            frame, coord, contour = self.track_mouse(frame=frame)
             if coord != (None, None):
                 frame = self.process_coords(frame, coord)
-            self.frame_buffer.put_nowait(frame)
-            self.coords_output_queue.put_nowait(coord)
+            overlay = None
+            if self.log_overlay:
+                overlay = (None if contour is None else contour.reshape((-1, 2))), self.overlay_changes()
+            self.frame_buffer.put_nowait((frame, frame_seq, capture_time))
+            self.coords_output_queue.put_nowait((coord, frame_seq, capture_time, overlay))
             self.input_array.set_can_send_img()
         else:
             time.sleep(1.0 / 1000.0)
@@ -200,7 +314,7 @@ class CV2Processor(StoppableProcess):
                     fnum_frame = blank.copy()
                     cv2.putText(fnum_frame, 'Acquiring Background ({}/{})'.format(len(bg) + 1, self.num_calib_frames),
                                 (60, 250), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 3)
-                    self.frame_buffer.put_nowait(fnum_frame)
+                    self.frame_buffer.put_nowait((fnum_frame, NO_FRAME_SEQ, float('nan')))
                     fnum += 1
                 if self.input_array.can_recv_img():
                     bg.append(self.image_iterator())
@@ -214,6 +328,7 @@ class CV2Processor(StoppableProcess):
             self.background = self.accum_fn(bg, axis=0)
             self.bg_original = self.background.copy()
             self.has_background = True
+            self.num_backgrounds += 1
             if len(self.bounding_coords) == 2:
                 self.crop_to_bounds(self.background)
             # We send the new background to be saved at output
@@ -231,10 +346,10 @@ class CV2Processor(StoppableProcess):
                     self.kernel[i, j] = 1
 
     def track_mouse(self, frame):
-        """Tracks motion against background generated in get_bg()"""
+        """Tracks motion against background generated in get_bg(). Returns the display image, the coordinate and
+        contour of the mouse (None if no contour was found)"""
         # Return coords, frame
         disp_frame = frame.copy().astype('uint8')
-        cx, cy = None, None
         # Do we have boundaries? If so, crop frame so that areas outside boundaries are not tracked
         if len(self.bounding_coords) == 2:
             self.crop_to_bounds(frame)
@@ -246,81 +361,40 @@ class CV2Processor(StoppableProcess):
         seg = cv2.morphologyEx(th, cv2.MORPH_OPEN, self.kernel)
         seg = seg.astype('uint8')
         _, contours, hierarchy = cv2.findContours(seg, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        # Generate image with basic cv2 drawings
-        disp_frame = np.dstack((disp_frame, disp_frame, disp_frame))  # RGB Stack
-        if self.targ_perim.draw:
-            cv2.rectangle(disp_frame,
-                          (self.targ_perim.x1, self.targ_perim.y1),
-                          (self.targ_perim.x2, self.targ_perim.y2),
-                          (0, 255, 0), thickness=2)
-        if not contours:
-            cv2.putText(disp_frame, 'x, y: (NA, NA)', org=(10, 460), color=(255, 0, 0),
-                        fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=0.35)
-            if len(self.bounding_coords) == 2:
-                cv2.rectangle(disp_frame, self.bounding_coords[0], self.bounding_coords[1], (255, 255, 255))
-            return disp_frame, (cx, cy)
-        # Generate Contours
-        contour_area = np.array([cv2.contourArea(c) for c in contours])
-        contour_area = np.abs(contour_area - self.tracking_size)
-        select_contour = np.argmin(contour_area)
-        moments = cv2.moments(contours[select_contour])
-        # Generate image with contours drawn
-        try:
-            cx = int(moments['m10'] / moments['m00'])
-            cy = int(moments['m01'] / moments['m00'])
-        except ZeroDivisionError:
-            print('ZeroDivisionError, passing this frame.')
-            cv2.putText(disp_frame, 'x, y: (NA, NA)', org=(10, 460), color=(255, 0, 0),
-                        fontFace=cv2.FONT_HERSHEY_COMPLEX, fontScale=0.35)
-        else:
-            cv2.circle(disp_frame, (cx, cy), 3, (0, 0, 255), thickness=-1)
-            loc = 'x, y: ({}, {})'.format(cx, cy)
-            cv2.putText(disp_frame, loc, org=(10, 460), color=(255, 0, 0), fontFace=cv2.FONT_HERSHEY_COMPLEX,
-                        fontScale=0.35)
-        cv2.drawContours(disp_frame, contours, select_contour, (0, 255, 0), 1)
-        if len(self.bounding_coords) == 2:
-                cv2.rectangle(disp_frame, self.bounding_coords[0], self.bounding_coords[1], (255, 255, 255))
-        return disp_frame, (cx, cy)
+        contour, coord = None, (None, None)
+        if contours:
+            # Select contour closest to expected mouse size
+            contour_area = np.array([cv2.contourArea(c) for c in contours])
+            contour_area = np.abs(contour_area - self.tracking_size)
+            contour = contours[np.argmin(contour_area)]
+            moments = cv2.moments(contour)
+            try:
+                coord = int(moments['m10'] / moments['m00']), int(moments['m01'] / moments['m00'])
+            except ZeroDivisionError:
+                print('ZeroDivisionError, passing this frame.')
+        disp_frame = draw_tracking(disp_frame, self.targ_perim.regions(), self.bounding_coords, contour, coord)
+        return disp_frame, coord, contour
 
     def process_coords(self, frame, coord):
         """Takes supplied coordinates and generate movement direction + trail"""
         self.contrail_coords.appendleft(coord)
-        size = len(self.contrail_coords)
-        # Generate contrails
-        for i in np.arange(1, size):
-            thickness = int(np.sqrt(32.0 / (i + 1)) * 2.5)
-            cv2.line(frame, self.contrail_coords[i - 1], self.contrail_coords[i], (255, 0, 0), thickness)
-        # Generate Movement Direction
-        if size >= 10:
-            curr = self.contrail_coords[0]
-            last = self.contrail_coords[-10]
-            dx = curr[0] - last[0]
-            dy = curr[1] - last[1]
-            dir_x, dir_y = '', ''
-            if np.abs(dx) > 20:
-                dir_x = 'Right' if np.sign(dx) == 1 else 'Left'
-            if np.abs(dy) > 20:
-                dir_y = 'Down' if np.sign(dy) == 1 else 'Up'
-            if dir_x and dir_y:
-                direction = '{}-{}'.format(dir_x, dir_y)
-            else:
-                direction = dir_x if dir_x else dir_y
-            cv2.putText(frame, direction, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.65,
-                        (255, 0, 0), 2)
-            cv2.putText(frame, 'dx, dy: ({}, {})'.format(dx, dy), (10, 470), cv2.FONT_HERSHEY_SIMPLEX,
-                        0.35, (255, 0, 0), 1)
-        # Return processed frame
-        return frame
+        return draw_contrails(frame, self.contrail_coords)
+
+    def overlay_changes(self):
+        """Drawing state if it changed since last called, else None"""
+        state = {'bounds': [list(coord) for coord in self.bounding_coords],
+                 'show_tracked': self.show_only_tracked_space,
+                 'regions': self.targ_perim.regions(),
+                 'background': self.num_backgrounds}
+        if state == self.overlay_state:
+            return None
+        self.overlay_state = state
+        return state
 
     # Misc Image Display Options
     def crop_to_bounds(self, frame):
         """Crops a supplied frame to bounding coordinates"""
-        x1, y1 = self.bounding_coords[0]
-        x2, y2 = self.bounding_coords[1]
-        frame[:y1] = 0
-        frame[y2:] = 0
-        frame[:, :x1] = 0
-        frame[:, x2:] = 0
+        crop_to_bounds(frame, self.bounding_coords)
 
     def toggle_show_cropped_img(self):
         """Toggle showing tracked space only or entire image"""
@@ -346,4 +420,4 @@ class CV2Processor(StoppableProcess):
 
     def display_error_img(self):
         """If camera process encountered an error, we will display an error image to notify user"""
-        self.frame_buffer.put_nowait(self.error_img)
+        self.frame_buffer.put_nowait((self.error_img, NO_FRAME_SEQ, float('nan')))
@@ -3,130 +3,149 @@
 """Camera Process"""
 
 import sys
-import cv2
 import time
-from Misc.GlobalVars import VID_DIM
-import PyCapture2 as cap
-from Misc.GlobalVars import *
+from importlib.util import find_spec
+from Misc.CoreVars import *
+from Misc.IPC import proc_handler_queue
 from Misc.CustomClasses import *
 import threading as thr
+from Concurrency.VideoDecoder import PrefetchingDecoder
+from Concurrency.SyntheticSource import SyntheticCamera
 if sys.version[0] == '2':
     import Queue as Queue
 else:
     import queue as Queue
 
 
-# Do we restrict camera exposure?
-RESTRICT_EXPOSURE = True
-
-
-class CameraDevice(cap.Camera):
-    """Container for PTGrey FireFly Camera Hardware"""
-    def __init__(self):
-        super(CameraDevice, self).__init__()
-        self.running = False  # is the camera working
-        self.in_use = False  # are we using the camera or a saved video as source
-        # Hardware attributes
-        self.cmr_err = cap.Fc2error
-        # Finalize init
-        self.connect_camera()
-        time.sleep(50.0 / 1000.0)
-
-    def get_img(self):
-        """Acquires image data from camera"""
-        img = self.retrieveBuffer()
-        img = img.getData()
-        img = img.reshape(VID_DIM)
-        return img
-
-    def connect_camera(self):
-        """Initializes a PTGrey FireFly Camera"""
-        # Close any existing camera connections
-        self.close_camera()
-        # Try to connect
-        try:
-            bus = cap.BusManager()
-            cam_id = bus.getCameraFromIndex(0)
-            self.connect(cam_id)
-            self.setVideoModeAndFrameRate(cap.VIDEO_MODE.VM_640x480Y8, PYCAP_FRAMERATE)
-            if RESTRICT_EXPOSURE:
-                self.set_properties()
-            self.startCapture()
-        except self.cmr_err:
-            self.running = False
-        else:
-            self.running = True
-
-    def set_properties(self):
-        """Edit camera properties for better exposure control"""
-        # Set Frame Rate
-        self.writeRegister(CMR_REG_FRAMERATE, CMR_SET_REG_ABS_MANUAL)
-        self.writeRegister(CMR_REG_FRAMERATE_ABS, CAMERA_ABS_FRAMERATE_INT)
-        # Read register and apply a mask on last 12 digits to obtain max value
-        bright_max = self.readRegister(CMR_REG_BRIGHTNESS - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
-        exposure_max = self.readRegister(CMR_REG_EXPOSURE - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
-        shutter_max = self.readRegister(CMR_REG_SHUTTER - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
-        gain_max = self.readRegister(CMR_REG_GAIN - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
-        # Write max values to registers
-        self.writeRegister(CMR_REG_BRIGHTNESS, CMR_SET_REG_MANUAL_LOW | bright_max)
-        self.writeRegister(CMR_REG_EXPOSURE, CMR_SET_REG_MANUAL_LOW | exposure_max)
-        self.writeRegister(CMR_REG_SHUTTER, CMR_SET_REG_MANUAL_LOW | shutter_max)
-        self.writeRegister(CMR_REG_GAIN, CMR_SET_REG_MANUAL_LOW | gain_max)
-
-    def close_camera(self):
-        """Closes Device and Exits Process"""
-        self.running = False
-        try:
-            self.stopCapture()
-            self.disconnect()
-        except self.cmr_err:
-            pass
+# Camera backends, as selected in settings
+CAMERA_PYCAPTURE = 'pycapture2'
+CAMERA_SYNTHETIC = 'synthetic'
+# Frames held between the capture thread and tracking; if tracking falls behind, the oldest are overwritten
+CAPTURE_RING_FRAMES = 8
+# Secs the main loop waits for a captured frame before checking whether it is exiting
+CAPTURE_WAIT = 0.2
+# A gap between camera timestamps longer than this many frame periods means the camera dropped frames
+DROP_GAP_PERIODS = 1.5
+CAMERA_TIMESTAMPS_ENDING = '_CameraTimestamps.csv'
+CAMERA_TIMESTAMPS_HEADER = ('Frame', 'Camera Time (s)', 'Host Capture (ns)')
+CAMERA_TIMESTAMP_DTYPE = np.dtype([('frame', 'i8'), ('camera_time', 'f8'), ('capture_ns', 'i8')])
+
+
+def create_camera(backend):
+    """Camera by backend name. The camera SDK is only imported (in the camera process) if its camera is used;
+    without the SDK, the synthetic camera is used instead"""
+    if backend not in (CAMERA_PYCAPTURE, CAMERA_SYNTHETIC):
+        raise ValueError('[{}] is not a valid camera backend!'.format(backend))
+    if backend == CAMERA_PYCAPTURE and find_spec('PyCapture2') is None:
+        print('PyCapture2 is not installed; using the [{}] camera'.format(CAMERA_SYNTHETIC))
+        backend = CAMERA_SYNTHETIC
+    if backend == CAMERA_SYNTHETIC:
+        return SyntheticCamera((VID_DIM[1], VID_DIM[0]), CAMERA_FRAMERATE)
+    from Concurrency.PtGreyCamera import CameraDevice
+    return CameraDevice()
+
+
+def green_channel(frame):
+    """Grayscale video sources are decoded as BGR; the camera's frames are a single channel"""
+    return frame[..., 1] if len(frame.shape) == 3 else frame
 
 
 class VideoSource(object):
-    """Instead of using the camera, we can also load an already recorded video"""
-    def __init__(self):
-        self.video = None
+    """Instead of using the camera, we can also load an already recorded video.
+    Frames are decoded ahead on a worker thread (see Concurrency.VideoDecoder), from frame start_frame on.
+    playback_speed: multiple of the video's fps frames are replayed at; 0 replays as fast as the pipeline accepts"""
+    def __init__(self, playback_speed=1.0, start_frame=0):
+        self.decoder = None
         self.get_img = None
+        self.playback_speed = playback_speed
+        self.start_frame = start_frame
+        self.frame_period = 0.0
+        self.next_due = 0.0
+        # Frames smaller than the camera's are padded into this, reused for every frame
+        self.base = np.zeros(VID_DIM, dtype='uint8')
 
     def assign_video(self, vidpath):
         """Creates a new video read object from source video"""
-        self.video = cv2.VideoCapture(vidpath)
+        self.close_video()
+        # The previous video may have been larger; its pixels must not show around a smaller video's frames
+        self.base.fill(0)
+        try:
+            self.decoder = PrefetchingDecoder(vidpath, self.start_frame, convert=green_channel)
+        except IOError as error:
+            print(error)
+        fps = self.decoder.fps if self.decoder and self.decoder.fps > 0 else CAMERA_FRAMERATE
+        self.frame_period = 1.0 / (fps * self.playback_speed) if self.playback_speed > 0 else 0.0
+        self.next_due = 0.0
         iterator = self.img_iterator()
         self.get_img = lambda: next(iterator)
 
+    def close_video(self):
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+
+    def pace(self):
+        """Waits until the next frame is due. If the pipeline fell behind, frames are not rushed to catch up"""
+        if not self.frame_period:
+            return
+        delay = self.next_due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_due = max(self.next_due + self.frame_period, time.perf_counter())
+
     def img_iterator(self):
         """Creates a generator for getting the next frame"""
-        _, frame = self.video.read()
-        while frame is not None:
-            base = np.zeros(VID_DIM, dtype='uint8')
-            frame = frame[..., 1] if len(frame.shape) == 3 else frame
-            base[:frame.shape[0], :frame.shape[1]] = frame
-            yield base
-            time.sleep(15.0 / 1000.0)
-            _, frame = self.video.read()
+        decoder = self.decoder
+        if decoder is None:
+            return
+        num_frames, start = 0, time.perf_counter()
+        for frame in decoder:
+            if frame.shape != VID_DIM:
+                self.base[:frame.shape[0], :frame.shape[1]] = frame
+                frame = self.base
+            self.pace()
+            yield frame
+            num_frames += 1
+        secs = time.perf_counter() - start
+        print('Replayed {} Frames in {} Secs ({} FPS); {} Secs Waiting for Decoding'.format(
+            num_frames, round(secs, 2), round(num_frames / secs, 1) if secs else 0, round(decoder.waited_secs, 2)))
 
 
 class CameraHandler(StoppableProcess):
     """Camera Process that handles incoming messages and relays them to camera hardware"""
-    def __init__(self, cmr_cv2_mp_array):
+    def __init__(self, cmr_cv2_mp_array, playback_speed=1.0, start_frame=0, camera_backend=CAMERA_PYCAPTURE):
         super(CameraHandler, self).__init__()
         self.name = PROC_CMR
         self.connected = True
         self.input_msgs = mp.Queue()
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         self.cmr_cv2_mp_array = cmr_cv2_mp_array
         self.rec_to_file_sync_event = mp.Event()
+        # Speed videos used instead of the camera are replayed at; see VideoSource
+        self.playback_speed = playback_speed
+        self.start_frame = start_frame
+        self.camera_backend = camera_backend
+        # Sequence number of the next frame sent; identifies frames across processes
+        self.frame_seq = 0
         # Sometimes, we need to tell CV2_Proc To calibrate a new background
         self.get_background = False
+        # Camera timestamps of frames sent are logged from trial start until the trial is saved
+        self.log_timestamps = False
+        # Counters of the camera, since the last trial report
+        self.frames_captured = 0
+        self.camera_drops = 0
+        self.last_camera_time = None
 
     def run(self):
         """This is called by self.start(), and creates a new process"""
         self.init_unpickleable_objs()
         # Threading
         POLLING = 'polling'
+        CAPTURE = 'capture'
         thr_msg_polling = thr.Thread(target=self.msg_polling, name=POLLING, daemon=True)
         thr_msg_polling.start()
+        thr_capture = thr.Thread(target=self.capture_frames, name=CAPTURE, daemon=True)
+        thr_capture.start()
         # We begin by using camera; vidpath=None activates Camera functions
         self.toggle_vid_src(vidpath=None)
         if not self.camera.running:
@@ -149,10 +168,11 @@ class CameraHandler(StoppableProcess):
             if self.stopped():
                 self.connected = False
                 self.camera.close_camera()
+                self.vidsrc.close_video()
                 while True:
                     time.sleep(5.0 / 1000.0)
                     threads = [thread.name for thread in thr.enumerate()]
-                    if POLLING not in threads:
+                    if POLLING not in threads and CAPTURE not in threads:
                         break  # we only exit process if all child threads were terminated
         print('Exiting Camera Process...')
 
@@ -161,7 +181,8 @@ class CameraHandler(StoppableProcess):
         """Dictionary of {Msg:Actions}"""
         self.msg_parser = {
             CMD_EXIT: lambda val: self.stop(),
-            CMD_SET_VIDSRC: lambda val: self.toggle_vid_src(val)
+            CMD_SET_VIDSRC: lambda val: self.toggle_vid_src(val),
+            CMD_REPORT_BUFFER_STATS: lambda trial: self.report_buffer_stats(trial)
         }
 
     def msg_proc_handler(self, cmd, val=None):
@@ -187,41 +208,111 @@ class CameraHandler(StoppableProcess):
     # Concurrency
     def init_unpickleable_objs(self):
         """Sets up objects that must be initialized in the process it will be running"""
-        self.camera = CameraDevice()
-        self.vidsrc = VideoSource()
+        self.camera = create_camera(self.camera_backend)
+        self.vidsrc = VideoSource(self.playback_speed, self.start_frame)
         self.cmr_cv2_np_array = self.cmr_cv2_mp_array.generate_np_array()
+        self.capture_ring = FrameRing(VID_DIM, 'uint8', CAPTURE_RING_FRAMES, name='capture_ring')
+        self.timestamps = self.new_timestamp_log()
+        # Reports swap the timestamp log on the polling thread while frames are logged on the main loop
+        self.timestamps_lock = thr.Lock()
         self.setup_msg_parser()
 
+    @staticmethod
+    def new_timestamp_log():
+        return RecordBuffer(CAMERA_TIMESTAMP_DTYPE, capacity=0, chunk_size=60 * CAMERA_FRAMERATE,
+                            name='camera_timestamps')
+
     def toggle_vid_src(self, vidpath):
         """Switch between using camera and a video file"""
         if not vidpath:  # use camera
+            self.vidsrc.close_video()
+            # Frames captured before the switch are stale
+            self.capture_ring.clear()
             self.camera.in_use = True
-            self.next_frame = self.camera.get_img
-            self.error = self.camera.cmr_err
         elif vidpath:  # use supplied video
             self.camera.in_use = False
             self.vidsrc.assign_video(vidpath)
-            self.next_frame = self.vidsrc.get_img
-            self.error = StopIteration
         self.get_background = True
 
     def get_frames(self):
-        """Acquires 1 Image per call"""
-        if self.cmr_cv2_np_array.can_send_img():
+        """Acquires 1 Image per call: the oldest frame captured from the camera, or the next frame of the video"""
+        if not self.cmr_cv2_np_array.can_send_img():
+            time.sleep(1.0 / 1000.0)
+            return
+        if self.camera.in_use:
+            tags = self.capture_ring.read(self.cmr_cv2_np_array, timeout=CAPTURE_WAIT)
+            if tags is None:
+                return
+            capture_ns, camera_time = tags
+        else:
+            try:
+                data = self.vidsrc.get_img()
+            except StopIteration:
+                time.sleep(0.10)
+                return
+            self.cmr_cv2_np_array.send_img(data)
+            capture_ns, camera_time = time.perf_counter_ns(), float('nan')
+        with self.timestamps_lock:
+            self.cmr_cv2_np_array.set_frame_info(self.frame_seq, capture_ns / 1e9)
+            if self.log_timestamps:
+                self.timestamps.append(self.frame_seq, camera_time, capture_ns)
+            self.frame_seq += 1
+        self.cmr_cv2_np_array.set_can_recv_img()
+        # Inform CmrVidRecProcess that it can record a frame
+        self.rec_to_file_sync_event.set()
+
+    def capture_frames(self):
+        """Run on separate thread. Drains the camera into the capture ring as fast as it delivers frames, whether or
+        not tracking keeps up. Each frame is tagged with the host time it arrived and the camera's timestamp"""
+        while self.connected:
+            if not (self.camera.in_use and self.camera.running):
+                self.last_camera_time = None
+                time.sleep(10.0 / 1000.0)
+                continue
             try:
-                data = self.next_frame()
-            except self.error:
-                if self.error == self.camera.cmr_err:
+                img, camera_time = self.camera.get_img()
+            except self.camera.cmr_err:
+                # Closing the camera on exit also interrupts retrieving images
+                if self.connected and self.camera.running:
                     self.report_camera_error()
-                elif self.error == StopIteration:
-                    time.sleep(0.10)
-            else:
-                self.cmr_cv2_np_array.send_img(data)
-                self.cmr_cv2_np_array.set_can_recv_img()
-                # Inform CmrVidRecProcess that it can record a frame
-                self.rec_to_file_sync_event.set()
-        else:
-            time.sleep(1.0 / 1000.0)
+                continue
+            capture_ns = time.perf_counter_ns()
+            self.count_camera_drops(camera_time)
+            self.capture_ring.write(img, (capture_ns, camera_time))
+
+    def count_camera_drops(self, camera_time):
+        """Frames the camera dropped show as gaps of more than DROP_GAP_PERIODS frame periods between timestamps"""
+        self.frames_captured += 1
+        if self.last_camera_time is not None:
+            periods = (camera_time - self.last_camera_time) * CAMERA_FRAMERATE
+            # Negative after the camera reconnects, as its clock restarts
+            if periods > DROP_GAP_PERIODS:
+                self.camera_drops += int(round(periods)) - 1
+        self.last_camera_time = camera_time
+
+    def report_buffer_stats(self, trial):
+        """Sends capture counters since last report to be saved with trial (if any), and saves the timestamps of the
+        frames sent meanwhile; then resets them. Timestamps are logged from the first report (trial start) on"""
+        new_timestamps = self.new_timestamp_log()
+        with self.timestamps_lock:
+            timestamps, self.timestamps = self.timestamps, new_timestamps
+            self.log_timestamps = not trial
+        if trial:
+            camera = ('camera', DROP_NEWEST, '', self.frames_captured + self.camera_drops, self.camera_drops, '', '',
+                      0.0)
+            self.msg_proc_handler(cmd=MSG_BUFFER_STATS, val=(trial, [self.capture_ring.stats(), camera]))
+            self.save_timestamps(trial + CAMERA_TIMESTAMPS_ENDING, timestamps.data)
+        self.capture_ring.reset_stats()
+        self.frames_captured = 0
+        self.camera_drops = 0
+
+    @staticmethod
+    def save_timestamps(file, timestamps):
+        """Camera and host capture times of each frame sent during the trial; camera time is nan for video files"""
+        with open(file, 'w') as f:
+            for line in [CAMERA_TIMESTAMPS_HEADER] + timestamps.tolist():
+                f.write(''.join('{},'.format(element) for element in line))
+                f.write('\n')
 
     def report_camera_error(self):
         """If camera reports an error, we notify proc_handler"""
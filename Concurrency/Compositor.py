@@ -0,0 +1,118 @@
+# coding=utf-8
+
+"""Process assembling the displays of all processes into one shared BGR composite, for the GUI and CV2 video"""
+
+import sys
+import time
+import numpy as np
+import threading as thr
+import multiprocessing as mp
+from Misc.SharedArrays import SyncableMPArray
+from Misc.CustomClasses import StoppableProcess, ReadMessage
+from Misc.CoreVars import *
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Panels of the composite, in order of their dirty flags
+PANEL_CV2GUI = 'cv2gui'
+PANEL_PATHING = 'pathing'
+PANEL_HEATMAP = 'heatmap'
+PANEL_GRADIENT = 'gradient'
+PANEL_PROGBAR = 'progbar'
+PANELS = (PANEL_CV2GUI, PANEL_PATHING, PANEL_HEATMAP, PANEL_GRADIENT, PANEL_PROGBAR)
+# Maps and gradient on the left, camera and progress bar on the right; the progress bar has a 1px black border
+COMPOSITE_DIMS = VID_DIM_RGB[0] + GRADIENT_HEIGHT, VID_DIM_RGB[1] + MAP_DIMS[1], 3
+PANEL_SLICES = {
+    PANEL_CV2GUI: np.s_[:VID_DIM_RGB[0], MAP_DIMS[1]:COMPOSITE_DIMS[1]],
+    PANEL_PATHING: np.s_[:MAP_DIMS[0], :MAP_DIMS[1]],
+    PANEL_HEATMAP: np.s_[MAP_DIMS[0]:VID_DIM_RGB[0], :MAP_DIMS[1]],
+    PANEL_GRADIENT: np.s_[VID_DIM_RGB[0]:COMPOSITE_DIMS[0], :MAP_DIMS[1]],
+    PANEL_PROGBAR: np.s_[VID_DIM_RGB[0] + 1:COMPOSITE_DIMS[0] - 1, MAP_DIMS[1]:COMPOSITE_DIMS[1]]
+}
+
+
+class Compositor(StoppableProcess):
+    """Receives each panel (RGB) from its process and copies it into its place in a shared BGR composite.
+    Only panels that changed are copied; their dirty flags tell the GUI which panels to redraw"""
+    def __init__(self, panel_mp_arrays):
+        super(Compositor, self).__init__()
+        self.name = PROC_COMPOSITOR
+        self.connected = True
+        # Cross process communication
+        self.input_msgs = mp.Queue()
+        # {panel: mp array}
+        self.panel_mp_arrays = panel_mp_arrays
+        # Set for each new camera frame composited; CV2 video records one composite per camera frame
+        self.rec_to_file_sync_event = mp.Event()
+        # Output
+        self.composite_mp_array = SyncableMPArray(COMPOSITE_DIMS)
+        self.dirty_flags = mp.Array('B', len(PANELS), lock=False)
+
+    # Initialize objects
+    def init_unpickleable_objs(self):
+        """Creates objects that must exist in the new process"""
+        self.panels = tuple((panel, index, self.panel_mp_arrays[panel].generate_np_array(), PANEL_SLICES[panel])
+                            for index, panel in enumerate(PANELS))
+        self.composite = self.composite_mp_array.generate_np_array()
+        self.composite_lock = self.composite_mp_array.array.get_lock()
+        self.setup_msg_parser()
+
+    def setup_msg_parser(self):
+        """Dictionary of {Msg:Actions}"""
+        self._msg_parser = {
+            CMD_EXIT: lambda val: self.stop()
+        }
+
+    # Msg polling and processing thread
+    def process_message(self, msg):
+        self._msg_parser[msg.command](msg.value)
+
+    def msg_polling(self):
+        """Run on separate thread. Listens to input_msgs queue for messages"""
+        while self.connected:
+            try:
+                msg = self.input_msgs.get(timeout=0.5)
+            except Queue.Empty:
+                time.sleep(30.0 / 1000.0)
+            else:
+                msg = ReadMessage(msg)
+                self.process_message(msg)
+
+    # Main thread
+    def run(self):
+        """Called by start() when spawning a new process"""
+        self.init_unpickleable_objs()
+        POLLING = 'polling'
+        thr_msg_polling = thr.Thread(target=self.msg_polling, name=POLLING, daemon=True)
+        thr_msg_polling.start()
+        while self.connected:
+            if not self.composite_panels():
+                time.sleep(1.0 / 1000.0)
+            if self.stopped():
+                self.connected = False
+                thr_msg_polling.join()
+        print('Exiting Compositor...')
+
+    def composite_panels(self):
+        """Copies every panel with a new image into the composite. Returns True if any panel changed"""
+        changed = False
+        for name, index, panel, panel_slice in self.panels:
+            if not panel.can_recv_img():
+                continue
+            with self.composite_lock:
+                self.composite[panel_slice] = panel[..., ::-1]
+                self.dirty_flags[index] = 1
+                # The composite is identified by the camera frame shown in it
+                if name == PANEL_CV2GUI:
+                    self.composite.set_frame_info(*panel.get_frame_info())
+            panel.set_can_send_img()
+            changed = True
+            # Inform CV2 VideoRecorder that it can record a frame
+            if name == PANEL_CV2GUI:
+                self.rec_to_file_sync_event.set()
+        if changed:
+            self.composite.set_can_recv_img()
+        return changed
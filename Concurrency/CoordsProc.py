@@ -2,117 +2,109 @@
 
 """Processes CV2 Coordinates into paths and heatmap"""
 
+import os
 import cv2
 import time
-import serial
 import numpy as np
-from collections import deque
 import threading as thr
 import multiprocessing as mp
-from pyfirmata import Arduino
-from Misc.GlobalVars import *
+from collections import deque
+from Misc.CoreVars import *
+from Misc.IPC import proc_handler_queue, exp_start_event
 from Misc.CustomFunctions import format_secs
-from Misc.CustomClasses import StoppableProcess, ReadMessage, StopWatch, NewMessage
-from GUI.DataDisplays.SendRecvProtocols import SyncableMPArray
-from Concurrency.CV2Proc import CV2TargetAreaPerimeter
+from Misc.CustomClasses import StoppableProcess, ReadMessage, StopWatch, NewMessage, RecordBuffer
+from DirsSettings.TrialData import COORDS_DTYPE, NO_COORD, BUFFER_MARGIN_SECS, TARG_REGION_HEADER, write_coords_csv
+from DirsSettings.TrialStore import save_trial_store
+from DirsSettings.CoordsLog import CoordsLogWriter, LOG_ENDING, COORDS_LOG
+from DirsSettings.OverlayLog import OverlayLog, OVERLAY_ENDING
+from Concurrency.TrialFinaliser import TrialFinaliser
+from Concurrency.ArduinoIO import create_arduino, save_io_latencies, ARDUINO_FIRMATA
+from Concurrency.Stimulation import StimScheduler, STIM_SCHEDULER, save_stim_log, pulse_jitter
+from Concurrency.Protocols import StimProtocol
+from Misc.SharedArrays import SyncableMPArray
+from Concurrency.CV2Proc import CV2TargetAreaPerimeter, CONTRAIL_LENGTH
+from Analysis.Locomotion import LocomotionSummary
 import queue as Queue
 
 
-# Stimulate mouse for STIM_ON seconds every STIM_TOTAL seconds
-STIM_ON = 0.4
-STIM_TOTAL = 1.0
 # Thread names
 POLLING = 'polling'
-SEND_SIGNAL = 'send_signal'
-# Arduino Pin
-ARDPIN = 6
-
-
-class ArduinoDevice(object):
-    """Connects to external arduino hardware"""
-    def __init__(self):
-        self.main_pin = 'd:{}:o'.format(ARDPIN)  # digital, pin 6, output
-        self.test_pin = 'd:13:o'  # ask arduino for connection status. Added benefit of seeing LED 13 as visual aid
-        self.ping_state = 0
-        self.ping_interval = 1
-        self.ping_timer = StopWatch()
-        self.ping_timer.start()
-        self.manual_mode = False
-        self.connected = False
-
-    def connect(self):
-        """Attempts to connect to the device"""
-        self.connected = False
-        for port in range(1, 256+1):
-            port = 'COM{}'.format(port)
-            try:
-                temp1 = serial.Serial(port)
-                temp1.flush()
-                temp1.close()
-                self.board = Arduino(port)
-            except serial.serialutil.SerialException:
-                try:
-                    self.board.exit()
-                except AttributeError:
-                    try:
-                        temp2 = serial.Serial(port)
-                    except serial.serialutil.SerialException:
-                        pass
-                    else:
-                        temp2.flush()
-                        temp2.close()
-            else:
-                self.main_output = self.board.get_pin(self.main_pin)
-                self.test_output = self.board.get_pin(self.test_pin)
-                print('Arduino Port Found at: {}'.format(port))
-                self.connected = True
+# Chars the progress bar timers and counters are drawn with
+GLYPH_CHARS = '0123456789:.)'
+# Progress bar changes pending beyond this many regions are sent as a whole image
+MAX_DIRTY_REGIONS = 64
+
+
+class GlyphAtlas(object):
+    """Pre-rendered cv2 text glyphs. Text in a single font is drawn by blitting glyphs instead of cv2.putText"""
+    def __init__(self, font, scale, height, baseline, thickness=1, color=(255, 255, 255), chars=GLYPH_CHARS):
+        self.height = height
+        self.glyphs = {}
+        self.advances = {}
+        for char in chars:
+            width = cv2.getTextSize(char, font, scale, thickness)[0][0]
+            glyph = np.zeros((height, width + thickness, 3), dtype='uint8')
+            cv2.putText(glyph, char, (0, baseline), fontFace=font, fontScale=scale, color=color, thickness=thickness)
+            self.glyphs[char] = glyph
+            # Strokes overhang the advance by thickness, the same as in a cv2.putText string
+            self.advances[char] = width - thickness
+
+    def offsets(self, text):
+        """Horizontal offset of each char in text, plus the offset where text ends"""
+        offsets = [0]
+        for char in text:
+            offsets.append(offsets[-1] + self.advances[char])
+        return offsets
+
+
+class GlyphText(object):
+    """A text field of an image drawn from a glyph atlas. Only chars from the first changed char onwards are redrawn"""
+    def __init__(self, atlas, image, row, col, width):
+        self.atlas = atlas
+        self.row = row
+        self.col = col
+        self.slice = image[row:row + atlas.height, col:col + width, :]
+        self.width = self.slice.shape[1]
+        self.text = None
+        self.x = 0
+        self.extent = 0
+
+    def forget(self):
+        """Image was redrawn underneath; next draw redraws the whole field"""
+        self.text = None
+
+    def draw(self, text, x=0):
+        """Draws text at x in field. Returns changed (row_start, row_end, col_start, col_end) of image, or None"""
+        if text == self.text and x == self.x:
+            return None
+        offsets = self.atlas.offsets(text)
+        extent = min(self.width, x + offsets[-1] + 1)
+        if self.text is None:
+            first, clear_start, clear_end = 0, 0, self.width
+        elif x != self.x:
+            first, clear_start, clear_end = 0, min(x, self.x), max(extent, self.extent)
+        else:
+            first = 0
+            while first < min(len(text), len(self.text)) and text[first] == self.text[first]:
+                first += 1
+            clear_start, clear_end = x + offsets[first], max(extent, self.extent)
+            # The previous glyph overhangs into the first changed char; redraw it too
+            first = max(0, first - 1)
+        self.slice[:, clear_start:clear_end, :] = 0
+        for char, offset in zip(text[first:], offsets[first:]):
+            glyph = self.atlas.glyphs[char]
+            start = x + offset
+            if start >= self.width:
                 break
-
-    def toggle_manual(self):
-        """Turns manual mode on or off"""
-        self.manual_mode = not self.manual_mode
-
-    def __send_signal__(self):
-        """Sends a pulse"""
-        self.write(1)
-        time.sleep(STIM_ON)
-        self.write(0)
-
-    def send_signal(self):
-        """Sends a pulse using a worker thread"""
-        thread = thr.Thread(target=self.__send_signal__, daemon=True, name=SEND_SIGNAL)
-        thread.start()
-
-    def write(self, num):
-        """Writes to arduino while handling any serial errors"""
-        try:
-            self.main_output.write(num)
-        except (serial.serialutil.SerialTimeoutException, serial.serialutil.SerialException, AttributeError):
-            self.connected = False
-
-    def exit(self):
-        """Close device cleanly"""
-        try:
-            self.board.exit()
-        except (serial.serialutil.SerialException, serial.serialutil.SerialTimeoutException, AttributeError):
-            pass
-
-    def ping(self):
-        """test if arduino is still connected"""
-        if self.ping_timer.elapsed() > self.ping_interval:
-            try:
-                self.ping_state ^= 1
-                self.test_output.write(self.ping_state)
-            except (serial.serialutil.SerialTimeoutException, serial.serialutil.SerialException, AttributeError):
-                self.connected = False
-            finally:
-                self.ping_timer.reset()
-                self.ping_timer.start()
+            region = self.slice[:, start:start + glyph.shape[1], :]
+            np.maximum(region, glyph[:, :region.shape[1], :], out=region)
+        self.text, self.x, self.extent = text, x, extent
+        return self.row, self.row + self.atlas.height, self.col + clear_start, self.col + clear_end
 
 
 class ProgressBar(object):
     """Numpy Array based progress bar"""
-    def __init__(self, initial_duration):
+    def __init__(self, initial_duration, stim_protocol=None, arduino_backend=ARDUINO_FIRMATA):
         self.mp_array = SyncableMPArray((PROGBAR_HEIGHT, *VID_DIM_RGB[1:]))
         # -- Constants -- #
         # Total segments in progress bar (= horizontal length)
@@ -126,6 +118,9 @@ class ProgressBar(object):
         spacing = self.text_dims[0] // 2
         self.txt_left_lmt = spacing
         self.txt_right_lmt = self.num_steps - spacing
+        self.atlas = None
+        # Static layer (legends, time indicators) for each trial duration
+        self._static_layers = {}
         # -- Main thread vars -- #
         # Operation Params
         self.curr_loc = -1
@@ -133,7 +128,9 @@ class ProgressBar(object):
         self.start_time = None
         self.output_array = None
         self.image = None
-        self.displaying_error_image = False
+        # Regions (row_start, row_end, col_start, col_end) of image changed since last sent to output array
+        self.dirty_regions = []
+        self.displaying_error_image = None  # error text displayed instead of the progress bar, if any
         self.targ_perim = CV2TargetAreaPerimeter()
         # Progress bar segments for each element
         self.pbar_slice = None
@@ -141,8 +138,12 @@ class ProgressBar(object):
         self.mouse_stim_slice = None
         # Mouse Status
         self.mouse_in_target = False  # is mouse inside target region?
+        self.mouse_regions = 0  # bitmask of target regions mouse is inside
         self.mouse_recv_stim = False  # does mouse receive stimulation?
-        self.mouse_stim_timer = None  # timer to make sure mouse receives STIM_ON secs stim, max every STIM_TOTAL secs
+        self.protocol = StimProtocol(stim_protocol)  # decides when and how to stimulate
+        self.stim_scheduler = None  # times stimulation pulses while protocol allows
+        self.arduino_backend = arduino_backend  # see ArduinoIO.create_arduino
+        self._stim_written = False  # was the current pulse written to the arduino?
         self.in_targ_stopwatch = StopWatch()  # total time spent in target region
         self.get_stim_stopwatch = StopWatch()  # total time spent receiving stimulation
         self.mouse_n_entries = 0  # num entries into target region
@@ -155,28 +156,35 @@ class ProgressBar(object):
     # Initializing functions. Call once once new process starts
     def init_unpickleable_objs(self):
         """These objects must be created in the process they will run in"""
+        self.init_image()
+        # Arduino object; searched for in the background, we keep running while it is missing
+        self.arduino = create_arduino(self.arduino_backend)
+        self.arduino.start()
+        self.arduino.connect()
+        self.stim_scheduler = StimScheduler(output=self.write_stim, stim_on=self.protocol.stim_on,
+                                            stim_period=self.protocol.stim_period)
+        self.stim_scheduler.start()
+        # Set Progress bar to initial conditions
+        self.reset_bar()
+
+    def init_image(self):
+        """Output array, progress bar image and its text fields"""
         self.output_array = self.mp_array.generate_np_array()
         self.image = self.output_array.copy()
         # Progress bar slices
         self.pbar_slice = self.image[20:60, :, :1]
         self.mouse_in_targ_slice = self.image[20:40, :, 1:2]
         self.mouse_stim_slice = self.image[40:60, :, 2:3]
-        # Text slices
+        # Text fields
         w, h = self.text_dims
-        self.main_timer_slice = self.image[:self.text_vloc+5, :, :]
-        self.targ_timer_slice = self.image[92-h:92+5, 95:95+w, :]
-        self.stim_timer_slice = self.image[92-h:92+5, 411:411+w, :]
-        self.targ_count_slice = self.image[92-h:92+5, 256:256+int(w*3/4), :]
-        self.stim_count_slice = self.image[92-h:92+5, 563:563+int(w*3/4), :]
-        # Arduino object
-        cv2.putText(self.output_array, 'CONNECTING TO ARDUINO...', (30, 63),
-                    cv2.FONT_HERSHEY_SIMPLEX, 1.3, (255, 255, 255), 1)
-        self.output_array.set_can_recv_img()
-        self.arduino = ArduinoDevice()
-        self.arduino.connect()  # this step takes a few seconds
-        self.output_array.fill(0)
-        # Set Progress bar to initial conditions
-        self.reset_bar()
+        self.atlas = GlyphAtlas(self.font, self.text_size, h + 5, h, self.text_thickness)
+        self.main_timer_field = GlyphText(self.atlas, self.image, self.text_vloc - h, 0, self.num_steps)
+        self.targ_timer_field = GlyphText(self.atlas, self.image, 92 - h, 95, w)
+        self.stim_timer_field = GlyphText(self.atlas, self.image, 92 - h, 411, w)
+        self.targ_count_field = GlyphText(self.atlas, self.image, 92 - h, 256, int(w * 3 / 4))
+        self.stim_count_field = GlyphText(self.atlas, self.image, 92 - h, 563, int(w * 3 / 4))
+        self.text_fields = (self.main_timer_field, self.targ_timer_field, self.stim_timer_field,
+                            self.targ_count_field, self.stim_count_field)
 
     # Modifier Functions. Can call from other threads
     # *** Non-underscored variables are READ ONLY
@@ -189,11 +197,12 @@ class ProgressBar(object):
 
     def set_stop(self):
         self._running = False
+        self.stim_scheduler.set_gate(False)
 
     # Main Update Function. Run in Main Thread. Do NOT call from any other thread
     # *** Underscored variables are READ ONLY
     def set_timer_text(self, reset):
-        """Places cv2 text on output array"""
+        """Draws timer text and sends changes to output array"""
         if reset:
             main_timer = '00:00.000'
             mouse_in_region_timer = '00:00.000'
@@ -201,61 +210,66 @@ class ProgressBar(object):
             num_entries = '0)'
             num_stims = '0)'
         else:
-            main_timer = format_secs(time.perf_counter() - self.start_time, 'with_ms')
-            mouse_in_region_timer = format_secs(self.in_targ_stopwatch.elapsed(), 'with_ms')
-            mouse_recv_stim_timer = format_secs(self.get_stim_stopwatch.elapsed(), 'with_ms')
+            trial_time, in_targ_time, stim_time = self.timer_values()
+            main_timer = format_secs(trial_time, 'with_ms')
+            mouse_in_region_timer = format_secs(in_targ_time, 'with_ms')
+            mouse_recv_stim_timer = format_secs(stim_time, 'with_ms')
             num_entries = '{})'.format(self.mouse_n_entries)
             num_stims = '{})'.format(self.mouse_n_stims)
-        self.main_timer_slice.fill(0)
-        self.targ_timer_slice.fill(0)
-        self.stim_timer_slice.fill(0)
-        self.targ_count_slice.fill(0)
-        self.stim_count_slice.fill(0)
-        cv2.putText(self.main_timer_slice, main_timer, (self.text_hloc, self.text_vloc),
-                    fontFace=self.font, fontScale=self.text_size, color=(255, 255, 255))
-        cv2.putText(self.targ_timer_slice, mouse_in_region_timer, (0, self.text_dims[1]),
-                    fontFace=self.font, fontScale=self.text_size, color=(255, 255, 255))
-        cv2.putText(self.stim_timer_slice, mouse_recv_stim_timer, (0, self.text_dims[1]),
-                    fontFace=self.font, fontScale=self.text_size, color=(255, 255, 255))
-        cv2.putText(self.targ_count_slice, num_entries, (0, self.text_dims[1]),
-                    fontFace=self.font, fontScale=self.text_size, color=(255, 255, 255))
-        cv2.putText(self.stim_count_slice, num_stims, (0, self.text_dims[1]),
-                    fontFace=self.font, fontScale=self.text_size, color=(255, 255, 255))
+        self.mark_dirty(self.main_timer_field.draw(main_timer, self.text_hloc))
+        self.mark_dirty(self.targ_timer_field.draw(mouse_in_region_timer))
+        self.mark_dirty(self.stim_timer_field.draw(mouse_recv_stim_timer))
+        self.mark_dirty(self.targ_count_field.draw(num_entries))
+        self.mark_dirty(self.stim_count_field.draw(num_stims))
         # Image is now fully prepared, send
-        self.output_array.send_img(self.image)
+        self.send_dirty()
 
-    def check_mouse_inside_target(self, coord):
-        """Checks if mouse is inside target region"""
-        x, y = coord
-        self.mouse_in_target = False
-        if not self.targ_perim.draw or coord == (None, None):
+    def trial_time(self):
+        """Secs since trial start"""
+        return time.perf_counter() - self.start_time
+
+    def timer_values(self):
+        """Secs since trial start, spent in target region, and spent receiving stimulation"""
+        return self.trial_time(), self.in_targ_stopwatch.elapsed(), self.get_stim_stopwatch.elapsed()
+
+    def mark_dirty(self, region):
+        """Marks region (row_start, row_end, col_start, col_end) of image as changed. None (nothing drawn) marks
+        nothing; past MAX_DIRTY_REGIONS regions, the whole image is marked instead"""
+        if region is None:
             return
-        x1, x2, y1, y2 = self.targ_perim.x1, self.targ_perim.x2, self.targ_perim.y1, self.targ_perim.y2
-        if x1 <= x <= x2 and y1 <= y <= y2:
-            self.mouse_in_target = True
+        if len(self.dirty_regions) >= MAX_DIRTY_REGIONS:
+            self.mark_all_dirty()
+        else:
+            self.dirty_regions.append(region)
+
+    def mark_all_dirty(self):
+        """Marks the whole image as changed"""
+        self.dirty_regions = [(0, self.image.shape[0], 0, self.image.shape[1])]
+
+    def send_dirty(self):
+        """Copies only the changed regions of image to the output array"""
+        for r0, r1, c0, c1 in self.dirty_regions:
+            self.output_array[r0:r1, c0:c1] = self.image[r0:r1, c0:c1]
+        self.dirty_regions = []
+
+    def check_mouse_inside_target(self, coord):
+        """Checks which target regions the mouse is inside"""
+        self.mouse_regions = self.targ_perim.membership(coord)
+        self.mouse_in_target = self.mouse_regions != 0
+        self.protocol.update(time.perf_counter(), coord, self.mouse_regions,
+                             self.stim_scheduler.num_pulses, self.stim_scheduler.stim_time)
 
     def send_stim_to_mouse(self):
-        """Stim mouse if inside region"""
-        if self.mouse_stim_timer:
-            elapsed = time.perf_counter() - self.mouse_stim_timer
-            if STIM_ON > elapsed:
-                return
-            elif STIM_ON <= elapsed < STIM_TOTAL:
-                self.mouse_recv_stim = False
-                return
-            elif STIM_TOTAL <= elapsed:
-                if self.mouse_in_target:
-                    self.mouse_recv_stim = True
-                    self.mouse_stim_timer = time.perf_counter()
-                    return
-                elif not self.mouse_in_target:
-                    self.mouse_recv_stim = False
-                    self.mouse_stim_timer = None
-                    return
-        else:
-            if self.mouse_in_target:
-                self.mouse_recv_stim = True
-                self.mouse_stim_timer = time.perf_counter()
+        """Stim mouse while the protocol allows. Pulse timing is owned by the stim scheduler"""
+        self.stim_scheduler.set_gate(self.protocol.gate_open, self.protocol.stim_on, self.protocol.stim_period)
+        self.mouse_recv_stim = self.stim_scheduler.pulse_on
+
+    def write_stim(self, on, manual):
+        """Writes pulses from the stim scheduler to the arduino. Automatic pulses are not sent in manual mode"""
+        if on:
+            self._stim_written = manual or not self.arduino.manual_mode
+        if self._stim_written:
+            self.arduino.write(int(on), wait=True)
 
     def reset_bar(self):
         """Resets to initial conditions"""
@@ -267,7 +281,9 @@ class ProgressBar(object):
         self.get_stim_stopwatch.reset()
         self.mouse_n_entries = 0
         self.mouse_n_stims = 0
-        self.mouse_stim_timer = None
+        self.protocol.reset()
+        if self.stim_scheduler:  # not created when the bar is redrawn offline
+            self.stim_scheduler.set_gate(False)
         # Reset Progress Bar Image
         self.reset_progbar_img()
         # Send Image
@@ -275,6 +291,17 @@ class ProgressBar(object):
 
     def reset_progbar_img(self):
         """Reset progressbar to initial image"""
+        if self._duration not in self._static_layers:
+            self._static_layers[self._duration] = self.draw_static_layer()
+        self.image[:] = self._static_layers[self._duration]
+        for field in self.text_fields:
+            field.forget()
+        self.mark_all_dirty()
+        # add initializing timer text
+        self.set_timer_text(reset=True)
+
+    def draw_static_layer(self):
+        """Draws the parts of the progress bar that do not change during a trial"""
         self.image.fill(0)
         # Add new progress bar at origin
         self.pbar_slice[:, :1, :] = 255
@@ -298,8 +325,7 @@ class ProgressBar(object):
         self.image[80:95, 323:338, 2] = 255
         cv2.putText(self.image, 'Get Stim:', (340, 92), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255))
         cv2.putText(self.image, '(# Stims:', (491, 92), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255))
-        # add initializing timer text
-        self.set_timer_text(reset=True)
+        return self.image.copy()
 
     def can_update(self):
         """Checks we are allowed to proceed"""
@@ -311,8 +337,9 @@ class ProgressBar(object):
     def update(self):
         """Draws next frame of progress bar"""
         # Get elapsed time, get expected location, check mouse location/stim status
-        elapsed = time.perf_counter() - self.start_time
+        elapsed = self.trial_time()
         loc = int((elapsed / self._duration) * self.num_steps)
+        self.mark_dirty((20, 60, max(0, min(loc, self.curr_loc) - 1), max(0, loc + 1)))
         # Check if mouse in target region; also calculate total time inside
         if self.mouse_in_target:
             self.mouse_in_targ_slice[:, loc - 1:loc, :] = 255
@@ -328,8 +355,6 @@ class ProgressBar(object):
             if not self.get_stim_stopwatch.started:
                 self.mouse_n_stims += 1
                 self.get_stim_stopwatch.start()
-                if not self.arduino.manual_mode:
-                    self.arduino.send_signal()
         else:
             if self.get_stim_stopwatch.started:
                 self.get_stim_stopwatch.stop()
@@ -349,30 +374,40 @@ class ProgressBar(object):
         if self.output_array.can_send_img():
             if not self.arduino.connected:
                 self.display_error_img()
-            elif updating:
-                self.set_timer_text(reset=False)
-            elif not updating and self.displaying_error_image:
-                self.displaying_error_image = False
-                self.output_array[:] = self.image
+            else:
+                # Error image overwrote the output array; resend everything
+                if self.displaying_error_image:
+                    self.displaying_error_image = None
+                    self.mark_all_dirty()
+                if updating:
+                    self.set_timer_text(reset=False)
+                else:
+                    self.send_dirty()
             self.output_array.set_can_recv_img()
         if not self.arduino.connected:
             self.arduino.connect()
 
     def display_error_img(self):
-        if not self.displaying_error_image:
-            self.displaying_error_image = True
+        """Until the first search for the arduino completes, we show we are connecting rather than an error"""
+        error = 'ARDUINO ERROR. RECONNECT DEVICE' if self.arduino.searched else 'CONNECTING TO ARDUINO...'
+        if self.displaying_error_image != error:
+            self.displaying_error_image = error
             self.output_array.fill(0)
-            cv2.putText(self.output_array, 'ARDUINO ERROR. RECONNECT DEVICE', (10, 60), cv2.FONT_HERSHEY_SIMPLEX,
-                        1, (255, 255, 255), 2)
+            if self.arduino.searched:
+                cv2.putText(self.output_array, error, (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+            else:
+                cv2.putText(self.output_array, error, (30, 63), cv2.FONT_HERSHEY_SIMPLEX, 1.3, (255, 255, 255), 1)
 
 
 class Heatmap(object):
     """Generates heatmap from coordinates"""
+    # Constants
+    num_rows = 12
+    num_cols = 16
+
     def __init__(self):
         self.mp_array = SyncableMPArray(MAP_DIMS)
         # Constants
-        self.num_rows = 12
-        self.num_cols = 16
         self.row_scale = int(MAP_DIMS[0] / self.num_rows)
         self.col_scale = int(MAP_DIMS[1] / self.num_cols)
         # Main thread vars
@@ -419,18 +454,18 @@ class Heatmap(object):
         # Update Gradient
         return self.bins.min(), self.bins.max()
 
-    # Generate Output from List of Coords
-    def get_heatmap(self, coord_list):
-        """Provided a full list of coords, generate a full size map"""
-        bins = np.zeros((self.num_rows, self.num_cols), dtype='uint32')
-        empty = np.zeros((self.num_rows, self.num_cols), dtype='uint8')
-        row_scale = int(VID_DIM_RGB[0] / self.num_rows)
-        col_scale = int(VID_DIM_RGB[1] / self.num_cols)
-        for col, row in coord_list:
-            if row is not None and col is not None:
-                rowbin = int(row / row_scale)
-                colbin = int(col / col_scale)
-                bins[rowbin, colbin] += 1
+    # Generate Output from Coordinate Columns
+    @classmethod
+    def get_heatmap(cls, xs, ys):
+        """Provided full x and y coordinate columns, generate a full size map"""
+        empty = np.zeros((cls.num_rows, cls.num_cols), dtype='uint8')
+        row_scale = int(VID_DIM_RGB[0] / cls.num_rows)
+        col_scale = int(VID_DIM_RGB[1] / cls.num_cols)
+        tracked = (xs != NO_COORD) & (ys != NO_COORD)
+        rowbins = np.clip(ys[tracked] // row_scale, 0, cls.num_rows - 1)
+        colbins = np.clip(xs[tracked] // col_scale, 0, cls.num_cols - 1)
+        bins = np.bincount(rowbins * cls.num_cols + colbins, minlength=cls.num_rows * cls.num_cols)
+        bins = bins.reshape((cls.num_rows, cls.num_cols)).astype('uint32')
         red = bins.copy()
         green = bins.copy()
         # Create Gradient (black yellow red)
@@ -446,8 +481,8 @@ class Heatmap(object):
         stacked = np.dstack((empty, green, red))
         heatmap = np.kron(stacked, np.ones((row_scale, col_scale, 1), dtype='uint8'))
         # Add bin text
-        for row in range(self.num_rows):
-            for col in range(self.num_cols):
+        for row in range(cls.num_rows):
+            for col in range(cls.num_cols):
                 num = int(bins[row, col])
                 if num < bins.max() / 3:
                     color = (255, 255, 255)
@@ -491,17 +526,15 @@ class Pathing(object):
                 cv2.line(self.output_array, coord, self.last_coord, (0, 255, 0), 1)
             self.last_coord = coord
 
-    # Generate Output from List of Coords
+    # Generate Output from Coordinate Columns
     @staticmethod
-    def get_pathmap(coord_list):
-        """Provided a full list of coords, generate a full size map"""
-        last_path_coord = None
+    def get_pathmap(xs, ys):
+        """Provided full x and y coordinate columns, generate a full size map"""
         pathmap = np.zeros(VID_DIM_RGB, dtype='uint8')
-        for coord in coord_list:
-            if coord != (None, None):
-                if last_path_coord:
-                    cv2.line(pathmap, coord, last_path_coord, (0, 255, 0), 1)
-                last_path_coord = coord
+        tracked = (xs != NO_COORD) & (ys != NO_COORD)
+        points = np.column_stack((xs[tracked], ys[tracked])).astype('int32')
+        if points.shape[0] > 1:
+            cv2.polylines(pathmap, [points], False, (0, 255, 0), 1)
         return pathmap
 
 
@@ -617,35 +650,104 @@ class Gradient(object):
         return output
 
 
+# Saving trial outputs
+def save_coords_csv(save_name, data, metadata):
+    """Save coords to .csv"""
+    targ_region = tuple(metadata['target_region'][element] for element in TARG_REGION_HEADER)
+    num_regions = len(metadata.get('target_regions', ()))
+    write_coords_csv('{}_Coords.csv'.format(save_name), targ_region, data, num_regions)
+
+
+def save_summary(save_name, data, metadata):
+    """Time binned locomotion summary"""
+    untracked = (data['x'] == NO_COORD) | (data['y'] == NO_COORD)
+    summary = LocomotionSummary(bin_width=metadata['summary_bin_width'])
+    rows = summary.compute(data['time'], np.where(untracked, np.nan, data['x']), np.where(untracked, np.nan, data['y']),
+                           data['in_targ'], duration=metadata['duration'])
+    summary.save('{}_Summary.csv'.format(save_name), rows)
+
+
+def save_heatmap(save_name, data):
+    """Generate full size heatmap with gradient"""
+    heatmap = Heatmap.get_heatmap(data['x'], data['y'])
+    heatmap = Gradient.append_gradient(*heatmap)
+    quality = int(cv2.IMWRITE_PNG_COMPRESSION), 0
+    cv2.imwrite(save_name+'_Heatmap.png', heatmap, quality)
+
+
+def save_pathmap(save_name, data):
+    """Generate full size pathing map"""
+    pathmap = Pathing.get_pathmap(data['x'], data['y'])
+    quality = int(cv2.IMWRITE_PNG_COMPRESSION), 0
+    cv2.imwrite(save_name+'_Mouse_Path.png', pathmap, quality)
+
+
+def save_stim_timing(save_name, pulses, metadata):
+    """Save commanded vs actual pulse times and their jitter"""
+    protocol = metadata['stim_protocol']
+    save_stim_log('{}_Stims.csv'.format(save_name), pulses, protocol['stim_on'], protocol['stim_period'])
+    jitter = pulse_jitter(pulses)
+    print('Stimulation Timing: {} Pulses; On Latency {} +/- {} ms; Width Error {} +/- {} ms'.format(
+        jitter[0], jitter[1], jitter[2], jitter[7], jitter[8]))
+
+
+def trial_file_jobs(save_name, data, metadata):
+    """Independent jobs that together write all outputs of a trial's records; each may run on its own thread"""
+    return [lambda: save_coords_csv(save_name, data, metadata),
+            lambda: save_trial_store(save_name, data, metadata),  # columnar copy for fast batch analysis
+            lambda: save_summary(save_name, data, metadata),
+            lambda: save_heatmap(save_name, data),
+            lambda: save_pathmap(save_name, data)]
+
+
+def save_trial_files(save_name, data, metadata):
+    """Writes all outputs of a trial's records: .csv, binary store, locomotion summary, full size maps"""
+    for job in trial_file_jobs(save_name, data, metadata):
+        job()
+
+
 class CoordinateProcessor(StoppableProcess):
     """Processes CV2 Coordinates"""
-    def __init__(self, coords_queue, initial_duration):
+    def __init__(self, coords_queue, initial_duration, summary_bin_width, stim_protocol=None,
+                 arduino_backend=ARDUINO_FIRMATA):
         super(CoordinateProcessor, self).__init__()
         self.connected = True
         self.initialize_experiment = False
         self.name = PROC_COORDS
         self.input_msgs = mp.Queue()
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         self.parent_pipe, self.pipe = mp.Pipe()
-        self.exp_start_event = EXP_START_EVENT
-        # Output deque for coords, coord times, and mouse in region/get stim status
-        self.all_coords = deque()
+        self.exp_start_event = exp_start_event()
+        # Output buffer for coords, coord times, and mouse in region/get stim status
+        self.all_coords = RecordBuffer(COORDS_DTYPE, capacity=0, chunk_size=60 * CAMERA_FRAMERATE, name='trial_records')
         self.coords_saved = True
         self._reset_coords = False
         self._save_name = None
+        self._trial_metadata = None
+        # Write-ahead log of coords; lets us recover a trial if the process dies before saving
+        self.coords_log = None
         # Input source
         self.input_queue = coords_queue
+        # CV2 drawing state and trail, mirrored from the overlay sent with coords when the CV2 video is rendered
+        # offline; logged during trials
+        self.overlay_state = None
+        self.contrail = deque(maxlen=CONTRAIL_LENGTH)
+        self.overlay_log = None
+        self._last_frame_seq = NO_FRAME_SEQ
         # Mapping Objects
         self.heatmap = Heatmap()
         self.pathing = Pathing()
         self.gradient = Gradient()
-        self.progbar = ProgressBar(initial_duration)
+        self.progbar = ProgressBar(initial_duration, stim_protocol, arduino_backend)
+        # Analytics computed at save time
+        self.summary_bin_width = summary_bin_width
 
     # Initializing functions. Call once once new process starts
     def init_unpickleable_objs(self):
         """Initializes objs that must be created in the process it runs in"""
         for obj in (self.heatmap, self.pathing, self.gradient, self.progbar):
             obj.init_unpickleable_objs()
+        self.finaliser = TrialFinaliser(on_finished=self.trial_saved)
         self.setup_msg_parser()
 
     def setup_msg_parser(self):
@@ -658,8 +760,9 @@ class CoordinateProcessor(StoppableProcess):
             CMD_CLR_MAPS: lambda val: self.reset_maps(),
             CMD_TARG_DRAW: lambda params: self.progbar.targ_perim.toggle_draw(params),
             CMD_TARG_RADIUS: lambda radius: self.progbar.targ_perim.update_radius(radius),
+            CMD_TARG_REGIONS: lambda regions: self.progbar.targ_perim.set_extra_regions(regions),
             CMD_TOGGLE_MANUAL_TRIGGER: lambda val: self.progbar.arduino.toggle_manual(),
-            CMD_SEND_STIMULUS: lambda val: self.progbar.arduino.send_signal()
+            CMD_SEND_STIMULUS: lambda val: self.progbar.stim_scheduler.manual_pulse()
         }
 
     # Message read/write/process functions. CALL IN CHILD THREADS
@@ -695,12 +798,22 @@ class CoordinateProcessor(StoppableProcess):
         """Resets heatmap, pathing map, gradient"""
         for obj in (self.heatmap, self.pathing, self.gradient):
             obj.reset()
+        # Rendered offline, maps are cleared from the next frame on
+        overlay_log = self.overlay_log
+        if overlay_log is not None:
+            overlay_log.add_event(self._last_frame_seq + 1, {'clear_maps': True})
 
     def setup_experiment(self):
         """Setup maps/progbar/data containers for next experiment trial"""
-        # Reset Coordinate deque
-        self.all_coords.clear()
+        # Reset Coordinate buffer; preallocate enough records for the whole trial
+        # Records beyond twice that are dropped, bounding memory if coordinates arrive faster than expected
+        capacity = (self.progbar._duration + BUFFER_MARGIN_SECS) * CAMERA_FRAMERATE
+        self.all_coords.reset(capacity=capacity, max_capacity=2 * capacity)
         self.coords_saved = False
+        # Start logging records to disk as they arrive
+        self._trial_metadata = self.get_trial_metadata()
+        self.coords_log = CoordsLogWriter(self._save_name + LOG_ENDING, COORDS_DTYPE, self._trial_metadata)
+        self.coords_log.start()
         # Reset pathing/heatmap/gradient
         self.reset_maps()
         # Reset Progressbar
@@ -709,6 +822,8 @@ class CoordinateProcessor(StoppableProcess):
         self.pipe.send(MSG_RECEIVED)
         self.exp_start_event.wait()
         self.progbar.start_time = time.perf_counter()
+        self.progbar.stim_scheduler.start_trial(self.progbar.start_time)
+        self.progbar.arduino.pop_latencies()  # discard I/O from between trials
 
     def run(self):
         """Call using start(); spawns new process"""
@@ -724,11 +839,15 @@ class CoordinateProcessor(StoppableProcess):
             self.process_coords()
             if self.stopped():
                 self.connected = False
+                self.progbar.stim_scheduler.close()
                 self.progbar.arduino.exit()
+                if self.coords_log:
+                    self.coords_log.close()
+                self.finaliser.shutdown()
                 while True:
                     time.sleep(5.0 / 1000.0)
                     threads = [thread.name for thread in thr.enumerate()]
-                    if POLLING not in threads and SEND_SIGNAL not in threads:
+                    if POLLING not in threads and STIM_SCHEDULER not in threads and COORDS_LOG not in threads:
                         break
         print('Exiting Coordinate Processor...')
 
@@ -736,11 +855,13 @@ class CoordinateProcessor(StoppableProcess):
         """Processes coordinates into heatmap and pathing map"""
         # Get coords, update all maps, send if able to
         try:
-            coord = self.input_queue.get_nowait()
+            coord, frame_seq, _, overlay = self.input_queue.get_nowait()
         except Queue.Empty:
             coord = None
             time.sleep(1.0 / 1000.0)
         else:
+            if overlay is not None:
+                self.update_overlay(coord, frame_seq, *overlay)
             # Check if mouse is inside target region
             self.progbar.check_mouse_inside_target(coord)
             # Update maps
@@ -765,7 +886,26 @@ class CoordinateProcessor(StoppableProcess):
             self.progbar.send_stim_to_mouse()
             self.progbar.update()
             if coord:
-                self.append_coords(coord)
+                self.append_coords(coord, frame_seq)
+
+    def update_overlay(self, coord, frame_seq, contour, changes):
+        """Mirrors the CV2 process' drawing state and trail. While the trial runs, each state change and mouse
+        contour is logged, starting from the state and trail the trial started with"""
+        recording = self.progbar.can_update()
+        if recording and self.overlay_log is None:
+            self.overlay_log = OverlayLog(self.overlay_state, self.contrail)
+        if changes is not None:
+            # A new background clears the trail
+            if self.overlay_state is None or changes['background'] != self.overlay_state['background']:
+                self.contrail.clear()
+            self.overlay_state = changes
+            if recording:
+                self.overlay_log.add_event(frame_seq, changes)
+        if coord != (None, None):
+            self.contrail.appendleft(coord)
+        if recording and contour is not None:
+            self.overlay_log.add_contour(frame_seq, contour)
+        self._last_frame_seq = frame_seq
 
     def set_ttl_time(self, ttl_time):
         """Reformats progress bar with new duration"""
@@ -773,65 +913,57 @@ class CoordinateProcessor(StoppableProcess):
         self.progbar.reset_bar()
 
     # Save coords and output to file at end of trial
-    def append_coords(self, coord):
-        """Add coords to deque, along with timing/mouse statuses"""
-        time_elapsed = round(time.perf_counter()-self.progbar.start_time, 3)
-        targ_elapsed = round(self.progbar.in_targ_stopwatch.elapsed(), 3)
-        stim_elapsed = round(self.progbar.get_stim_stopwatch.elapsed(), 3)
-        in_targ = self.progbar.mouse_in_target
-        get_stim = self.progbar.mouse_recv_stim
-        num_entries = self.progbar.mouse_n_entries
-        num_stims = self.progbar.mouse_n_stims
-        append = (time_elapsed, *coord,
-                  in_targ, num_entries, targ_elapsed,
-                  get_stim, num_stims, stim_elapsed)
-        self.all_coords.append(append)
+    def append_coords(self, coord, frame_seq=NO_FRAME_SEQ):
+        """Add coords to trial buffer, along with timing/mouse statuses and the camera frame they came from"""
+        progbar = self.progbar
+        x, y = (NO_COORD, NO_COORD) if coord == (None, None) else coord
+        record = (time.perf_counter() - progbar.start_time, x, y,
+                  progbar.mouse_in_target, progbar.mouse_n_entries, progbar.in_targ_stopwatch.elapsed(),
+                  progbar.mouse_recv_stim, progbar.mouse_n_stims, progbar.get_stim_stopwatch.elapsed(),
+                  progbar.mouse_regions, frame_seq)
+        if self.all_coords.append(*record):
+            self.coords_log.append(record)
 
     def save_coords(self):
-        """saves coords to file"""
+        """Hands a snapshot of the trial to the finaliser, which saves all outputs in the background"""
         # Inform proc handler we are starting to save
-        msg = NewMessage(dev=self.name, cmd=MSG_VIDREC_SAVING)
+        msg = NewMessage(dev=self.name, cmd=MSG_VIDREC_SAVING, val=self._save_name)
+        self.output_msgs.put_nowait(msg)
+        msg = NewMessage(dev=self.name, cmd=MSG_BUFFER_STATS, val=(self._save_name, [self.all_coords.stats()]))
         self.output_msgs.put_nowait(msg)
-        # Save coords to .csv
-        file = '{}_Coords.csv'.format(self._save_name)
-        with open(file, 'w') as f:
-            # target region information
-            for element in ('Target Region X', 'Target Region Y', 'Target Region Radius',
-                            'Normalized X', 'Normalized Y'):
-                f.write('{},'.format(element))
-            f.write('\n')
-            for element in (self.progbar.targ_perim.cx, self.progbar.targ_perim.cy, self.progbar.targ_perim.radius,
-                            self.progbar.targ_perim.norm_x, self.progbar.targ_perim.norm_y):
-                f.write('{},'.format(element))
-            f.write('\n')
-            # coords data
-            for element in ('Total Time Elapsed (s)', 'Mouse X', 'Mouse Y',
-                            'Mouse In Target', 'Num Entries', 'Time in Target (s)', 'Total Time in Target (s)',
-                            'Mouse Get Stim', 'Num Stimulations', 'Total Stim Time (s)'):
-                f.write('{},'.format(element))
-            f.write('\n')
-            last_entry_time = 0
-            last_stored_time = 0
-            last_num_entries = 0
-            for line in self.all_coords:
-                for index, element in enumerate(line):
-                    f.write('{},'.format(element))
-                    if index == 4:
-                        if element != last_num_entries:
-                            last_num_entries = element
-                            last_entry_time = last_stored_time
-                        f.write('{},'.format(line[5]-last_entry_time))
-                        last_stored_time = line[5]
-                f.write('\n')
-        # Generate full size heatmap and pathing map
-        coords = [(line[1], line[2]) for line in self.all_coords]
-        pathmap = self.pathing.get_pathmap(coord_list=coords)
-        heatmap = self.heatmap.get_heatmap(coord_list=coords)
-        heatmap = self.gradient.append_gradient(*heatmap)
-        quality = int(cv2.IMWRITE_PNG_COMPRESSION), 0
-        cv2.imwrite(self._save_name+'_Heatmap.png', heatmap, quality)
-        cv2.imwrite(self._save_name+'_Mouse_Path.png', pathmap, quality)
+        # Snapshot; the trial buffer and log are reused by the next trial
+        data = self.all_coords.data.copy()
+        coords_log, self.coords_log = self.coords_log, None
+        jobs = trial_file_jobs(self._save_name, data, self._trial_metadata)
+        pulses = self.progbar.stim_scheduler.pop_log()
+        latencies = self.progbar.arduino.pop_latencies()
+        jobs.append(lambda save_name=self._save_name, metadata=self._trial_metadata:
+                    save_stim_timing(save_name, pulses, metadata))
+        jobs.append(lambda save_name=self._save_name, start_time=self.progbar.start_time:
+                    save_io_latencies('{}_ArduinoIO.csv'.format(save_name), latencies, start_time))
+        overlay_log, self.overlay_log = self.overlay_log, None
+        if overlay_log is not None:
+            jobs.append(lambda save_name=self._save_name: overlay_log.save(save_name + OVERLAY_ENDING))
+        # Finish the log so it is complete on disk until outputs are written
+        jobs.append(coords_log.close)
+        self.finaliser.submit(self._save_name, jobs)
+
+    def trial_saved(self, save_name, errors):
+        """Called from finaliser thread once all outputs of a trial are written"""
+        # Outputs are safely written; log no longer needed. Keep it if anything failed so we can recover
+        if not errors:
+            os.remove(save_name + LOG_ENDING)
         # Inform proc handler we finished saving
-        msg = NewMessage(dev=self.name, cmd=MSG_VIDREC_FINISHED)
+        msg = NewMessage(dev=self.name, cmd=MSG_VIDREC_FINISHED, val=save_name)
         self.output_msgs.put_nowait(msg)
         print('Finished Saving Coordinates to File...')
+
+    def get_trial_metadata(self):
+        """Trial parameters saved alongside the records"""
+        targ_perim = self.progbar.targ_perim
+        targ_region = targ_perim.cx, targ_perim.cy, targ_perim.radius, targ_perim.norm_x, targ_perim.norm_y
+        return {'trial': self._save_name, 'duration': self.progbar._duration, 'framerate': CAMERA_FRAMERATE,
+                'no_coord': NO_COORD, 'summary_bin_width': self.summary_bin_width,
+                'target_region': dict(zip(TARG_REGION_HEADER, targ_region)),
+                'target_regions': targ_perim.regions(),
+                'stim_protocol': self.progbar.protocol.params}
@@ -0,0 +1,268 @@
+# coding=utf-8
+
+"""Video encoder backends for VideoRecorder, and a benchmark comparing them on a sample clip
+
+Usage: python -m Concurrency.Encoders SAMPLE_CLIP [--encoders xvid mjpg ffv1 raw npy] [--frames N] [--gray]"""
+
+import os
+import cv2
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+
+# Encoder names, as selected per recorder in settings
+ENCODER_XVID = 'xvid'
+ENCODER_MJPG = 'mjpg'
+ENCODER_FFV1 = 'ffv1'
+ENCODER_RAW = 'raw'
+ENCODER_NPY = 'npy'
+# Used for lossless encoders not supported by the local OpenCV
+LOSSLESS_FALLBACK = ENCODER_RAW
+BENCHMARK_HEADER = ('Encoder', 'Frames', 'Encode FPS', 'CPU (%)', 'Bytes/Frame', 'Lossless')
+
+
+class Encoder(object):
+    """Writes frames of frame_size (cols, rows) to file_base + EXTENSION. num_frames: frames expected, if known.
+    TRANSCODE: output is meant to be compressed offline once the trial is over (see Concurrency.Transcoder)"""
+    EXTENSION = ''
+    LOSSLESS = False
+    TRANSCODE = False
+
+    def __init__(self, file_base, frame_size, fps, is_color, num_frames=None):
+        self.file_name = file_base + self.EXTENSION
+        self.frame_size = frame_size
+        self.fps = fps
+        self.is_color = is_color
+
+    def write(self, img, timestamp=None):
+        """timestamp: capture time of img (secs since trial start); only kept by some encoders
+        Returns True if img was written, False if it was dropped"""
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+
+class FourccEncoder(Encoder):
+    """Encodes with a cv2.VideoWriter codec"""
+    FOURCC = ''
+    EXTENSION = '.avi'
+
+    def __init__(self, file_base, frame_size, fps, is_color, num_frames=None):
+        super(FourccEncoder, self).__init__(file_base, frame_size, fps, is_color)
+        self.writer = cv2.VideoWriter(self.file_name, cv2.VideoWriter_fourcc(*self.FOURCC), fps, frame_size, is_color)
+
+    def write(self, img, timestamp=None):
+        self.writer.write(img)
+        return True
+
+    def release(self):
+        self.writer.release()
+
+    @classmethod
+    def available(cls):
+        """Whether the local OpenCV can write this codec"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            writer = cv2.VideoWriter(os.path.join(temp_dir, 'test' + cls.EXTENSION),
+                                     cv2.VideoWriter_fourcc(*cls.FOURCC), 15, (16, 16), False)
+            opened = writer.isOpened()
+            writer.release()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return opened
+
+
+class XvidEncoder(FourccEncoder):
+    """MPEG-4; small files, lossy"""
+    FOURCC = 'XVID'
+
+
+class MjpgEncoder(FourccEncoder):
+    """Motion JPEG; each frame compressed independently, cheap to encode, lossy"""
+    FOURCC = 'MJPG'
+
+
+class Ffv1Encoder(FourccEncoder):
+    """FFmpeg's lossless intra-frame codec"""
+    FOURCC = 'FFV1'
+    LOSSLESS = True
+
+
+class RawEncoder(Encoder):
+    """Unencoded frames appended to a .raw file; shape, dtype and fps are written to a .json alongside when released.
+    Read back with read_raw()"""
+    EXTENSION = '.raw'
+    LOSSLESS = True
+
+    def __init__(self, file_base, frame_size, fps, is_color, num_frames=None):
+        super(RawEncoder, self).__init__(file_base, frame_size, fps, is_color)
+        self.file = open(self.file_name, 'wb')
+        self.num_frames = 0
+        self.dtype = None
+
+    def write(self, img, timestamp=None):
+        img = np.ascontiguousarray(img)
+        self.dtype = img.dtype
+        self.file.write(img.data)
+        self.num_frames += 1
+        return True
+
+    def release(self):
+        self.file.close()
+        cols, rows = self.frame_size
+        shape = (self.num_frames, rows, cols, 3) if self.is_color else (self.num_frames, rows, cols)
+        with open(self.file_name + '.json', 'w') as f:
+            json.dump({'shape': shape, 'dtype': np.dtype(self.dtype or 'uint8').str, 'fps': self.fps}, f)
+
+    @classmethod
+    def available(cls):
+        return True
+
+
+class NpyEncoder(Encoder):
+    """No encoding: uint8 frames are copied into a preallocated memory mapped .npy of num_frames frames, and their
+    timestamps saved to a _Timestamps.npy alongside. Frames past num_frames are dropped. A .json alongside records
+    fps and the number of frames written; unwritten frames at the end of the .npy are blank"""
+    EXTENSION = '.npy'
+    LOSSLESS = True
+    TRANSCODE = True
+
+    def __init__(self, file_base, frame_size, fps, is_color, num_frames=None):
+        super(NpyEncoder, self).__init__(file_base, frame_size, fps, is_color)
+        if not num_frames:
+            raise ValueError('Encoder [{}] needs the number of frames to record'.format(ENCODER_NPY))
+        cols, rows = frame_size
+        shape = (num_frames, rows, cols, 3) if is_color else (num_frames, rows, cols)
+        self.frames = np.lib.format.open_memmap(self.file_name, mode='w+', dtype='uint8', shape=shape)
+        self.timestamps = np.full(num_frames, np.nan)
+        self.timestamps_file = file_base + '_Timestamps.npy'
+        self.num_frames = 0
+        self.drops = 0
+
+    def write(self, img, timestamp=None):
+        if self.num_frames >= self.frames.shape[0]:
+            self.drops += 1
+            return False
+        self.frames[self.num_frames] = img
+        self.timestamps[self.num_frames] = np.nan if timestamp is None else timestamp
+        self.num_frames += 1
+        return True
+
+    def release(self):
+        self.frames.flush()
+        del self.frames
+        np.save(self.timestamps_file, self.timestamps[:self.num_frames])
+        with open(self.file_name + '.json', 'w') as f:
+            json.dump({'fps': self.fps, 'num_frames': self.num_frames, 'dropped': self.drops,
+                       'timestamps': os.path.basename(self.timestamps_file)}, f)
+
+    @classmethod
+    def available(cls):
+        return True
+
+
+ENCODERS = {
+    ENCODER_XVID: XvidEncoder,
+    ENCODER_MJPG: MjpgEncoder,
+    ENCODER_FFV1: Ffv1Encoder,
+    ENCODER_RAW: RawEncoder,
+    ENCODER_NPY: NpyEncoder
+}
+_AVAILABLE = {}
+
+
+def encoder_available(name):
+    """Whether encoder name can be used here; checked once per process"""
+    if name not in _AVAILABLE:
+        _AVAILABLE[name] = name in ENCODERS and ENCODERS[name].available()
+    return _AVAILABLE[name]
+
+
+def resolve_encoder(name):
+    """Name of the encoder that will write for encoder name. A lossless encoder the local OpenCV cannot write falls
+    back to LOSSLESS_FALLBACK"""
+    if name not in ENCODERS:
+        raise ValueError('[{}] is not a valid encoder! Choose from: {}'.format(name, sorted(ENCODERS)))
+    if not encoder_available(name):
+        if not ENCODERS[name].LOSSLESS:
+            raise ValueError('Encoder [{}] is not supported by the local OpenCV'.format(name))
+        print('Encoder [{}] is not supported by the local OpenCV; using [{}]'.format(name, LOSSLESS_FALLBACK))
+        name = LOSSLESS_FALLBACK
+    return name
+
+
+def create_encoder(name, file_base, frame_size, fps, is_color, num_frames=None):
+    """Encoder by name, or its fallback; see resolve_encoder()"""
+    return ENCODERS[resolve_encoder(name)](file_base, frame_size, fps, is_color, num_frames)
+
+
+def read_raw(file_name):
+    """Memory mapped frames of a RawEncoder .raw file"""
+    with open(file_name + '.json', 'r') as f:
+        info = json.load(f)
+    return np.memmap(file_name, dtype=info['dtype'], mode='r', shape=tuple(info['shape']))
+
+
+# Benchmark
+def load_clip(file_name, num_frames, is_color):
+    """Up to num_frames frames of a video file, decoded into memory so decoding is not timed"""
+    capture = cv2.VideoCapture(file_name)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    frames = []
+    while len(frames) < num_frames:
+        got, frame = capture.read()
+        if not got:
+            break
+        frames.append(frame if is_color else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    capture.release()
+    return frames, fps
+
+
+def benchmark_encoder(name, frames, fps, is_color, temp_dir):
+    """Encodes frames; returns a row for BENCHMARK_HEADER"""
+    frame_size = frames[0].shape[1], frames[0].shape[0]
+    encoder = create_encoder(name, os.path.join(temp_dir, name), frame_size, fps, is_color, num_frames=len(frames))
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for frame in frames:
+        encoder.write(frame)
+    encoder.release()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    num_bytes = os.path.getsize(encoder.file_name)
+    # CPU is the share of one core used while encoding; multithreaded codecs can exceed 100%
+    return (name, len(frames), round(len(frames) / wall, 1), round(100 * cpu / wall, 1),
+            int(num_bytes / len(frames)), encoder.LOSSLESS)
+
+
+def benchmark(file_name, encoders, num_frames, is_color):
+    frames, fps = load_clip(file_name, num_frames, is_color)
+    if not frames:
+        print('Could not read frames from: {}'.format(file_name))
+        return
+    rows = [BENCHMARK_HEADER]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name in encoders:
+            if not encoder_available(name):
+                print('Skipping [{}]: not supported by the local OpenCV'.format(name))
+                continue
+            rows.append(benchmark_encoder(name, frames, fps, is_color, temp_dir))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(BENCHMARK_HEADER))]
+    for row in rows:
+        print('  '.join(str(element).rjust(width) for element, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare encode fps, CPU and size of video encoders on a clip')
+    parser.add_argument('clip', help='sample video file')
+    parser.add_argument('--encoders', nargs='+', default=sorted(ENCODERS), choices=sorted(ENCODERS))
+    parser.add_argument('--frames', type=int, default=300, help='max frames of the clip to encode')
+    parser.add_argument('--gray', action='store_true', help='encode grayscale frames, as the camera recorder does')
+    args = parser.parse_args()
+    benchmark(args.clip, args.encoders, args.frames, not args.gray)
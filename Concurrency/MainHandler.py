@@ -2,12 +2,19 @@
 
 """Main Process Handler managing communication from GUI to all child processes"""
 
+import os
 import cv2
 import sys
 import time
+import numpy as np
+import threading as thr
 import multiprocessing as mp
-from Misc.GlobalVars import *
+from Misc.CoreVars import *
+from Misc.IPC import proc_handler_queue, exp_start_event, master_dump_queue
 from Misc.CustomClasses import *
+from DirsSettings.TrialData import FRAME_RECORD_ENDING, FRAMES_ENDING, RAW_VIDEO_ENDING, CV2_VIDEO_ENDING, \
+    coord_rows, write_frames_csv
+from DirsSettings.TrialStore import TrialStore, STORE_SUFFIX
 if sys.version[0] == '2':
     import Queue as Queue
 else:
@@ -16,13 +23,15 @@ else:
 
 class ProcessHandler(StoppableProcess):
     """Main handler class with communication protocols to child processes"""
-    def __init__(self, cmr_msgs, cv2_msgs, coords_msgs, cv2_vidrec_msgs, cmr_vidrec_msgs, *msg_rcvd_pipes):
+    def __init__(self, cmr_msgs, cv2_msgs, coords_msgs, cv2_vidrec_msgs, cmr_vidrec_msgs, compositor_msgs,
+                 *msg_rcvd_pipes):
         super(ProcessHandler, self).__init__()
-        self.input_msgs = PROC_HANDLER_QUEUE
-        self.exp_start_event = EXP_START_EVENT
+        self.input_msgs = proc_handler_queue()
+        self.exp_start_event = exp_start_event()
         self.msg_rcvd_pipes = msg_rcvd_pipes
-        self.vidrec_saving_list = []
-        self.vidrec_finished_list = []
+        # {trial name: devices that reported}; tracked per trial so trials can overlap while saving
+        self.vidrec_saving_list = {}
+        self.vidrec_finished_list = {}
         self.cv2_bg_w_boundary, self.cv2_bg_original = None, None
         self.queue_selector = {
             PROC_CMR: cmr_msgs,
@@ -30,7 +39,8 @@ class ProcessHandler(StoppableProcess):
             PROC_COORDS: coords_msgs,
             PROC_CV2_VIDREC: cv2_vidrec_msgs,
             PROC_CMR_VIDREC: cmr_vidrec_msgs,
-            PROC_GUI: MASTER_DUMP_QUEUE
+            PROC_COMPOSITOR: compositor_msgs,
+            PROC_GUI: master_dump_queue()
         }
 
     def setup_msg_parser(self):
@@ -51,6 +61,8 @@ class ProcessHandler(StoppableProcess):
                                                                     cmd=CMD_TARG_DRAW, val=targ_area),
             CMD_TARG_RADIUS: lambda dev, radius: self.send_message(targets=(PROC_CV2, PROC_COORDS),
                                                                    cmd=CMD_TARG_RADIUS, val=radius),
+            CMD_TARG_REGIONS: lambda dev, regions: self.send_message(targets=(PROC_CV2, PROC_COORDS),
+                                                                     cmd=CMD_TARG_REGIONS, val=regions),
             # Messages bound for Camera Process
             CMD_SET_VIDSRC: lambda dev, fname: self.send_message(targets=(PROC_CMR,), cmd=CMD_SET_VIDSRC, val=fname),
             # Messages bound for Coords Process
@@ -59,10 +71,14 @@ class ProcessHandler(StoppableProcess):
                                                                       cmd=CMD_TOGGLE_MANUAL_TRIGGER),
             CMD_SEND_STIMULUS: lambda d, v: self.send_message(targets=(PROC_COORDS,), cmd=CMD_SEND_STIMULUS),
             # Messages bound for GUI
-            MSG_VIDREC_SAVING: lambda proc_origin, val: self.vidrec_saving(saving=True, proc_origin=proc_origin),
-            MSG_VIDREC_FINISHED: lambda proc_origin, val: self.vidrec_saving(saving=False, proc_origin=proc_origin),
+            MSG_VIDREC_SAVING: lambda proc_origin, trial: self.vidrec_saving(saving=True, proc_origin=proc_origin,
+                                                                             trial=trial),
+            MSG_VIDREC_FINISHED: lambda proc_origin, trial: self.vidrec_saving(saving=False, proc_origin=proc_origin,
+                                                                               trial=trial),
+            MSG_TRANSCODE: lambda dev, file: self.send_message(targets=(PROC_GUI,), cmd=MSG_TRANSCODE, val=file),
             # Messages intended for Proc Handler
             CMD_NEW_BACKGROUND: lambda dev, new_backgrounds: self.save_backgrounds(new_backgrounds),
+            MSG_BUFFER_STATS: lambda dev, trial_stats: self.save_buffer_stats(dev, *trial_stats),
         }
 
     def process_message(self, msg):
@@ -91,7 +107,7 @@ class ProcessHandler(StoppableProcess):
     def close_children(self):
         """Close all child processes before exiting"""
         self.send_message(targets=(PROC_CMR, PROC_CV2, PROC_COORDS,
-                                   PROC_CV2_VIDREC, PROC_CMR_VIDREC),
+                                   PROC_CV2_VIDREC, PROC_CMR_VIDREC, PROC_COMPOSITOR),
                           cmd=CMD_EXIT)
         self.stop()
 
@@ -107,6 +123,8 @@ class ProcessHandler(StoppableProcess):
             self.send_message(targets=(PROC_COORDS, PROC_CV2_VIDREC, PROC_CMR_VIDREC),
                               cmd=CMD_START,
                               val=trial_params)
+            # Buffer counters of continuously running processes start counting for this trial
+            self.send_message(targets=(PROC_CMR, PROC_CV2), cmd=CMD_REPORT_BUFFER_STATS, val=None)
             for pipe in self.msg_rcvd_pipes:
                 pipe.recv()
             # don't allow any process to proceed unless all processes have confirmed receipt of message
@@ -123,20 +141,55 @@ class ProcessHandler(StoppableProcess):
         """Saves backgrounds from cv2_proc for output into file"""
         self.cv2_bg_w_boundary, self.cv2_bg_original = new_backgrounds
 
-    def vidrec_saving(self, saving, proc_origin):
-        """collects all CMD_VIDREC_SAVING and CMD_VIDREC_SAVED signals, then sends a single signal
-        to GUI when all signals are collected"""
-        if saving:
-            self.vidrec_saving_list.append(proc_origin)
-            if PROC_CV2_VIDREC in self.vidrec_saving_list\
-                    and PROC_CMR_VIDREC in self.vidrec_saving_list\
-                    and PROC_COORDS in self.vidrec_saving_list:
-                self.vidrec_saving_list = []
-                self.send_message(targets=(PROC_GUI,), cmd=MSG_VIDREC_SAVING)
-        elif not saving:
-            self.vidrec_finished_list.append(proc_origin)
-            if PROC_CV2_VIDREC in self.vidrec_finished_list\
-                    and PROC_CMR_VIDREC in self.vidrec_finished_list\
-                    and PROC_COORDS in self.vidrec_finished_list:
-                self.vidrec_finished_list = []
-                self.send_message(targets=(PROC_GUI,), cmd=MSG_VIDREC_FINISHED)
+    def vidrec_saving(self, saving, proc_origin, trial):
+        """collects all CMD_VIDREC_SAVING and CMD_VIDREC_SAVED signals of a trial, then sends a single signal
+        to GUI when all signals are collected. Once all devices are saving, GUI may start the next trial;
+        the trial's files are then finished in the background, and reported when all are written"""
+        devices = (PROC_CV2_VIDREC, PROC_CMR_VIDREC, PROC_COORDS)
+        reported = self.vidrec_saving_list if saving else self.vidrec_finished_list
+        reported.setdefault(trial, set()).add(proc_origin)
+        if all(device in reported[trial] for device in devices):
+            del reported[trial]
+            if saving:
+                self.send_message(targets=(PROC_CMR, PROC_CV2), cmd=CMD_REPORT_BUFFER_STATS, val=trial)
+                self.send_message(targets=(PROC_GUI,), cmd=MSG_VIDREC_SAVING, val=trial)
+            else:
+                # Sidecars are loaded and rewritten whole; done off the message loop
+                thr.Thread(target=self.finish_trial, args=(trial,), name='link_frames', daemon=True).start()
+
+    def finish_trial(self, trial):
+        """Run on separate thread. Links the trial's frame records, then tells the GUI the trial is saved"""
+        try:
+            self.link_frames(trial)
+        except (IOError, OSError, ValueError) as error:
+            print('Unable to link frames of {}: {}'.format(trial, error))
+        self.send_message(targets=(PROC_GUI,), cmd=MSG_VIDREC_FINISHED, val=trial)
+
+    @staticmethod
+    def link_frames(trial):
+        """Writes each video's frame records with the coordinate record of each frame, as [video]_Frames.csv"""
+        coord_frames = []
+        if os.path.isdir(trial + STORE_SUFFIX):
+            store = TrialStore(trial)
+            if 'frame' in store:
+                coord_frames = store['frame']
+        for ending in (RAW_VIDEO_ENDING, CV2_VIDEO_ENDING):
+            frames_file = trial + ending + FRAME_RECORD_ENDING
+            if not os.path.isfile(frames_file):
+                continue
+            frames = np.load(frames_file)
+            write_frames_csv(frames_file[:-len(FRAME_RECORD_ENDING)] + FRAMES_ENDING, frames,
+                             coord_rows(frames['frame'], coord_frames))
+            os.remove(frames_file)
+
+    @staticmethod
+    def save_buffer_stats(device, trial, stats):
+        """Adds the buffer counters of a process to the trial's _BufferStats.csv"""
+        file = '{}_BufferStats.csv'.format(trial)
+        new_file = not os.path.isfile(file)
+        with open(file, 'a') as f:
+            lines = [BUFFER_STATS_HEADER] if new_file else []
+            lines.extend((device,) + tuple(stat) for stat in stats)
+            for line in lines:
+                f.write(''.join('{},'.format(element) for element in line))
+                f.write('\n')
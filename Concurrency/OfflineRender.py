@@ -0,0 +1,336 @@
+# coding=utf-8
+
+"""Renders a trial's CV2 video after the trial, from its raw video, coordinates and overlay events, instead of
+encoding the composite live. Each trial is split into time segments rendered in parallel by a pool of processes
+
+Usage: python -m Concurrency.OfflineRender [TRIAL or DIRECTORY] ... [--encoder xvid] [--workers N]
+Directories are searched recursively for trials with an overlay log ([trial]_Overlay.npz)"""
+
+import os
+import cv2
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import multiprocessing as mp
+from collections import deque
+from Misc.CoreVars import *
+from Concurrency.Encoders import create_encoder, resolve_encoder, read_raw, ENCODERS, ENCODER_XVID, ENCODER_NPY, \
+    ENCODER_RAW
+from Concurrency.Transcoder import read_npy_recording
+from Concurrency.VideoDecoder import PrefetchingDecoder
+from Concurrency.SegmentedEncoding import concat_segments, SEGMENT_SECS, SEGMENT_INDEX_ENDING
+from Concurrency.Compositor import COMPOSITE_DIMS, PANEL_SLICES, PANEL_CV2GUI, PANEL_PATHING, PANEL_HEATMAP, \
+    PANEL_GRADIENT, PANEL_PROGBAR
+from Concurrency.CV2Proc import crop_to_bounds, draw_tracking, draw_contrails, CONTRAIL_LENGTH
+from Concurrency.CoordsProc import ProgressBar, Heatmap, Pathing, Gradient
+from DirsSettings.TrialData import FRAMES_ENDING, RAW_VIDEO_ENDING, CV2_VIDEO_ENDING, NO_COORD, read_frames_csv
+from DirsSettings.TrialStore import TrialStore
+from DirsSettings.OverlayLog import OVERLAY_ENDING, read_overlay_log
+
+
+# Pool leaves a core free for other work
+DEFAULT_RENDER_WORKERS = max(1, mp.cpu_count() - 1)
+
+
+def video_files(file_base):
+    """(file, first frame, num frames) of each file of the video recorded as file_base, whichever encoder wrote
+    it; several if it was encoded in segments. num frames is None if unknown"""
+    for extension in ('.npy', '.raw', '.avi'):
+        if os.path.isfile(file_base + extension):
+            return [(file_base + extension, 0, None)]
+    if os.path.isfile(file_base + SEGMENT_INDEX_ENDING):
+        with open(file_base + SEGMENT_INDEX_ENDING, 'r') as f:
+            index = json.load(f)
+        directory = os.path.dirname(os.path.abspath(file_base))
+        return [(os.path.join(directory, segment['file']), segment['first_frame'], segment['num_frames'])
+                for segment in index['segments']]
+    raise IOError('No video recorded as: {}'.format(file_base))
+
+
+def read_video_file(file, start):
+    """Yields grayscale frames of a video file from frame start on"""
+    if file.endswith('.npy'):
+        frames = read_npy_recording(file)[0]
+    elif file.endswith('.raw'):
+        frames = read_raw(file)
+    else:
+        # Decoded frames are always BGR
+        decoder = PrefetchingDecoder(file, start, convert=lambda frame: frame[..., 0])
+        try:
+            for frame in decoder:
+                yield frame
+        finally:
+            decoder.close()
+        return
+    for frame in frames[start:]:
+        yield frame
+
+
+def read_video(file_base, first_frame, num_frames):
+    """Yields num_frames grayscale frames of the video recorded as file_base, from first_frame on"""
+    remaining = num_frames
+    for file, file_first, file_frames in video_files(file_base):
+        if file_frames is not None and file_first + file_frames <= first_frame:
+            continue
+        for frame in read_video_file(file, max(0, first_frame - file_first)):
+            if not remaining:
+                return
+            yield frame
+            remaining -= 1
+
+
+class OfflineProgressBar(ProgressBar):
+    """Progress bar redrawn from a trial's records rather than the clock, stopwatches and arduino"""
+    def __init__(self, duration, stim_protocol=None):
+        super(OfflineProgressBar, self).__init__(duration, stim_protocol)
+        self.record = None
+        self._trial_time = 0.0
+
+    def init_unpickleable_objs(self):
+        self.init_image()
+        self.set_start()
+
+    def trial_time(self):
+        return self._trial_time
+
+    def timer_values(self):
+        if self.record is None:
+            return self._trial_time, 0.0, 0.0
+        return self._trial_time, float(self.record['targ_time']), float(self.record['stim_time'])
+
+    def ping_arduino(self, updating):
+        """No arduino offline; draws the counters and timers of the current record"""
+        if self.record is not None:
+            self.mouse_n_entries, self.mouse_n_stims = int(self.record['num_entries']), int(self.record['num_stims'])
+        self.set_timer_text(reset=False)
+
+    def replay(self, record):
+        """Updates the bar up to the time of record. Live, the bar is updated continuously between records, so it is
+        first updated once for each position passed since the last record, with the last record's mouse status"""
+        step = self._duration / self.num_steps
+        for loc in range(self.curr_loc + 1, int((record['time'] / self._duration) * self.num_steps)):
+            if not self.can_update():
+                return
+            self._trial_time = (loc + 0.5) * step
+            self.update()
+        self.record = record
+        self.mouse_in_target = bool(record['in_targ'])
+        self.mouse_recv_stim = bool(record['get_stim'])
+        self._trial_time = float(record['time'])
+        if self.can_update():
+            self.update()
+
+
+class TrialRenderer(object):
+    """Replays a trial's records and overlay events through the same drawing as the live processes, and
+    composites each raw frame with them as the compositor does"""
+    def __init__(self, trial):
+        store = TrialStore(trial)
+        self.records = store.records()
+        self.initial, self.events, self.contours = read_overlay_log(trial + OVERLAY_ENDING)
+        self.state = self.initial['state'] or {'bounds': [], 'show_tracked': False, 'regions': [], 'background': 0}
+        self.contrail = deque((tuple(coord) for coord in self.initial['contrail']), maxlen=CONTRAIL_LENGTH)
+        self.pathing, self.heatmap, self.gradient = Pathing(), Heatmap(), Gradient()
+        self.progbar = OfflineProgressBar(store.metadata['duration'], store.metadata['stim_protocol'])
+        for obj in (self.pathing, self.heatmap, self.gradient, self.progbar):
+            obj.init_unpickleable_objs()
+        self.composite = np.zeros(COMPOSITE_DIMS, dtype='uint8')
+        self.next_record = 0
+        self.next_event = 0
+
+    def apply_events(self, frame_seq):
+        """Applies overlay events up to camera frame frame_seq"""
+        while self.next_event < len(self.events) and self.events[self.next_event][0] <= frame_seq:
+            changes = self.events[self.next_event][1]
+            if changes.get('clear_maps'):
+                for obj in (self.heatmap, self.pathing, self.gradient):
+                    obj.reset()
+            else:
+                # A new background clears the trail
+                if changes['background'] != self.state['background']:
+                    self.contrail.clear()
+                self.state = changes
+            self.next_event += 1
+
+    def advance(self, frame_seq):
+        """Applies records and overlay events up to camera frame frame_seq. Returns the coordinate tracked in it"""
+        frame_coord = None, None
+        while self.next_record < self.records.shape[0] and self.records[self.next_record]['frame'] <= frame_seq:
+            record = self.records[self.next_record]
+            self.apply_events(record['frame'])
+            coord = (None, None) if NO_COORD in (record['x'], record['y']) else (int(record['x']), int(record['y']))
+            self.pathing.update(coord)
+            self.gradient.update(*self.heatmap.update(coord))
+            self.progbar.replay(record)
+            if coord != (None, None):
+                self.contrail.appendleft(coord)
+            if record['frame'] == frame_seq:
+                frame_coord = coord
+            self.next_record += 1
+        self.apply_events(frame_seq)
+        return frame_coord
+
+    def render(self, frame, frame_seq):
+        """Composite (BGR) of raw frame, camera frame number frame_seq"""
+        coord = self.advance(frame_seq)
+        disp_frame = frame.copy()
+        bounds = self.state['bounds']
+        if len(bounds) == 2 and self.state['show_tracked']:
+            crop_to_bounds(disp_frame, bounds)
+        cv2gui = draw_tracking(disp_frame, self.state['regions'], bounds, self.contours.get(frame_seq), coord)
+        if coord != (None, None):
+            draw_contrails(cv2gui, self.contrail)
+        panels = ((PANEL_CV2GUI, cv2gui), (PANEL_PATHING, self.pathing.output_array),
+                  (PANEL_HEATMAP, self.heatmap.output_array), (PANEL_GRADIENT, self.gradient.output_array),
+                  (PANEL_PROGBAR, self.progbar.output_array))
+        for panel, image in panels:
+            self.composite[PANEL_SLICES[panel]] = image[..., ::-1]
+        return self.composite
+
+
+def render_segment(trial, first_frame, num_frames, encoder, segment_base):
+    """Renders frames first_frame to first_frame + num_frames of the trial's CV2 video. Returns the segment's entry
+    in the segment index"""
+    raw_base = trial + RAW_VIDEO_ENDING
+    frames, _ = read_frames_csv(raw_base + FRAMES_ENDING)
+    renderer = TrialRenderer(trial)
+    if first_frame:
+        renderer.advance(frames['frame'][first_frame - 1])
+    writer = create_encoder(encoder, segment_base, (COMPOSITE_DIMS[1], COMPOSITE_DIMS[0]),
+                            TrialStore(trial).metadata['framerate'], True, num_frames=num_frames)
+    written = 0
+    for frame, frame_seq in zip(read_video(raw_base, first_frame, num_frames),
+                                frames['frame'][first_frame:first_frame + num_frames]):
+        writer.write(renderer.render(frame, frame_seq))
+        written += 1
+    writer.release()
+    capture_times = frames['capture_time'][first_frame:first_frame + written]
+    return {'file': os.path.basename(writer.file_name), 'first_frame': first_frame, 'num_frames': written,
+            'start_time': float(capture_times[0]) if written else None,
+            'end_time': float(capture_times[-1]) if written else None}
+
+
+def segment_jobs(trial, encoder, segment_secs=SEGMENT_SECS):
+    """Arguments of render_segment() for each segment of the trial's CV2 video"""
+    frames, _ = read_frames_csv(trial + RAW_VIDEO_ENDING + FRAMES_ENDING)
+    segment_frames = max(1, int(round(segment_secs * TrialStore(trial).metadata['framerate'])))
+    return [(trial, first_frame, min(segment_frames, frames.shape[0] - first_frame), encoder,
+             '{}{}_seg{:03d}'.format(trial, CV2_VIDEO_ENDING, num))
+            for num, first_frame in enumerate(range(0, frames.shape[0], segment_frames))]
+
+
+def count_frames(file):
+    """Number of frames in a video file"""
+    if file.endswith('.raw'):
+        return len(read_raw(file))
+    capture = cv2.VideoCapture(file)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return num_frames
+
+
+def join_segments(trial, encoder, segments):
+    """Joins the rendered segments into the trial's CV2 video, with a copy of the raw video's frame sidecar, as
+    rendered frames match raw frames one to one. Segments are removed once joined. Returns the video's file name.
+    Raises IOError, keeping the segments, if the joined video does not hold all their frames"""
+    video_base = trial + CV2_VIDEO_ENDING
+    index_file = video_base + SEGMENT_INDEX_ENDING
+    num_frames = sum(segment['num_frames'] for segment in segments)
+    with open(index_file, 'w') as f:
+        json.dump({'encoder': encoder, 'fps': TrialStore(trial).metadata['framerate'],
+                   'frame_size': (COMPOSITE_DIMS[1], COMPOSITE_DIMS[0]), 'is_color': True,
+                   'num_frames': num_frames, 'dropped': 0, 'segments': segments}, f, indent=1)
+    video = concat_segments(index_file)
+    joined_frames = count_frames(video) if os.path.isfile(video) else 0
+    if joined_frames != num_frames:
+        raise IOError('Joined {} of {} frames into {}; segments kept'.format(joined_frames, num_frames, video))
+    directory = os.path.dirname(os.path.abspath(index_file))
+    for segment in segments:
+        os.remove(os.path.join(directory, segment['file']))
+    os.remove(index_file)
+    shutil.copyfile(trial + RAW_VIDEO_ENDING + FRAMES_ENDING, video_base + FRAMES_ENDING)
+    return video
+
+
+def find_rendered_trials(directory):
+    """Trials with an overlay log in directory and its subdirectories"""
+    trials = []
+    for root, _, files in os.walk(directory):
+        trials.extend(os.path.join(root, file[:-len(OVERLAY_ENDING)]) for file in files
+                      if file.endswith(OVERLAY_ENDING))
+    return sorted(trials)
+
+
+class RenderPool(object):
+    """Renders trials' CV2 videos in worker processes as they are submitted; the segments of a trial are rendered in
+    parallel, then joined. Must be created in a non-daemonic process"""
+    def __init__(self, workers=DEFAULT_RENDER_WORKERS, encoder=ENCODER_XVID, segment_secs=SEGMENT_SECS):
+        # Joining raw segments would not compress them; a lossless encoder not supported here would fall back to raw
+        if resolve_encoder(encoder) in (ENCODER_NPY, ENCODER_RAW):
+            raise ValueError('Cannot render to [{}]'.format(encoder))
+        self.encoder = encoder
+        self.segment_secs = segment_secs
+        self.pool = mp.Pool(workers)
+        # {trial: rendered segments (None until rendered)} of trials submitted and not yet rendered
+        self.pending = {}
+
+    def submit(self, trial):
+        try:
+            jobs = segment_jobs(trial, self.encoder, self.segment_secs)
+        except (IOError, OSError) as error:
+            print('Unable to render {}: {}'.format(trial, error))
+            return
+        if not jobs:
+            print('No frames to render for {}'.format(trial))
+            return
+        self.pending[trial] = [None] * len(jobs)
+        for num, job in enumerate(jobs):
+            self.pool.apply_async(render_segment, job,
+                                  callback=lambda segment, num=num: self.segment_rendered(trial, num, segment),
+                                  error_callback=lambda error: self.failed(trial, error))
+
+    def segment_rendered(self, trial, num, segment):
+        """Once all segments of trial are rendered, they are joined by a worker"""
+        segments = self.pending.get(trial)
+        if segments is None:  # another segment failed
+            return
+        segments[num] = segment
+        if None not in segments:
+            self.pool.apply_async(join_segments, (trial, self.encoder, segments),
+                                  callback=lambda video: self.finished(trial, video),
+                                  error_callback=lambda error: self.failed(trial, error))
+
+    def finished(self, trial, video):
+        self.pending.pop(trial, None)
+        print('Rendered {} to {}'.format(trial, video))
+
+    def failed(self, trial, error):
+        if self.pending.pop(trial, None) is not None:
+            print('Unable to render {}: {}'.format(trial, error))
+
+    def close(self):
+        """Closes the workers once they finish; call when nothing is pending, as joins are submitted by callbacks"""
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the CV2 video of trials recorded with overlay logs')
+    parser.add_argument('paths', nargs='+', help='trials ([trial] as saved), or directories to search for them')
+    parser.add_argument('--encoder', default=ENCODER_XVID, choices=sorted(set(ENCODERS) - {ENCODER_NPY, ENCODER_RAW}))
+    parser.add_argument('--workers', type=int, default=DEFAULT_RENDER_WORKERS)
+    parser.add_argument('--segment-secs', type=float, default=SEGMENT_SECS, help='secs of video rendered per job')
+    args = parser.parse_args()
+    trials = []
+    for path in args.paths:
+        trials.extend(find_rendered_trials(path) if os.path.isdir(path) else [path])
+    start = time.perf_counter()
+    renderer = RenderPool(args.workers, args.encoder, args.segment_secs)
+    for trial_name in trials:
+        renderer.submit(trial_name)
+    while renderer.pending:
+        time.sleep(0.1)
+    renderer.close()
+    print('Rendered {} Trials in {} Secs'.format(len(trials), round(time.perf_counter() - start, 2)))
@@ -0,0 +1,202 @@
+# coding=utf-8
+
+"""Closed-loop stimulation protocols. A state machine, updated once per coordinate, decides when and how to stimulate"""
+
+import numpy as np
+from Concurrency.Stimulation import STIM_ON, STIM_TOTAL, PULSE_DTYPE
+
+
+# Protocol parameters. Protocols are dicts of these; missing keys take their default
+# stim_on: pulse width (secs); stim_period: secs between pulse starts
+# dwell: secs the mouse must stay inside a region before stimulation starts
+# min_speed, max_speed: stimulate only while smoothed speed (px/s) is within these (None = no limit)
+# ramp_period, ramp_secs: period changes linearly in frequency from stim_period to ramp_period over the first
+#   ramp_secs of each continuous bout of stimulation (ramp_period None = no ramp)
+# max_pulses, max_stim_time: dose caps per trial (None = no cap)
+# enabled: whether to stimulate in a region at all
+# regions: {region_num: {param: value}} overrides for mouse inside that region. If the mouse is inside several
+#   regions the lowest numbered region applies
+DEFAULT_PROTOCOL = {
+    'stim_on': STIM_ON,
+    'stim_period': STIM_TOTAL,
+    'dwell': 0.0,
+    'min_speed': None,
+    'max_speed': None,
+    'ramp_period': None,
+    'ramp_secs': 0.0,
+    'max_pulses': None,
+    'max_stim_time': None,
+    'enabled': True,
+    'regions': {}
+}
+# Time constant (secs) of the exponential smoothing of speed
+SPEED_SMOOTHING = 0.25
+# Protocol states
+PROTOCOL_IDLE = 'idle'  # outside all (enabled) regions
+PROTOCOL_DWELLING = 'dwelling'  # inside a region, waiting for the dwell time
+PROTOCOL_SPEED_GATED = 'speed_gated'  # would stimulate, but speed is outside limits
+PROTOCOL_STIMULATING = 'stimulating'
+PROTOCOL_CAPPED = 'capped'  # dose cap reached; no more stimulation this trial
+PROTOCOL_STATES = (PROTOCOL_IDLE, PROTOCOL_DWELLING, PROTOCOL_SPEED_GATED, PROTOCOL_STIMULATING, PROTOCOL_CAPPED)
+# Region schedules resolvable in O(1) by the lowest set bit of a region bitmask
+MAX_SCHEDULES = 16
+
+
+def protocol_params(protocol):
+    """Protocol with defaults filled in and region keys as ints (they are strings when loaded from JSON)"""
+    params = dict(DEFAULT_PROTOCOL)
+    params.update(protocol or {})
+    params['regions'] = {int(region): dict(overrides) for region, overrides in params['regions'].items()}
+    return params
+
+
+class StimProtocol(object):
+    """Protocol state machine. update() is called once per coordinate and does O(1) work"""
+    def __init__(self, protocol=None):
+        self.params = protocol_params(protocol)
+        # Schedule (params) for each region, precomputed so lookup per coordinate is a list index
+        base = {key: value for key, value in self.params.items() if key != 'regions'}
+        self.schedules = []
+        for region_num in range(MAX_SCHEDULES):
+            schedule = dict(base)
+            schedule.update(self.params['regions'].get(region_num, {}))
+            for key in ('stim_period', 'ramp_period'):
+                if schedule[key] is not None and schedule[key] < schedule['stim_on']:
+                    raise ValueError('Region {} {} ({}s) is shorter than stim_on ({}s)'.format(
+                        region_num, key, schedule[key], schedule['stim_on']))
+            self.schedules.append(schedule)
+        self.reset()
+
+    def reset(self):
+        """Initial state for a new trial"""
+        self.state = PROTOCOL_IDLE
+        self.schedule = self.schedules[0]
+        self.region = None
+        self.entered = None  # time current region was entered
+        self.bout_start = None  # time current continuous bout of stimulation started
+        self.speed = 0.0
+        self.last_time = None
+        self.last_coord = None
+        self.stim_on = self.schedule['stim_on']
+        self.stim_period = self.schedule['stim_period']
+
+    @property
+    def gate_open(self):
+        return self.state == PROTOCOL_STIMULATING
+
+    def update_speed(self, t, x, y):
+        """Exponentially smoothed speed from consecutive tracked coordinates"""
+        if x is None or y is None:
+            return
+        if self.last_coord is not None and t > self.last_time:
+            dt = t - self.last_time
+            speed = np.hypot(x - self.last_coord[0], y - self.last_coord[1]) / dt
+            weight = 1.0 - np.exp(-dt / SPEED_SMOOTHING)
+            self.speed += weight * (speed - self.speed)
+        self.last_time, self.last_coord = t, (x, y)
+
+    def update(self, t, coord, regions, num_pulses, stim_time):
+        """Advances the state machine. t: secs; coord: (x, y) or (None, None); regions: bitmask of regions mouse is in
+        num_pulses, stim_time: automatic pulses and on time delivered so far this trial. Returns new state"""
+        self.update_speed(t, *coord)
+        if self.state == PROTOCOL_CAPPED:
+            return self.state
+        # Lowest numbered region mouse is in
+        region = (regions & -regions).bit_length() - 1 if regions else None
+        if region != self.region:
+            self.region, self.entered = region, t
+            self.schedule = self.schedules[region] if region is not None and region < MAX_SCHEDULES \
+                else self.schedules[0]
+        schedule = self.schedule
+        # Dose caps apply to the whole trial
+        max_pulses, max_stim_time = schedule['max_pulses'], schedule['max_stim_time']
+        if (max_pulses is not None and num_pulses >= max_pulses) or \
+                (max_stim_time is not None and stim_time + schedule['stim_on'] > max_stim_time + 1e-9):
+            self.set_state(PROTOCOL_CAPPED, t)
+        elif region is None or not schedule['enabled']:
+            self.set_state(PROTOCOL_IDLE, t)
+        elif t - self.entered < schedule['dwell']:
+            self.set_state(PROTOCOL_DWELLING, t)
+        elif (schedule['min_speed'] is not None and self.speed < schedule['min_speed']) or \
+                (schedule['max_speed'] is not None and self.speed > schedule['max_speed']):
+            self.set_state(PROTOCOL_SPEED_GATED, t)
+        else:
+            self.set_state(PROTOCOL_STIMULATING, t)
+        self.stim_on = schedule['stim_on']
+        self.stim_period = self.ramped_period(t)
+        return self.state
+
+    def set_state(self, state, t):
+        if state == PROTOCOL_STIMULATING and self.state != PROTOCOL_STIMULATING:
+            self.bout_start = t
+        self.state = state
+
+    def ramped_period(self, t):
+        """Period, ramped linearly in frequency over the start of the bout"""
+        schedule = self.schedule
+        if schedule['ramp_period'] is None or self.bout_start is None:
+            return schedule['stim_period']
+        progress = 1.0 if schedule['ramp_secs'] <= 0 else min(1.0, (t - self.bout_start) / schedule['ramp_secs'])
+        frequency = (1.0 / schedule['stim_period']) * (1 - progress) + (1.0 / schedule['ramp_period']) * progress
+        return 1.0 / frequency
+
+
+class SimulatedScheduler(object):
+    """Event driven equivalent of Stimulation.StimScheduler, for replaying trials faster than real time"""
+    def __init__(self):
+        self.gate = False
+        self.gate_opened = 0.0
+        self.next_allowed = float('-inf')
+        self.pulse_end = None
+        self.stim_on = STIM_ON
+        self.stim_period = STIM_TOTAL
+        self.num_pulses = 0
+        self.stim_time = 0.0
+        self.pulses = []
+
+    def advance(self, t):
+        """Delivers all pulses due up to time t"""
+        while True:
+            if self.pulse_end is not None:
+                if self.pulse_end > t:
+                    return
+                self.pulse_end = None
+            if not self.gate:
+                return
+            start = max(self.gate_opened, self.next_allowed)
+            if start > t:
+                return
+            self.pulse_end = start + self.stim_on
+            self.next_allowed = start + self.stim_period
+            self.num_pulses += 1
+            self.stim_time += self.stim_on
+            self.pulses.append((start, start, self.pulse_end, self.pulse_end, self.stim_period, False))
+
+    def set_gate(self, t, gate_open, stim_on, stim_period):
+        self.stim_on, self.stim_period = stim_on, stim_period
+        if gate_open and not self.gate:
+            self.gate_opened = t
+        self.gate = gate_open
+
+    def pulse_log(self):
+        return np.array(self.pulses, dtype=PULSE_DTYPE)
+
+
+def simulate_protocol(protocol, times, xs, ys, regions):
+    """Replays recorded coordinates through a protocol. xs, ys: NaN where untracked; regions: bitmask per record
+    Returns pulses (PULSE_DTYPE; actual = commanded) and {state: secs spent in state}"""
+    state_machine = StimProtocol(protocol)
+    scheduler = SimulatedScheduler()
+    state_time = dict.fromkeys(PROTOCOL_STATES, 0.0)
+    last_t, last_state = None, state_machine.state
+    for t, x, y, region_mask in zip(times.tolist(), xs.tolist(), ys.tolist(), regions.tolist()):
+        scheduler.advance(t)
+        if last_t is not None:
+            state_time[last_state] += t - last_t
+        coord = (None, None) if np.isnan(x) or np.isnan(y) else (x, y)
+        last_state = state_machine.update(t, coord, region_mask, scheduler.num_pulses, scheduler.stim_time)
+        scheduler.set_gate(t, state_machine.gate_open, state_machine.stim_on, state_machine.stim_period)
+        last_t = t
+    if last_t is not None:
+        scheduler.advance(last_t)
+    return scheduler.pulse_log(), state_time
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+"""PTGrey camera, through the PyCapture2 SDK. Only imported by the camera process when the camera is used; see
+CmrProc.create_camera"""
+
+import time
+import PyCapture2 as cap
+from Misc.CoreVars import *
+
+
+# Do we restrict camera exposure?
+RESTRICT_EXPOSURE = True
+PYCAP_FRAMERATE = getattr(cap.FRAMERATE, 'FR_{}'.format(CAMERA_FRAMERATE))
+# The 1394 cycle time embedded in images counts 128 secs of 8000 cycles of 3072 ticks, then wraps
+CYCLE_WRAP_SECS = 128
+CYCLES_PER_SEC = 8000
+TICKS_PER_CYCLE = 3072
+
+
+class CameraDevice(cap.Camera):
+    """Container for PTGrey FireFly Camera Hardware"""
+    def __init__(self):
+        super(CameraDevice, self).__init__()
+        self.running = False  # is the camera working
+        self.in_use = False  # are we using the camera or a saved video as source
+        # Hardware attributes
+        self.cmr_err = cap.Fc2error
+        # Finalize init
+        self.connect_camera()
+        time.sleep(50.0 / 1000.0)
+
+    def get_img(self):
+        """Acquires image data from camera, with the camera's timestamp of the image (see camera_time)"""
+        img = self.retrieveBuffer()
+        timestamp = self.camera_time(img.getTimeStamp())
+        img = img.getData()
+        img = img.reshape(VID_DIM)
+        return img, timestamp
+
+    def camera_time(self, timestamp):
+        """Secs on the camera's clock from its embedded cycle time. The cycle time wraps every CYCLE_WRAP_SECS;
+        wraps are counted between consecutive images, so a pause in capture longer than that loses one"""
+        cycles = timestamp.cycleCount + timestamp.cycleOffset / TICKS_PER_CYCLE
+        secs = timestamp.cycleSeconds + cycles / CYCLES_PER_SEC
+        if secs < self.last_cycle_secs:
+            self.cycle_wraps += 1
+        self.last_cycle_secs = secs
+        return self.cycle_wraps * CYCLE_WRAP_SECS + secs
+
+    def connect_camera(self):
+        """Initializes a PTGrey FireFly Camera"""
+        # Close any existing camera connections
+        self.close_camera()
+        self.last_cycle_secs = 0.0
+        self.cycle_wraps = 0
+        # Try to connect
+        try:
+            bus = cap.BusManager()
+            cam_id = bus.getCameraFromIndex(0)
+            self.connect(cam_id)
+            self.setVideoModeAndFrameRate(cap.VIDEO_MODE.VM_640x480Y8, PYCAP_FRAMERATE)
+            if RESTRICT_EXPOSURE:
+                self.set_properties()
+            # Images carry the camera's timestamp of their exposure
+            self.setEmbeddedImageInfo(timestamp=True)
+            self.startCapture()
+        except self.cmr_err:
+            self.running = False
+        else:
+            self.running = True
+
+    def set_properties(self):
+        """Edit camera properties for better exposure control"""
+        # Set Frame Rate
+        self.writeRegister(CMR_REG_FRAMERATE, CMR_SET_REG_ABS_MANUAL)
+        self.writeRegister(CMR_REG_FRAMERATE_ABS, CAMERA_ABS_FRAMERATE_INT)
+        # Read register and apply a mask on last 12 digits to obtain max value
+        bright_max = self.readRegister(CMR_REG_BRIGHTNESS - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
+        exposure_max = self.readRegister(CMR_REG_EXPOSURE - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
+        shutter_max = self.readRegister(CMR_REG_SHUTTER - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
+        gain_max = self.readRegister(CMR_REG_GAIN - CMR_REG_READ_VALS) & CMR_MAX_VALUE_MASK
+        # Write max values to registers
+        self.writeRegister(CMR_REG_BRIGHTNESS, CMR_SET_REG_MANUAL_LOW | bright_max)
+        self.writeRegister(CMR_REG_EXPOSURE, CMR_SET_REG_MANUAL_LOW | exposure_max)
+        self.writeRegister(CMR_REG_SHUTTER, CMR_SET_REG_MANUAL_LOW | shutter_max)
+        self.writeRegister(CMR_REG_GAIN, CMR_SET_REG_MANUAL_LOW | gain_max)
+
+    def close_camera(self):
+        """Closes Device and Exits Process"""
+        self.running = False
+        try:
+            self.stopCapture()
+            self.disconnect()
+        except self.cmr_err:
+            pass
@@ -0,0 +1,280 @@
+# coding=utf-8
+
+"""Parallel encoding: a recording is split into time segments, each encoded by one of a pool of encoder processes.
+Segments are listed in an index file, and can be joined into one video with concat_segments()
+
+Usage: python -m Concurrency.SegmentedEncoding SEGMENT_INDEX [OUTPUT]"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import multiprocessing as mp
+from Concurrency.Encoders import create_encoder, resolve_encoder, read_raw, ENCODERS, ENCODER_NPY, ENCODER_RAW
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Secs of video in each segment
+SEGMENT_SECS = 10
+# Frames waiting to be encoded, per worker; if all are in use, new frames are dropped
+SLOTS_PER_WORKER = 30
+# Secs to wait for a free slot before dropping a frame
+SLOT_TIMEOUT = 0.5
+# Secs release() waits for the workers to close another segment before giving up on them
+WORKER_STALL_SECS = 30
+SEGMENT_INDEX_ENDING = '_Segments.json'
+# Jobs sent to workers
+JOB_OPEN = 'open'
+JOB_FRAME = 'frame'
+JOB_CLOSE = 'close'
+JOB_EXIT = 'exit'
+
+
+def segment_worker(worker_num, jobs, slots, frame_shape, free_slots, segments_done, failures):
+    """Encoder process. Encodes frames from shared slots into their segment, returning each slot once its frame is
+    written. Segments of overlapping recordings may be open at once. segments_done[worker_num] counts segments closed.
+    A segment that fails is reported on failures as (segment, error) and its remaining frames are skipped; its slots
+    are still returned and its close still counted, so the recorder does not wait on it"""
+    frames = np.frombuffer(slots, dtype='uint8').reshape((-1,) + tuple(frame_shape))
+    writers = {}
+    failed = set()
+    while True:
+        job = jobs.get()
+        if job[0] == JOB_EXIT:
+            break
+        segment = job[2] if job[0] == JOB_OPEN else job[1]
+        try:
+            if job[0] == JOB_OPEN:
+                _, encoder, _, frame_size, fps, is_color, num_frames = job
+                writers[segment] = create_encoder(encoder, segment, frame_size, fps, is_color, num_frames)
+            elif job[0] == JOB_FRAME and segment not in failed:
+                _, _, slot, timestamp = job
+                writers[segment].write(frames[slot], timestamp)
+            elif job[0] == JOB_CLOSE and segment not in failed:
+                writers.pop(segment).release()
+        except Exception as error:
+            # Any error abandons only this segment; the worker goes on with the others
+            failed.add(segment)
+            writers.pop(segment, None)
+            failures.put((segment, '{}: {}'.format(type(error).__name__, error)))
+            print('Unable to encode segment {}: {}'.format(segment, error))
+        finally:
+            if job[0] == JOB_FRAME:
+                free_slots.put(job[2])
+            elif job[0] == JOB_CLOSE:
+                failed.discard(segment)
+                segments_done[worker_num] += 1
+
+
+class SegmentPool(object):
+    """Encoder processes and the shared frame slots they read from, for one recorder. Must be created and started in a
+    non-daemonic process (e.g. the GUI), and passed to the recorder"""
+    def __init__(self, frame_shape, workers):
+        self.frame_shape = tuple(frame_shape)
+        self.workers = workers
+        num_slots = workers * SLOTS_PER_WORKER
+        self.slots = mp.Array('B', num_slots * int(np.prod(frame_shape)), lock=False)
+        self.free_slots = mp.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self.jobs = [mp.Queue() for _ in range(workers)]
+        self.segments_done = mp.Array('i', workers)
+        # Segments closed per worker; only counted in the recorder's process
+        self.closes_sent = [0] * workers
+        # (segment, error) of segments that failed to encode, and {segment: error} of those collected from it; the
+        # latter only in the recorder's process
+        self.failures = mp.Queue()
+        self.failed = {}
+        self.processes = []
+
+    def start(self):
+        for worker_num in range(self.workers):
+            process = mp.Process(target=segment_worker, name='segment_encoder_{}'.format(worker_num), daemon=True,
+                                 args=(worker_num, self.jobs[worker_num], self.slots, self.frame_shape,
+                                       self.free_slots, self.segments_done, self.failures))
+            process.start()
+            self.processes.append(process)
+
+    def collect_failures(self):
+        """Moves failures reported by the workers into failed"""
+        while True:
+            try:
+                segment, error = self.failures.get_nowait()
+            except Queue.Empty:
+                return
+            self.failed[segment] = error
+
+    def close(self):
+        """Workers exit once all segments sent to them are written"""
+        for jobs in self.jobs:
+            jobs.put((JOB_EXIT,))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+
+class SegmentedWriter(object):
+    """Same interface as Encoders.Encoder; sends segments of segment_secs of frames to the pool's workers in turn"""
+    TRANSCODE = False
+
+    def __init__(self, pool, encoder, file_base, frame_size, fps, is_color, segment_secs=SEGMENT_SECS):
+        if encoder == ENCODER_NPY:
+            raise ValueError('Encoder [{}] cannot be segmented'.format(encoder))
+        self.pool = pool
+        # Resolved once, so the workers and the index agree on the encoder that writes the segments
+        self.encoder = resolve_encoder(encoder)
+        self.file_base = file_base
+        self.file_name = file_base + SEGMENT_INDEX_ENDING
+        self.frame_size = frame_size
+        self.fps = fps
+        self.is_color = is_color
+        self.segment_frames = max(1, int(round(segment_secs * fps)))
+        self.frames = np.frombuffer(pool.slots, dtype='uint8').reshape((-1,) + pool.frame_shape)
+        self.segments = []
+        self.segment_base = None
+        self.num_frames = 0
+        self.drops = 0
+
+    def write(self, img, timestamp=None):
+        try:
+            slot = self.pool.free_slots.get(timeout=SLOT_TIMEOUT)
+        except Queue.Empty:
+            self.drops += 1
+            return False
+        self.frames[slot] = img
+        if self.num_frames % self.segment_frames == 0:
+            self.next_segment(timestamp)
+        segment = self.segments[-1]
+        self.pool.jobs[segment['worker']].put((JOB_FRAME, self.segment_base, slot, timestamp))
+        segment['num_frames'] += 1
+        segment['end_time'] = timestamp
+        self.num_frames += 1
+        return True
+
+    def next_segment(self, timestamp):
+        """Closes the current segment, and opens the next on the next worker"""
+        if self.segments:
+            self.close_segment()
+        worker = len(self.segments) % self.pool.workers
+        self.segment_base = '{}_seg{:03d}'.format(self.file_base, len(self.segments))
+        self.pool.jobs[worker].put((JOB_OPEN, self.encoder, self.segment_base, self.frame_size, self.fps, self.is_color,
+                                    self.segment_frames))
+        self.segments.append({'file': os.path.basename(self.segment_base + ENCODERS[self.encoder].EXTENSION),
+                              'worker': worker, 'first_frame': self.num_frames, 'num_frames': 0,
+                              'start_time': timestamp, 'end_time': timestamp})
+
+    def close_segment(self):
+        worker = self.segments[-1]['worker']
+        self.pool.jobs[worker].put((JOB_CLOSE, self.segment_base))
+        self.pool.closes_sent[worker] += 1
+
+    def release(self):
+        """Waits until all segments are written, then writes the segment index. Segments that failed, or that the
+        workers stopped closing for WORKER_STALL_SECS, are listed with an error"""
+        if self.segments:
+            self.close_segment()
+        # Workers close segments in the order they were sent, so this includes any of an earlier recording
+        closes_sent = list(self.pool.closes_sent)
+        segments_done, last_progress = list(self.pool.segments_done), time.perf_counter()
+        while any(done < closed for done, closed in zip(segments_done, closes_sent)):
+            time.sleep(5.0 / 1000.0)
+            if list(self.pool.segments_done) != segments_done:
+                segments_done, last_progress = list(self.pool.segments_done), time.perf_counter()
+            elif time.perf_counter() - last_progress > WORKER_STALL_SECS:
+                self.mark_unclosed(segments_done, closes_sent)
+                break
+        self.pool.collect_failures()
+        for num, segment in enumerate(self.segments):
+            error = self.pool.failed.pop('{}_seg{:03d}'.format(self.file_base, num), None)
+            if error is not None:
+                segment['error'] = error
+        with open(self.file_name, 'w') as f:
+            json.dump({'encoder': self.encoder, 'fps': self.fps, 'frame_size': self.frame_size,
+                       'is_color': self.is_color, 'num_frames': self.num_frames, 'dropped': self.drops,
+                       'segments': self.segments}, f, indent=1)
+
+    def mark_unclosed(self, segments_done, closes_sent):
+        """Lists the latest segments of each worker that did not close them all as failed"""
+        print('Segment encoders stopped closing segments of {}'.format(self.file_base))
+        for worker, (done, closed) in enumerate(zip(segments_done, closes_sent)):
+            segments = [segment for segment in self.segments if segment['worker'] == worker]
+            for segment in segments[max(0, len(segments) - (closed - done)):]:
+                segment['error'] = 'Not closed within {} secs'.format(WORKER_STALL_SECS)
+
+
+def concat_segments(index_file, output=None):
+    """Joins the segments of an index into one video; without re-encoding if ffmpeg is available, else by decoding
+    and re-encoding with the segments' encoder. Raw segments are appended as they are. Segments listed with an
+    error are left out. Returns the output file name. Raises IOError if no frame could be read from the segments"""
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+    directory = os.path.dirname(os.path.abspath(index_file))
+    for segment in index['segments']:
+        if 'error' in segment:
+            print('Leaving out segment {}: {}'.format(segment['file'], segment['error']))
+    files = [os.path.join(directory, segment['file']) for segment in index['segments'] if 'error' not in segment]
+    file_base = index_file[:-len(SEGMENT_INDEX_ENDING)]
+    if output is None:
+        output = file_base + ENCODERS[index['encoder']].EXTENSION
+    if index['encoder'] == ENCODER_RAW:
+        return concat_raw_segments(index, files, output)
+    if shutil.which('ffmpeg'):
+        list_file = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        with list_file:
+            list_file.write(''.join("file '{}'\n".format(file.replace("'", "'\\''")) for file in files))
+        try:
+            subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                                   '-i', list_file.name, '-c', 'copy', output])
+        finally:
+            os.remove(list_file.name)
+        return output
+    import cv2
+    writer = None
+    for file in files:
+        capture = cv2.VideoCapture(file)
+        while True:
+            got, frame = capture.read()
+            if not got:
+                break
+            if writer is None:
+                writer = create_encoder(index['encoder'], os.path.splitext(output)[0], tuple(index['frame_size']),
+                                        index['fps'], index['is_color'])
+            # Decoded frames are always BGR
+            writer.write(frame if index['is_color'] else frame[..., 0])
+        capture.release()
+    if writer is None:
+        raise IOError('No frames could be read from the segments of: {}'.format(index_file))
+    writer.release()
+    return output
+
+
+def concat_raw_segments(index, files, output):
+    """Appends the frames of RawEncoder segments (which neither ffmpeg nor OpenCV read) to one .raw file"""
+    writer = None
+    for file in files:
+        frames = read_raw(file)
+        if writer is None and len(frames):
+            writer = create_encoder(ENCODER_RAW, os.path.splitext(output)[0], tuple(index['frame_size']),
+                                    index['fps'], index['is_color'])
+        for frame in frames:
+            writer.write(frame)
+    if writer is None:
+        raise IOError('No frames could be read from the segments: {}'.format(files))
+    writer.release()
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Join the segments of a segmented recording into one video')
+    parser.add_argument('index', help='segment index ([trial]_[stream]{})'.format(SEGMENT_INDEX_ENDING))
+    parser.add_argument('output', nargs='?', help='output video; default is the index name without the ending')
+    args = parser.parse_args()
+    print('Saved {}'.format(concat_segments(args.index, args.output)))
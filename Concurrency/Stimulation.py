@@ -0,0 +1,202 @@
+# coding=utf-8
+
+"""Stimulation pulse timing. A scheduler thread owns pulse on/off timing using absolute deadlines"""
+
+import time
+import numpy as np
+import threading as thr
+
+
+# Stimulate mouse for STIM_ON seconds every STIM_TOTAL seconds
+STIM_ON = 0.4
+STIM_TOTAL = 1.0
+# Deadlines are slept towards until SPIN_MARGIN secs remain, then spun on; sleeps alone overshoot by ~1ms+
+SPIN_MARGIN = 2.0 / 1000.0
+# Thread name
+STIM_SCHEDULER = 'stim_scheduler'
+# One record per pulse. Times are secs since trial start
+# period: secs until the next automatic pulse was allowed to start
+PULSE_DTYPE = np.dtype([('commanded_on', 'f8'), ('actual_on', 'f8'), ('commanded_off', 'f8'), ('actual_off', 'f8'),
+                        ('period', 'f8'), ('manual', '?')])
+PULSE_HEADER = ('Commanded On (s)', 'Actual On (s)', 'Commanded Off (s)', 'Actual Off (s)', 'Period (s)', 'Manual')
+JITTER_HEADER = ('Num Pulses', 'Mean On Latency (ms)', 'SD On Latency (ms)', 'Max On Latency (ms)',
+                 'Mean Off Latency (ms)', 'SD Off Latency (ms)', 'Max Off Latency (ms)',
+                 'Mean Width Error (ms)', 'SD Width Error (ms)', 'Max Abs Width Error (ms)',
+                 'Mean Period Error (ms)', 'SD Period Error (ms)', 'Max Abs Period Error (ms)')
+
+
+def wait_until(deadline):
+    """Waits until deadline (a time.perf_counter() value)"""
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        # sleep(0) releases the GIL while spinning
+        time.sleep(remaining - SPIN_MARGIN if remaining > SPIN_MARGIN else 0)
+
+
+class StimScheduler(object):
+    """Delivers pulses of stim_on secs, at most one every stim_period secs, while the gate is open.
+    Pulse times are computed from deadlines, not from when the previous step happened to finish, so they do not drift"""
+    def __init__(self, output, stim_on=STIM_ON, stim_period=STIM_TOTAL):
+        # output(on, manual) sets the hardware output; called from the scheduler thread
+        self.output = output
+        self.stim_on = stim_on
+        self.stim_period = stim_period
+        # Is an automatic (gated) pulse on? Read only outside of scheduler thread
+        self.pulse_on = False
+        # Automatic pulses started, and their total on time, since the trial started. Read only outside of scheduler
+        self.num_pulses = 0
+        self.stim_time = 0.0
+        self.thread = None
+        self._cond = thr.Condition()
+        self._closed = False
+        self._gate = False
+        self._gate_opened = 0.0
+        self._next_allowed = float('-inf')
+        self._manual_requests = []
+        self._trial_start = time.perf_counter()
+        self._log = []
+        # Record of the pulse being delivered, until it is logged or closed out by pop_log()
+        self._in_progress = None
+
+    def start(self):
+        self.thread = thr.Thread(target=self.stim_scheduling_worker, name=STIM_SCHEDULER, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stops the scheduler after any pulse in progress"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def set_gate(self, gate_open, stim_on=None, stim_period=None):
+        """Pulses are delivered while the gate is open. Optionally sets the timing of the next automatic pulses"""
+        with self._cond:
+            if stim_on is not None:
+                self.stim_on = stim_on
+            if stim_period is not None:
+                self.stim_period = stim_period
+            if gate_open != self._gate:
+                self._gate = gate_open
+                if gate_open:
+                    self._gate_opened = time.perf_counter()
+                self._cond.notify()
+
+    def manual_pulse(self):
+        """Delivers one pulse now, regardless of the gate"""
+        with self._cond:
+            self._manual_requests.append(time.perf_counter())
+            self._cond.notify()
+
+    def start_trial(self, start_time):
+        """Clears the pulse log; logged times are relative to start_time (a time.perf_counter() value)"""
+        with self._cond:
+            self._trial_start = start_time
+            self._log = []
+            # A pulse started before the trial is not logged
+            self._in_progress = None
+            self.num_pulses = 0
+            self.stim_time = 0.0
+
+    def pop_log(self):
+        """Returns pulses delivered since the trial started and clears the log. A pulse still on is closed out into
+        this log, with the times not yet known as NaN, rather than logged into the next trial"""
+        with self._cond:
+            log, self._log = self._log, []
+            if self._in_progress is not None:
+                log.append(tuple(self._in_progress))
+                self._in_progress = None
+            trial_start = self._trial_start
+        pulses = np.array(log, dtype=PULSE_DTYPE)
+        for name in ('commanded_on', 'actual_on', 'commanded_off', 'actual_off'):
+            pulses[name] -= trial_start
+        return pulses
+
+    def stim_scheduling_worker(self):
+        """a worker thread that delivers pulses"""
+        while True:
+            with self._cond:
+                while not (self._closed or self._gate or self._manual_requests):
+                    self._cond.wait()
+                if self._closed:
+                    break
+                if self._manual_requests:
+                    commanded_on, manual = self._manual_requests.pop(0), True
+                else:
+                    commanded_on, manual = max(self._gate_opened, self._next_allowed), False
+                stim_on, stim_period = self.stim_on, self.stim_period
+                due = commanded_on <= time.perf_counter()
+                if due and not manual:
+                    self.num_pulses += 1
+                    self.stim_time += stim_on
+            if not due:
+                # Too soon after the last pulse; check the gate is still open once the period is up
+                wait_until(commanded_on)
+                continue
+            self.pulse(commanded_on, manual, stim_on, stim_period)
+
+    def pulse(self, commanded_on, manual, stim_on, stim_period):
+        """Delivers a single pulse. Off deadline is relative to the commanded on time"""
+        commanded_off = commanded_on + stim_on
+        record = [commanded_on, float('nan'), commanded_off, float('nan'), stim_period, manual]
+        with self._cond:
+            self._in_progress = record
+        actual_on = self.set_output(True, manual)
+        with self._cond:
+            record[1] = actual_on
+        wait_until(commanded_off)
+        actual_off = self.set_output(False, manual)
+        with self._cond:
+            if not manual:
+                self._next_allowed = commanded_on + stim_period
+            # Unless already closed out by pop_log()
+            if self._in_progress is record:
+                record[3] = actual_off
+                self._log.append(tuple(record))
+                self._in_progress = None
+
+    def set_output(self, on, manual):
+        """Sets output; returns time the output was set"""
+        self.output(on, manual)
+        if not manual:
+            self.pulse_on = on
+        return time.perf_counter()
+
+
+def pulse_jitter(pulses):
+    """Timing error statistics (ms) of logged pulses, as a row for JITTER_HEADER
+    Period error is measured between consecutive automatic pulses delivered back to back. Times not known (NaN, of a
+    pulse still on when logged) are left out"""
+    on_latency = (pulses['actual_on'] - pulses['commanded_on']) * 1000
+    off_latency = (pulses['actual_off'] - pulses['commanded_off']) * 1000
+    width_error = ((pulses['actual_off'] - pulses['actual_on']) -
+                   (pulses['commanded_off'] - pulses['commanded_on'])) * 1000
+    auto = pulses[~pulses['manual']]
+    back_to_back = np.isclose(np.diff(auto['commanded_on']), auto['period'][:-1])
+    period_error = (np.diff(auto['actual_on']) - auto['period'][:-1])[back_to_back] * 1000
+    row = [pulses.shape[0]]
+    for errors, use_abs in ((on_latency, False), (off_latency, False), (width_error, True), (period_error, True)):
+        errors = errors[np.isfinite(errors)]
+        if not errors.size:
+            row.extend((0.0, 0.0, 0.0))
+            continue
+        maximum = np.abs(errors).max() if use_abs else errors.max()
+        row.extend(round(float(value), 3) for value in (errors.mean(), errors.std(), maximum))
+    return tuple(row)
+
+
+def save_stim_log(file, pulses, stim_on=STIM_ON, stim_period=STIM_TOTAL):
+    """Writes pulse timing to a .csv: parameters, jitter statistics, then each pulse"""
+    with open(file, 'w') as f:
+        lines = (('Stim On (s)', 'Stim Period (s)'), (stim_on, stim_period),
+                 JITTER_HEADER, pulse_jitter(pulses), PULSE_HEADER)
+        lines += tuple((round(float(pulse['commanded_on']), 4), round(float(pulse['actual_on']), 4),
+                        round(float(pulse['commanded_off']), 4), round(float(pulse['actual_off']), 4),
+                        round(float(pulse['period']), 4), bool(pulse['manual'])) for pulse in pulses)
+        for line in lines:
+            f.write(''.join('{},'.format(element) for element in line))
+            f.write('\n')
@@ -0,0 +1,195 @@
+# coding=utf-8
+
+"""Synthetic camera: dark blobs (stand-ins for mice) moving over a noisy arena, with ground truth trajectories.
+Lets the tracking pipeline be run and profiled without a camera; select it with the camera_backend setting
+
+Usage: python -m Concurrency.SyntheticSource OUTPUT [--frames N] [--fps F] [--size COLS ROWS] [--blobs N] [--seed S]
+Writes OUTPUT.avi, to be replayed as a video source, and its ground truth OUTPUT_Truth.csv"""
+
+import cv2
+import math
+import time
+import argparse
+import numpy as np
+
+
+TRUTH_ENDING = '_Truth.csv'
+TRUTH_HEADER = ('Frame', 'Time (s)', 'Blob', 'X', 'Y', 'Angle (deg)')
+# Arena; the mouse is tracked as darker than the background
+FLOOR_LEVEL = 170
+WALL_LEVEL = 100
+WALL_WIDTH = 16
+BLOB_LEVEL = 60
+# Half lengths of each blob's axes; its area is close to CV2Processor's expected mouse size
+BLOB_AXES = (36, 22)
+NOISE_SD = 4.0
+# Noise fields rendered in advance; each frame adds one picked at random
+NOISE_FIELDS = 8
+# Motion: heading drifts randomly; speed (px/s) reverts to its mean
+MEAN_SPEED = 120.0
+SPEED_SD = 60.0
+SPEED_REVERSION = 1.0
+TURN_SD = 2.0
+
+
+class SyntheticArena(object):
+    """Renders frames of frame_size (cols, rows). Frame n shows the blobs at time n / fps.
+    Motion and rendering use separate random streams, so trajectories for a seed are the same whether or not frames
+    are rendered; see trajectories()"""
+    def __init__(self, frame_size, fps, num_blobs=1, seed=0, noise_sd=NOISE_SD):
+        self.frame_size = tuple(frame_size)
+        self.fps = fps
+        self.dt = 1.0 / fps
+        self.num_blobs = num_blobs
+        self.motion = np.random.RandomState(seed)
+        self.noise = np.random.RandomState(seed + 1)
+        self.background = self.render_background(np.random.RandomState(seed + 2))
+        # Saturating noise: each field is split into the part added and the part subtracted
+        fields = [self.noise.normal(0, noise_sd, self.background.shape) for _ in range(NOISE_FIELDS)]
+        self.noise_fields = [(np.clip(field, 0, 255).astype('uint8'), np.clip(-field, 0, 255).astype('uint8'))
+                             for field in fields]
+        # Blobs stay clear of the walls
+        cols, rows = self.frame_size
+        margin = WALL_WIDTH + BLOB_AXES[0]
+        self.limits = np.array([margin, margin]), np.array([cols - margin, rows - margin])
+        self.positions = self.motion.uniform(self.limits[0], self.limits[1], (num_blobs, 2))
+        self.headings = self.motion.uniform(0, 2 * math.pi, num_blobs)
+        self.speeds = np.full(num_blobs, MEAN_SPEED)
+        self.frame_num = 0
+
+    def render_background(self, random):
+        """Floor with a static, low frequency mottle, surrounded by darker walls"""
+        cols, rows = self.frame_size
+        mottle = cv2.resize(random.normal(0, 6, (rows // 40 + 2, cols // 40 + 2)), (cols, rows),
+                            interpolation=cv2.INTER_CUBIC)
+        background = np.clip(FLOOR_LEVEL + mottle, 0, 255).astype('uint8')
+        background[:WALL_WIDTH], background[-WALL_WIDTH:] = WALL_LEVEL, WALL_LEVEL
+        background[:, :WALL_WIDTH], background[:, -WALL_WIDTH:] = WALL_LEVEL, WALL_LEVEL
+        return background
+
+    def state(self):
+        """(x, y, angle in degrees) of each blob in the current frame"""
+        return np.column_stack((self.positions, np.degrees(self.headings) % 360))
+
+    def step(self):
+        """Moves the blobs on by one frame, turning them back into the arena at its edges"""
+        self.headings += self.motion.normal(0, TURN_SD * math.sqrt(self.dt), self.num_blobs)
+        self.speeds += (SPEED_REVERSION * (MEAN_SPEED - self.speeds) * self.dt +
+                        self.motion.normal(0, SPEED_SD * math.sqrt(self.dt), self.num_blobs))
+        self.speeds = np.maximum(self.speeds, 0)
+        velocities = np.column_stack((np.cos(self.headings), np.sin(self.headings))) * (self.speeds * self.dt)[:, None]
+        positions = self.positions + velocities
+        low, high = self.limits
+        # Reflect off the edges: position mirrored back inside, heading mirrored on that axis
+        for axis in (0, 1):
+            below, above = positions[:, axis] < low[axis], positions[:, axis] > high[axis]
+            positions[below, axis] = 2 * low[axis] - positions[below, axis]
+            positions[above, axis] = 2 * high[axis] - positions[above, axis]
+            positions[:, axis] = np.clip(positions[:, axis], low[axis], high[axis])
+            self.headings[below | above] = (math.pi if axis == 0 else 0) - self.headings[below | above]
+        self.positions = positions
+        self.frame_num += 1
+
+    def render(self):
+        """Grayscale image of the current frame"""
+        frame = self.background.copy()
+        for x, y, angle in self.state():
+            cv2.ellipse(frame, (int(round(x)), int(round(y))), BLOB_AXES, angle, 0, 360, BLOB_LEVEL, -1, cv2.LINE_AA)
+        added, subtracted = self.noise_fields[self.noise.randint(NOISE_FIELDS)]
+        return cv2.subtract(cv2.add(frame, added), subtracted)
+
+    def next_frame(self):
+        """Renders the current frame and moves on to the next. Returns the image and the blobs' state in it"""
+        frame, state = self.render(), self.state()
+        self.step()
+        return frame, state
+
+    def skip(self, num_frames):
+        """Moves on without rendering, e.g. for frames a camera would have dropped"""
+        for _ in range(num_frames):
+            self.step()
+
+    def trajectories(self, num_frames):
+        """Ground truth rows (TRUTH_HEADER) of the next num_frames frames, without rendering them"""
+        rows = []
+        for _ in range(num_frames):
+            rows.extend(self.truth_rows(self.frame_num, self.state()))
+            self.step()
+        return rows
+
+    def truth_rows(self, frame_num, state):
+        return [(frame_num, round(frame_num * self.dt, 4), blob, round(x, 2), round(y, 2), round(angle, 1))
+                for blob, (x, y, angle) in enumerate(state)]
+
+
+class SyntheticCameraError(Exception):
+    pass
+
+
+class SyntheticCamera(object):
+    """Stand-in for CmrProc.CameraDevice. Frames are delivered at fps; like a camera, frames that are not retrieved in
+    time are dropped, and show as gaps in the camera timestamps. Camera time n / fps is frame n of a SyntheticArena
+    with the same seed, so tracked coordinates can be compared with its trajectories()"""
+    def __init__(self, frame_size, fps, num_blobs=1, seed=0):
+        self.frame_size = frame_size
+        self.fps = fps
+        self.num_blobs = num_blobs
+        self.seed = seed
+        self.running = False
+        self.in_use = False
+        self.cmr_err = SyntheticCameraError
+        self.connect_camera()
+
+    def get_img(self):
+        """Waits for the next frame; returns it with its camera timestamp (secs)"""
+        if not self.running:
+            raise SyntheticCameraError('Synthetic camera is closed')
+        due = self.start + self.arena.frame_num * self.arena.dt
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Frames due while we were late are dropped
+            self.arena.skip(int(-delay * self.fps))
+        frame_num = self.arena.frame_num
+        img, _ = self.arena.next_frame()
+        return img, frame_num * self.arena.dt
+
+    def connect_camera(self):
+        """Starts a new arena; its clock starts now"""
+        self.arena = SyntheticArena(self.frame_size, self.fps, self.num_blobs, self.seed)
+        self.start = time.perf_counter()
+        self.running = True
+
+    def close_camera(self):
+        self.running = False
+
+
+def write_synthetic_video(file_base, num_frames, fps, frame_size, num_blobs, seed):
+    """Writes file_base.avi (MJPG) and its ground truth file_base + TRUTH_ENDING"""
+    arena = SyntheticArena(frame_size, fps, num_blobs, seed)
+    writer = cv2.VideoWriter(file_base + '.avi', cv2.VideoWriter_fourcc(*'MJPG'), fps, frame_size, False)
+    lines = [TRUTH_HEADER]
+    for _ in range(num_frames):
+        frame_num = arena.frame_num
+        frame, state = arena.next_frame()
+        writer.write(frame)
+        lines.extend(arena.truth_rows(frame_num, state))
+    writer.release()
+    with open(file_base + TRUTH_ENDING, 'w') as f:
+        for line in lines:
+            f.write(''.join('{},'.format(element) for element in line))
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic arena video and its ground truth trajectories')
+    parser.add_argument('output', help='output file name, without extension')
+    parser.add_argument('--frames', type=int, default=900)
+    parser.add_argument('--fps', type=float, default=15)
+    parser.add_argument('--size', type=int, nargs=2, default=(640, 480), metavar=('COLS', 'ROWS'))
+    parser.add_argument('--blobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_synthetic_video(args.output, args.frames, args.fps, tuple(args.size), args.blobs, args.seed)
+    print('Saved {}.avi and {}{}'.format(args.output, args.output, TRUTH_ENDING))
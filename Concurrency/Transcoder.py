@@ -0,0 +1,102 @@
+# coding=utf-8
+
+"""Compresses frames recorded unencoded by Encoders.NpyEncoder, after the trial, in a pool of worker processes
+
+Usage: python -m Concurrency.Transcoder [NPY FILE or DIRECTORY] ... [--encoder xvid] [--workers N] [--delete]"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import multiprocessing as mp
+from Concurrency.Encoders import create_encoder, ENCODERS, ENCODER_XVID, ENCODER_NPY
+
+
+# Pool leaves a core free for other work
+DEFAULT_TRANSCODE_WORKERS = max(1, mp.cpu_count() - 1)
+
+
+def read_npy_recording(file_name):
+    """Memory mapped frames actually written, their timestamps, and the recording's info"""
+    with open(file_name + '.json', 'r') as f:
+        info = json.load(f)
+    frames = np.load(file_name, mmap_mode='r')[:info['num_frames']]
+    timestamps = np.load(os.path.join(os.path.dirname(file_name), info['timestamps']))
+    return frames, timestamps, info
+
+
+def transcode(file_name, encoder=ENCODER_XVID, delete_source=False):
+    """Encodes an .npy recording to the same file name with the encoder's extension. Returns the new file name.
+    The timestamps file is kept; with delete_source the .npy and its .json are removed once encoded"""
+    frames, _, info = read_npy_recording(file_name)
+    is_color = frames.ndim == 4
+    frame_size = frames.shape[2], frames.shape[1]
+    writer = create_encoder(encoder, file_name[:-len('.npy')], frame_size, info['fps'], is_color,
+                            num_frames=frames.shape[0])
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    del frames
+    if delete_source:
+        os.remove(file_name)
+        os.remove(file_name + '.json')
+    return writer.file_name
+
+
+def find_npy_recordings(directory):
+    """.npy recordings (those with a .json alongside) in directory and its subdirectories"""
+    recordings = []
+    for root, _, files in os.walk(directory):
+        recordings.extend(os.path.join(root, file) for file in files
+                          if file.endswith('.npy') and file + '.json' in files)
+    return sorted(recordings)
+
+
+class TranscoderPool(object):
+    """Transcodes recordings in worker processes as they are submitted. Must be created in a non-daemonic process"""
+    def __init__(self, workers=DEFAULT_TRANSCODE_WORKERS, encoder=ENCODER_XVID, delete_source=False):
+        if encoder == ENCODER_NPY:
+            raise ValueError('Cannot transcode to [{}]'.format(encoder))
+        self.encoder = encoder
+        self.delete_source = delete_source
+        self.pool = mp.Pool(workers)
+        # Files submitted and not yet transcoded
+        self.pending = set()
+
+    def submit(self, file_name):
+        self.pending.add(file_name)
+        self.pool.apply_async(transcode, (file_name, self.encoder, self.delete_source),
+                              callback=lambda new_file: self.finished(file_name, new_file),
+                              error_callback=lambda error: self.failed(file_name, error))
+
+    def finished(self, file_name, new_file):
+        self.pending.discard(file_name)
+        print('Transcoded {} to {}'.format(file_name, new_file))
+
+    def failed(self, file_name, error):
+        self.pending.discard(file_name)
+        print('Unable to transcode {}: {}'.format(file_name, error))
+
+    def close(self):
+        """Waits for submitted files to finish, then closes the workers"""
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Transcode unencoded .npy recordings')
+    parser.add_argument('paths', nargs='+', help='.npy recordings, or directories to search for them')
+    parser.add_argument('--encoder', default=ENCODER_XVID, choices=sorted(set(ENCODERS) - {ENCODER_NPY}))
+    parser.add_argument('--workers', type=int, default=DEFAULT_TRANSCODE_WORKERS)
+    parser.add_argument('--delete', action='store_true', help='remove .npy recordings once transcoded')
+    args = parser.parse_args()
+    files = []
+    for path in args.paths:
+        files.extend(find_npy_recordings(path) if os.path.isdir(path) else [path])
+    start = time.perf_counter()
+    transcoder = TranscoderPool(args.workers, args.encoder, args.delete)
+    for npy_file in files:
+        transcoder.submit(npy_file)
+    transcoder.close()
+    print('Transcoded {} Recordings in {} Secs'.format(len(files), round(time.perf_counter() - start, 2)))
@@ -0,0 +1,60 @@
+# coding=utf-8
+
+"""Produces end of trial artifacts in the background so the next trial can start immediately"""
+
+import threading as thr
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Worker threads per finaliser. Threads (not processes): our processes are daemonic and cannot have children;
+# the heavy lifting (numpy, cv2 encoding, file IO) releases the GIL anyway
+FINALISER_WORKERS = 4
+# Thread name prefix
+FINALISER = 'finaliser'
+
+
+class TrialFinaliser(object):
+    """Runs each trial's jobs on a worker pool and reports when all jobs of a trial are done"""
+    def __init__(self, on_finished, num_workers=FINALISER_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix=FINALISER)
+        # on_finished(trial, errors) is called from a worker thread once all of a trial's jobs complete
+        self.on_finished = on_finished
+        self._pending = {}
+        self._errors = {}
+        self._lock = thr.Lock()
+
+    def submit(self, trial, jobs):
+        """Run jobs (callables taking no args) for trial in parallel. Jobs must only use snapshots of trial data"""
+        with self._lock:
+            self._pending[trial] = len(jobs)
+            self._errors[trial] = []
+        if not jobs:
+            self.job_done(trial, future=None)
+        for job in jobs:
+            future = self.pool.submit(job)
+            future.add_done_callback(lambda f, t=trial: self.job_done(t, f))
+
+    def job_done(self, trial, future):
+        """Counts down trial's remaining jobs; reports trial once all are done"""
+        error = future.exception() if future else None
+        with self._lock:
+            if error:
+                self._errors[trial].append(error)
+            self._pending[trial] -= 1 if future else 0
+            finished = self._pending[trial] <= 0
+            if finished:
+                del self._pending[trial]
+                errors = self._errors.pop(trial)
+        if error:
+            print('Error Saving ({}): {!r}'.format(trial, error))
+        if finished:
+            self.on_finished(trial, errors)
+
+    def pending_trials(self):
+        """Trials with unfinished jobs"""
+        with self._lock:
+            return list(self._pending)
+
+    def shutdown(self):
+        """Waits for all submitted jobs to finish"""
+        self.pool.shutdown(wait=True)
@@ -2,39 +2,63 @@
 
 """Process for recording videos to file"""
 
-import cv2
 import sys
 import time
 import numpy as np
 import threading as thr
 import multiprocessing as mp
-from Misc.CustomClasses import StoppableProcess, ReadMessage, NewMessage
-from Misc.GlobalVars import *
+from Concurrency.Encoders import create_encoder, ENCODER_XVID
+from Concurrency.SegmentedEncoding import SegmentedWriter
+from DirsSettings.TrialData import FRAME_DTYPE, FRAME_RECORD_ENDING
+from Misc.CustomClasses import StoppableProcess, ReadMessage, NewMessage, BoundedBuffer, FramePool, DROP_NEWEST
+from Misc.CoreVars import *
+from Misc.IPC import proc_handler_queue, exp_start_event
 if sys.version[0] == '2':
     import Queue as Queue
 else:
     import queue as Queue
 
 
+# Secs of frames that may wait to be written; if the writer falls further behind, new frames are dropped
+RECORDER_BUFFER_SECS = 5
+RECORDER_BUFFER_SIZE = RECORDER_BUFFER_SECS * CAMERA_FRAMERATE
+# Recording until a wall clock duration may take more frames than duration x fps, if the camera runs fast
+WALL_CLOCK_FRAME_MARGIN = 1.1
+
+
 class VideoRecorder(StoppableProcess):
-    """Has a view to a provided; records from them"""
-    def __init__(self, name, is_color, file_name_ending, mp_array, recording_sync):
+    """Has a view to a provided mp_array; records from it"""
+    def __init__(self, name, is_color, file_name_ending, mp_array, recording_sync, encoder=ENCODER_XVID,
+                 segment_pool=None, stop_on_duration=False):
         super(VideoRecorder, self).__init__()
         self.name = name
         self.is_color = is_color
         self.connected = True
-        self.output_dimensions = VID_DIM[1], VID_DIM[0]
+        self.output_dimensions = mp_array.array_dims[1], mp_array.array_dims[0]
         # Cross process communication
-        self.output_msgs = PROC_HANDLER_QUEUE
-        self.exp_start_event = EXP_START_EVENT
+        self.output_msgs = proc_handler_queue()
+        self.exp_start_event = exp_start_event()
         self.input_msgs = mp.Queue()
         self.parent_pipe, self.pipe = mp.Pipe()
         # Recording params
-        self.file_name_ending = file_name_ending
+        self.file_name_ending = file_name_ending  # the encoder adds the file extension
+        # None records no video; the recorder still starts and finishes trials with the others, e.g. when the video is
+        # rendered after the trial instead (see Concurrency.OfflineRender)
+        self.encoder = encoder
+        # If given, frames are encoded in parallel segments by the pool's processes
+        self.segment_pool = segment_pool
+        # Stop after the trial duration has elapsed, rather than after duration x CAMERA_FRAMERATE frames
+        self.stop_on_duration = stop_on_duration
+        self._duration = 0.0
         self._recording = False
+        # Set by a user STOP; ends recording whether it stops on frames or on duration
+        self._stop_requested = False
         self._ttl_num_frames = -1
+        self._save_name = None
+        self._rec_start = 0.0
         self.curr_frame = 0
         self.frame_buffer = None
+        self.frame_pool = None
         # Shared MP arrays
         self.mp_array = mp_array
         # Rec Sync Event
@@ -45,10 +69,11 @@ class VideoRecorder(StoppableProcess):
         """Creates objects that must exist in the new process"""
         # Numpy views of shared mp array
         self.image_array = self.mp_array.generate_np_array()
+        self.image_lock = self.mp_array.array.get_lock()
+        # Queued frames are copied into these, so they are not overwritten by the camera before being written
+        self.frame_pool = FramePool(self.image_array.shape, self.image_array.dtype, RECORDER_BUFFER_SIZE)
         # Msg parser
         self.setup_msg_parser()
-        # Video buffers
-        self.frame_buffer = Queue.Queue()
 
     def setup_msg_parser(self):
         """Dictionary of {Msg:Actions}"""
@@ -59,9 +84,9 @@ class VideoRecorder(StoppableProcess):
         }
 
     # Msg polling and processing thread
-    def msg_proc_handler(self, cmd):
+    def msg_proc_handler(self, cmd, val=None):
         """Sends a message to process handler"""
-        msg = NewMessage(dev=self.name, cmd=cmd)
+        msg = NewMessage(dev=self.name, cmd=cmd, val=val)
         self.output_msgs.put_nowait(msg)
 
     def process_message(self, msg):
@@ -78,21 +103,26 @@ class VideoRecorder(StoppableProcess):
                 msg = ReadMessage(msg)
                 self.process_message(msg)
 
-    def video_writing_worker(self):
-        """a worker thread to write frames"""
-        record = True
-        while self.connected and record:
-            try:
-                img = self.frame_buffer.get(timeout=0.1)
-            except Queue.Empty:
-                if not self._recording:
-                    record = False
-                else:
-                    time.sleep(1.0 / 1000.0)
-            else:
-                self._video_writer.write(img)
-        self._video_writer.release()
-        self.msg_proc_handler(cmd=MSG_VIDREC_FINISHED)
+    def video_writing_worker(self, video_writer, frame_buffer, save_name):
+        """a worker thread to write one trial's frames. Each trial has its own writer and buffer, so a
+        new trial can start recording while this one is still being written. Frames are returned to the
+        pool once written. The camera frame and capture time of each frame written is saved alongside"""
+        frames = []
+        while True:
+            item = frame_buffer.get()
+            if item is None:  # end of trial
+                break
+            img, frame_seq, timestamp = item
+            if video_writer.write(img, timestamp):
+                frames.append((frame_seq, timestamp))
+            self.frame_pool.release(img)
+        video_writer.release()
+        np.save(save_name + self.file_name_ending + FRAME_RECORD_ENDING, np.array(frames, dtype=FRAME_DTYPE))
+        self.msg_proc_handler(cmd=MSG_BUFFER_STATS, val=(save_name, [frame_buffer.stats(), self.frame_pool.stats()]))
+        # Unencoded recordings are compressed by the GUI's transcoder pool
+        if video_writer.TRANSCODE:
+            self.msg_proc_handler(cmd=MSG_TRANSCODE, val=video_writer.file_name)
+        self.msg_proc_handler(cmd=MSG_VIDREC_FINISHED, val=save_name)
         print('Closing FrameWriter ({})...'.format(self.name))
 
     def set_record_to_file(self, record, recording_params):
@@ -102,20 +132,37 @@ class VideoRecorder(StoppableProcess):
             duration = recording_params[1]
             # Total frames to record at CAMERA_FRAMERATE
             self._ttl_num_frames = int(duration * CAMERA_FRAMERATE)
+            self._duration = duration
+            self._stop_requested = False
+            max_frames = self._ttl_num_frames + 1
+            if self.stop_on_duration:
+                max_frames = int(max_frames * WALL_CLOCK_FRAME_MARGIN)
             # setup video recorders
-            self._video_writer = cv2.VideoWriter(fname + self.file_name_ending,
-                                                 cv2.VideoWriter_fourcc(*'XVID'), CAMERA_FRAMERATE,
-                                                 self.output_dimensions, self.is_color)
-            # Create worker thread
-            self.frame_buffer.queue.clear()
-            worker = thr.Thread(target=self.video_writing_worker, name='video_writer', daemon=True)
+            self._save_name = fname
+            worker = None
+            if self.encoder is not None:
+                if self.segment_pool:
+                    video_writer = SegmentedWriter(self.segment_pool, self.encoder, fname + self.file_name_ending,
+                                                   self.output_dimensions, CAMERA_FRAMERATE, self.is_color)
+                else:
+                    video_writer = create_encoder(self.encoder, fname + self.file_name_ending,
+                                                  self.output_dimensions, CAMERA_FRAMERATE, self.is_color,
+                                                  num_frames=max_frames)
+                # Create worker thread
+                self.frame_buffer = BoundedBuffer(RECORDER_BUFFER_SIZE, DROP_NEWEST, name='recorder_frames')
+                self.frame_pool.reset_stats()
+                worker = thr.Thread(target=self.video_writing_worker, name='video_writer', daemon=True,
+                                    args=(video_writer, self.frame_buffer, fname))
             # Let proc_handler know we're setup and wait until other processes are ready
             self.pipe.send(MSG_RECEIVED)
             self.exp_start_event.wait()
+            self._rec_start = time.perf_counter()
             self._recording = True
-            worker.start()
+            if worker:
+                worker.start()
         elif not record:
             self._ttl_num_frames = -1
+            self._stop_requested = True
 
     # Main thread
     def run(self):
@@ -130,6 +177,8 @@ class VideoRecorder(StoppableProcess):
             self.record_to_file()
             if self.stopped():
                 self.connected = False
+                if self._recording:
+                    self.finish_recording()
                 while True:
                     time.sleep(5.0 / 1000.0)
                     threads = [thread.name for thread in thr.enumerate()]
@@ -142,64 +191,46 @@ class VideoRecorder(StoppableProcess):
         if not self._recording:
             time.sleep(5.0 / 1000.0)
             return
-        if self.curr_frame <= self._ttl_num_frames:
-            if self.rec_sync.is_set():
-                frame = self.get_output_img()
-                self.frame_buffer.put_nowait(frame)
-                self.rec_sync.clear()
-                self.curr_frame += 1
-            else:
-                time.sleep(1.0 / 1000.0)
-        elif self.curr_frame > self._ttl_num_frames:
-            self._recording = False
-            self.curr_frame = 0
-            self.msg_proc_handler(cmd=MSG_VIDREC_SAVING)
-
-    def get_output_img(self):
-        """Gets output image to save"""
-        return self.image_array
-
-
-class CV2VideoRecorder(VideoRecorder):
-    """Has a view to a provided; records from them. Subclasses VideoRecorder"""
-    def __init__(self, name, is_color, file_name_ending, recording_sync, cv2gui, pathing, heatmap, gradient, progbar):
-        super(CV2VideoRecorder, self).__init__(name=name, is_color=is_color,
-                                               file_name_ending=file_name_ending,
-                                               recording_sync=recording_sync, mp_array=None)
-        self.output_dimensions = VID_DIM_RGB[1] + MAP_DIMS[1], VID_DIM_RGB[0] + GRADIENT_HEIGHT
-        # Shared MP arrays
-        self.cv2gui = cv2gui
-        self.pathing = pathing
-        self.heatmap = heatmap
-        self.gradient = gradient
-        self.progbar = progbar
-
-    # Initialize objects
-    def init_unpickleable_objs(self):
-        """Creates objects that must exist in the new process"""
-        # Numpy views of shared mp array
-        self.cv2gui = self.cv2gui.generate_np_array()
-        self.pathing = self.pathing.generate_np_array()
-        self.heatmap = self.heatmap.generate_np_array()
-        self.gradient = self.gradient.generate_np_array()
-        self.progbar = self.progbar.generate_np_array()
-        np_array_shape = self.output_dimensions[1], self.output_dimensions[0], 3
-        self.image = np.zeros(np_array_shape, dtype='uint8')
-        self.cv2gui_slice = self.image[:VID_DIM_RGB[0], MAP_DIMS[1]:np_array_shape[1], :]
-        self.pathing_slice = self.image[:MAP_DIMS[0], :MAP_DIMS[1], :]
-        self.heatmap_slice = self.image[MAP_DIMS[0]:VID_DIM_RGB[0], :MAP_DIMS[1], :]
-        self.gradient_slice = self.image[VID_DIM_RGB[0]:np_array_shape[0], :MAP_DIMS[1], :]
-        self.progbar_slice = self.image[VID_DIM_RGB[0]+1:np_array_shape[0]-1, MAP_DIMS[1]:np_array_shape[1], :]
-        # Msg parser
-        self.setup_msg_parser()
-        # Video buffers
-        self.frame_buffer = Queue.Queue()
-
-    # Main thread
-    def get_output_img(self):
-        self.heatmap_slice[:] = self.heatmap
-        self.pathing_slice[:] = self.pathing
-        self.cv2gui_slice[:] = self.cv2gui
-        self.gradient_slice[:] = self.gradient
-        self.progbar_slice[:] = self.progbar
-        return self.image[..., ::-1]
+        if self._stop_requested:
+            finished = True
+        elif self.stop_on_duration:
+            finished = time.perf_counter() - self._rec_start > self._duration
+        else:
+            finished = self.curr_frame > self._ttl_num_frames
+        if finished:
+            self.finish_recording()
+        elif self.rec_sync.is_set() and self.encoder is None:
+            self.rec_sync.clear()
+            self.curr_frame += 1
+        elif self.rec_sync.is_set():
+            # Frame is dropped if all pool buffers are still waiting to be written
+            frame = self.frame_pool.acquire()
+            if frame is not None:
+                frame_seq, capture_time = self.get_output_img(frame)
+                # Images without a camera frame are timed from when they were copied
+                if np.isnan(capture_time):
+                    capture_time = time.perf_counter()
+                if not self.frame_buffer.put_nowait((frame, frame_seq, capture_time - self._rec_start)):
+                    self.frame_pool.release(frame)
+            self.rec_sync.clear()
+            self.curr_frame += 1
+        else:
+            time.sleep(1.0 / 1000.0)
+
+    def finish_recording(self):
+        """Stops recording; the trial's worker finishes writing its buffered frames in the background"""
+        self._recording = False
+        self.curr_frame = 0
+        if self.encoder is not None:
+            self.frame_buffer.put(None, force=True)
+        self.msg_proc_handler(cmd=MSG_VIDREC_SAVING, val=self._save_name)
+        # Without a video there is nothing left to write
+        if self.encoder is None:
+            self.msg_proc_handler(cmd=MSG_VIDREC_FINISHED, val=self._save_name)
+
+    def get_output_img(self, output):
+        """Copies output image to save into output. Holds the array lock so the frame is not torn.
+        Returns the image's camera frame sequence number and capture time"""
+        with self.image_lock:
+            np.copyto(output, self.image_array)
+            return self.image_array.get_frame_info()
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+"""Decodes video files on a background thread, ahead of the frames being used, so decoding overlaps with
+processing the frames already decoded"""
+
+import sys
+import cv2
+import time
+import threading as thr
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Decoded frames kept ready
+PREFETCH_FRAMES = 30
+# Secs between checks for close() while the queue is full
+PUT_TIMEOUT = 0.1
+
+
+class PrefetchingDecoder(object):
+    """Decodes a video file from frame start on, on a worker thread, into a bounded queue of ready frames.
+    convert: applied to each decoded BGR frame on the worker thread (e.g. to take one channel).
+    Iterating yields frames until the end of the video; close() stops decoding early"""
+    def __init__(self, file, start=0, convert=None, queue_size=PREFETCH_FRAMES):
+        self.file = file
+        self.capture = cv2.VideoCapture(file)
+        if not self.capture.isOpened():
+            raise IOError('Could not open video: {}'.format(file))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.convert = convert
+        self.frames = Queue.Queue(maxsize=queue_size)
+        self.closing = thr.Event()
+        # Secs spent waiting for frames to be decoded; ~0 if decoding keeps ahead
+        self.waited_secs = 0.0
+        got = self.seek(int(start))
+        self.thread = thr.Thread(target=self.decode, args=(got,), name='prefetch', daemon=True)
+        self.thread.start()
+
+    def position(self):
+        return int(round(self.capture.get(cv2.CAP_PROP_POS_FRAMES)))
+
+    def seek(self, start):
+        """Leaves frame start grabbed, ready to be retrieved. Returns False if the video has no frame start.
+        The position reported after grabbing is that of the decoded frame, confirming where a seek landed; if it
+        landed elsewhere (e.g. on a keyframe), the video is reopened and frames are grabbed up to start instead"""
+        if start > 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        got = self.capture.grab()
+        if start == 0 or (got and self.position() == start + 1):
+            return got
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.file)
+        for _ in range(start + 1):
+            got = self.capture.grab()
+            if not got:
+                break
+        return got
+
+    def decode(self, got):
+        """Run on separate thread. Retrieves each grabbed frame and queues it; None marks the end of the video"""
+        while got and not self.closing.is_set():
+            _, frame = self.capture.retrieve()
+            if self.convert is not None:
+                frame = self.convert(frame)
+            if not self.put(frame):
+                break
+            got = self.capture.grab()
+        self.put(None)
+        self.capture.release()
+
+    def put(self, item):
+        """Waits for space in the queue. Returns False if closed meanwhile"""
+        while not self.closing.is_set():
+            try:
+                self.frames.put(item, timeout=PUT_TIMEOUT)
+            except Queue.Full:
+                continue
+            return True
+        return False
+
+    def __iter__(self):
+        while True:
+            try:
+                frame = self.frames.get_nowait()
+            except Queue.Empty:
+                waiting = time.perf_counter()
+                frame = self.frames.get()
+                self.waited_secs += time.perf_counter() - waiting
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        """Stops decoding and waits for the worker thread to exit. Frames not yet used are discarded"""
+        self.closing.set()
+        self.thread.join()
+        while not self.frames.empty():
+            self.frames.get_nowait()
+        # Ends any iteration still waiting for a frame
+        self.frames.put_nowait(None)
@@ -0,0 +1,106 @@
+# coding=utf-8
+
+"""Append-only write-ahead log of trial records, written during the trial so a crash does not lose the session"""
+
+import os
+import sys
+import json
+import time
+import struct
+import numpy as np
+import threading as thr
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Log file layout: magic, header length (uint32 LE), JSON header, then fixed size raw records
+LOG_MAGIC = b'MTWAL1\n'
+LOG_ENDING = '_Coords.wal'
+# Flush written records to the OS every FLUSH_INTERVAL secs; force them to disk every FSYNC_INTERVAL secs
+FLUSH_INTERVAL = 0.25
+FSYNC_INTERVAL = 2.0
+# Thread name
+COORDS_LOG = 'coords_log'
+
+
+class CoordsLogWriter(object):
+    """Writes records to the log from a background thread in batches, with periodic fsyncs"""
+    def __init__(self, file, dtype, metadata, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        self.file = file
+        self.dtype = np.dtype(dtype)
+        self.metadata = metadata
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.records = Queue.Queue()
+        self.thread = None
+        self._file = None
+
+    def start(self):
+        """Writes log header and starts the writer thread"""
+        header = json.dumps({'dtype': self.dtype.descr, 'metadata': self.metadata}, default=str).encode('utf-8')
+        self._file = open(self.file, 'wb')
+        self._file.write(LOG_MAGIC + struct.pack('<I', len(header)) + header)
+        self.sync(fsync=True)
+        self.thread = thr.Thread(target=self.log_writing_worker, name=COORDS_LOG, daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        """Queues a record (tuple of field values) to be written. Call from the main thread"""
+        self.records.put_nowait(record)
+
+    def close(self):
+        """Writes all queued records, syncs to disk and closes the log"""
+        if self.thread:
+            self.records.put_nowait(None)
+            self.thread.join()
+            self.thread = None
+
+    def sync(self, fsync):
+        """Flushes python buffers; optionally forces the OS to write to disk"""
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def log_writing_worker(self):
+        """a worker thread to write batches of records"""
+        last_fsync = time.perf_counter()
+        writing = True
+        while writing:
+            # Wait for a record, then take everything else that is already queued
+            batch = []
+            try:
+                batch.append(self.records.get(timeout=self.flush_interval))
+                while True:
+                    batch.append(self.records.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in batch:
+                writing = False
+                batch = batch[:batch.index(None)]
+            if batch:
+                self._file.write(np.array(batch, dtype=self.dtype).tobytes())
+            # Batched syncing
+            fsync = not writing or time.perf_counter() - last_fsync >= self.fsync_interval
+            self.sync(fsync=fsync)
+            if fsync:
+                last_fsync = time.perf_counter()
+        self._file.close()
+
+
+def read_coords_log(file):
+    """Reads a (possibly partial) log. Returns records and the metadata saved at trial start.
+    A partially written final record is discarded"""
+    with open(file, 'rb') as f:
+        contents = f.read()
+    if not contents.startswith(LOG_MAGIC):
+        raise ValueError('[{}] is not a coordinates log file!'.format(file))
+    start = len(LOG_MAGIC)
+    header_len = struct.unpack('<I', contents[start:start + 4])[0]
+    header = json.loads(contents[start + 4:start + 4 + header_len].decode('utf-8'))
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    body = contents[start + 4 + header_len:]
+    num_records = len(body) // dtype.itemsize
+    records = np.frombuffer(body[:num_records * dtype.itemsize], dtype=dtype).copy()
+    return records, header['metadata']
@@ -5,7 +5,7 @@
 import pickle
 from DirsSettings.Settings import MainSettings
 from Misc.CustomFunctions import format_daytime
-from Misc.GlobalVars import *
+from Misc.CoreVars import *
 
 
 class Directories(object):
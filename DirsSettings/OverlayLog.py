@@ -0,0 +1,47 @@
+# coding=utf-8
+
+"""Overlay events of a trial: what was drawn over the camera frames beyond the frames and coordinates themselves.
+Recorded when the CV2 video is rendered after the trial instead of encoded live; see Concurrency.OfflineRender"""
+
+import json
+import numpy as np
+
+
+OVERLAY_ENDING = '_Overlay.npz'
+
+
+class OverlayLog(object):
+    """Collects a trial's overlay events in memory; saved with the trial's other outputs.
+    state: drawing state of the CV2 process when the trial started; contrail: its latest tracked coords, newest first"""
+    def __init__(self, state, contrail):
+        self.initial = {'state': state, 'contrail': [list(coord) for coord in contrail]}
+        # (camera frame sequence number, changes), applied before drawing that frame
+        self.events = []
+        # Contour of the mouse tracked in each camera frame
+        self.frames = []
+        self.contours = []
+
+    def add_event(self, frame_seq, changes):
+        self.events.append((frame_seq, changes))
+
+    def add_contour(self, frame_seq, contour):
+        self.frames.append(frame_seq)
+        self.contours.append(contour)
+
+    def save(self, file):
+        """Contours are concatenated into one array of points, with the index of each frame's first point"""
+        lengths = [contour.shape[0] for contour in self.contours]
+        points = np.concatenate(self.contours) if self.contours else np.zeros((0, 2), dtype='int32')
+        events = json.dumps({'initial': self.initial, 'events': self.events}, default=float)
+        np.savez(file, frame=np.array(self.frames, dtype='int64'),
+                 contour_index=np.concatenate(([0], np.cumsum(lengths))).astype('int64'),
+                 contour_points=points.astype('int32'), events=np.array(events))
+
+
+def read_overlay_log(file):
+    """Initial state, events, and {camera frame: contour points} of a saved overlay log"""
+    with np.load(file) as log:
+        events = json.loads(str(log['events']))
+        index, points = log['contour_index'], log['contour_points']
+        contours = {int(frame_seq): points[index[i]:index[i + 1]] for i, frame_seq in enumerate(log['frame'])}
+    return events['initial'], events['events'], contours
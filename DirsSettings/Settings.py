@@ -4,7 +4,7 @@
 
 import sys
 import numpy as np
-from Misc.GlobalVars import *
+from Misc.CoreVars import *
 
 
 class MainSettings(object):
@@ -15,10 +15,41 @@ class MainSettings(object):
         self.ttl_time = 0.0
         # target area settings (areas that mouse will receive stimulation if within)
         self.target_area_radius = 30
+        self.extra_target_regions = []  # regions in addition to the target area; see Misc.TargetRegions
         self.last_targ_areas = None
         self.target_areas = {}
         self.last_quadrant = BOTTOMLEFT
         self.bounding_coords = DEFAULT_BOUNDS
+        # stimulation protocol; keys missing here take defaults from Concurrency.Protocols.DEFAULT_PROTOCOL
+        self.stim_protocol = {}
+        # analysis settings
+        self.summary_bin_width = 60.0  # in secs; width of time bins in _Summary.csv
+        # video encoder of each recorder; see Concurrency.Encoders
+        self.video_encoders = {PROC_CMR_VIDREC: 'xvid', PROC_CV2_VIDREC: 'xvid'}
+        # 'npy' recordings are compressed with this encoder after each trial; see Concurrency.Transcoder
+        self.transcode_encoder = 'xvid'
+        self.transcode_workers = 2
+        # encoder processes of each recorder, encoding segments in parallel (0 = encode on the recorder's own thread)
+        self.segment_workers = {PROC_CMR_VIDREC: 0, PROC_CV2_VIDREC: 0}
+        # stop recording videos once the trial duration has elapsed, rather than after duration x fps frames
+        self.record_wall_clock = False
+        # record only the raw video, coordinates and overlay events during trials; the CV2 video is rendered from them
+        # after each trial by a pool of render processes (see Concurrency.OfflineRender)
+        self.render_cv2_offline = False
+        self.render_workers = 2
+        # videos used instead of the camera are replayed at this multiple of their fps (0 = as fast as tracking allows)
+        self.video_source_speed = 1.0
+        # frame of those videos replaying starts from
+        self.video_source_start = 0
+        # hardware backends: 'pycapture2' or 'synthetic' camera (blobs moving over a noisy arena; see
+        # Concurrency.SyntheticSource), 'firmata' or 'simulated' arduino. Lets the pipeline run without hardware
+        self.camera_backend = 'pycapture2'
+        self.arduino_backend = 'firmata'
+
+    def __setstate__(self, state):
+        """Settings pickled by older versions may lack newer attributes; these keep their defaults"""
+        self.__init__()
+        self.__dict__.update(state)
 
     def load_examples(self):
         """Example settings for first time users"""
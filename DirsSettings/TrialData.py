@@ -0,0 +1,132 @@
+# coding=utf-8
+
+"""Layout of the per-frame data recorded during a trial"""
+
+import numpy as np
+from Misc.TargetRegions import MASK_DTYPE, region_bits
+
+
+# One record per tracked frame. Times are secs since trial start (unrounded)
+COORDS_DTYPE = np.dtype([('time', 'f8'), ('x', 'i4'), ('y', 'i4'),
+                         ('in_targ', '?'), ('num_entries', 'u4'), ('targ_time', 'f8'),
+                         ('get_stim', '?'), ('num_stims', 'u4'), ('stim_time', 'f8'),
+                         ('regions', MASK_DTYPE),  # bitmask of target regions the mouse is in
+                         ('frame', 'i8')])  # sequence number of the camera frame the coordinate was tracked in
+# Value of x, y in records where the mouse was not found
+NO_COORD = -1
+# Extra seconds of records allocated beyond the trial duration before the buffer needs to grow
+BUFFER_MARGIN_SECS = 30
+# _Coords.csv layout
+TARG_REGION_HEADER = ('Target Region X', 'Target Region Y', 'Target Region Radius', 'Normalized X', 'Normalized Y')
+COORDS_HEADER = ('Total Time Elapsed (s)', 'Mouse X', 'Mouse Y',
+                 'Mouse In Target', 'Num Entries', 'Time in Target (s)', 'Total Time in Target (s)',
+                 'Mouse Get Stim', 'Num Stimulations', 'Total Stim Time (s)')
+# Per region columns, appended when a trial has more than one target region
+REGION_HEADER = ('In Region {}', 'Region {} Entries', 'Region {} Time (s)', 'Region {} Stims')
+# Videos of a trial, named [trial][ending] by their recorders
+RAW_VIDEO_ENDING = '_RAW'
+CV2_VIDEO_ENDING = '_CV2'
+# One record per frame written to a video, saved by the recorder as [video]_Frames.npy. Capture time is secs since
+# the recorder started recording the trial; frame is the camera frame sequence number
+FRAME_DTYPE = np.dtype([('frame', 'i8'), ('capture_time', 'f8')])
+FRAME_RECORD_ENDING = '_Frames.npy'
+# Once the trial is saved, frame records are linked to coordinate records and written as [video]_Frames.csv
+FRAMES_ENDING = '_Frames.csv'
+FRAMES_HEADER = ('Video Frame', 'Camera Frame', 'Capture Time (s)', 'Coords Row')
+
+
+def time_in_target(num_entries, ttl_targ_time):
+    """Time spent in target since the latest entry, for each record. ttl_targ_time should be rounded to ms"""
+    num_records = num_entries.shape[0]
+    # Entry counts and total target times of the previous record (first record compares against 0)
+    prev_entries = np.concatenate(([0], num_entries[:-1]))
+    prev_ttl_time = np.concatenate(([0.0], ttl_targ_time[:-1]))
+    # For each record, find the latest record at which the entry count changed
+    changed_at = np.where(num_entries != prev_entries, np.arange(num_records), -1)
+    changed_at = np.maximum.accumulate(changed_at) if num_records else changed_at
+    entry_time = np.where(changed_at >= 0, prev_ttl_time[changed_at], 0.0)
+    return ttl_targ_time - entry_time
+
+
+def region_columns(times, regions, get_stim, region_num):
+    """In region, entries, total time in region and stimulations received in region, for each record"""
+    inside = region_bits(regions, region_num)
+    prev_inside = np.concatenate(([False], inside[:-1]))
+    prev_stim = np.concatenate(([False], get_stim[:-1]))
+    entries = np.cumsum(inside & ~prev_inside)
+    # Each interval between records counts towards the region the mouse was in at its start
+    intervals = np.diff(times, prepend=times[:1]) if times.size else times
+    region_time = np.cumsum(intervals * prev_inside)
+    stims = np.cumsum(get_stim & ~prev_stim & inside)
+    return inside, entries, region_time, stims
+
+
+def format_column(column):
+    """Formats a numeric/bool column into strings identical to str() of the python values"""
+    return list(map(str, column.tolist()))
+
+
+def format_coords_column(column):
+    """Formats a coordinate column; untracked records are written as None"""
+    return ['None' if value == NO_COORD else str(value) for value in column.tolist()]
+
+
+def write_coords_csv(file, targ_region, data, num_regions=1):
+    """Writes trial records to a _Coords.csv. Derived columns are computed vectorized and rows formatted in bulk
+    targ_region: values for TARG_REGION_HEADER; data: records with COORDS_DTYPE
+    num_regions: number of target regions; per region columns are added if more than one"""
+    ttl_time = np.round(data['time'], 3)
+    ttl_targ_time = np.round(data['targ_time'], 3)
+    ttl_stim_time = np.round(data['stim_time'], 3)
+    num_entries = data['num_entries'].astype('int64')
+    columns = (format_column(ttl_time), format_coords_column(data['x']), format_coords_column(data['y']),
+               format_column(data['in_targ']), format_column(num_entries),
+               format_column(time_in_target(num_entries, ttl_targ_time)), format_column(ttl_targ_time),
+               format_column(data['get_stim']), format_column(data['num_stims']), format_column(ttl_stim_time))
+    header = COORDS_HEADER
+    # Records from before regions were recorded have no regions field
+    if num_regions > 1 and 'regions' in data.dtype.names:
+        for region_num in range(num_regions):
+            inside, entries, region_time, stims = region_columns(data['time'], data['regions'], data['get_stim'],
+                                                                 region_num)
+            columns += (format_column(inside), format_column(entries),
+                        format_column(np.round(region_time, 3)), format_column(stims))
+            header += tuple(name.format(region_num) for name in REGION_HEADER)
+    with open(file, 'w') as f:
+        for line in (TARG_REGION_HEADER, targ_region, header):
+            f.write(''.join('{},'.format(element) for element in line))
+            f.write('\n')
+        f.writelines(['{},\n'.format(','.join(row)) for row in zip(*columns)])
+
+
+def coord_rows(frame_seqs, coord_frames):
+    """Index of the coordinate record tracked in each camera frame of frame_seqs; -1 where there is none"""
+    frame_seqs = np.asarray(frame_seqs, dtype='int64')
+    coord_frames = np.asarray(coord_frames, dtype='int64')
+    if not coord_frames.size:
+        return np.full(frame_seqs.shape, -1, dtype='int64')
+    order = np.argsort(coord_frames, kind='stable')
+    sorted_frames = coord_frames[order]
+    found = np.minimum(np.searchsorted(sorted_frames, frame_seqs), sorted_frames.size - 1)
+    matched = (sorted_frames[found] == frame_seqs) & (frame_seqs >= 0)
+    return np.where(matched, order[found], -1)
+
+
+def write_frames_csv(file, frames, rows):
+    """Writes a video's frame sidecar. frames: records with FRAME_DTYPE, in video order; rows: from coord_rows()
+    Coords Row is the index of the record in _Coords.csv (0 = first record after the header)"""
+    columns = (format_column(np.arange(frames.shape[0])), format_column(frames['frame']),
+               format_column(np.round(frames['capture_time'], 4)), format_column(rows))
+    with open(file, 'w') as f:
+        f.write(''.join('{},'.format(element) for element in FRAMES_HEADER))
+        f.write('\n')
+        f.writelines(['{},\n'.format(','.join(row)) for row in zip(*columns)])
+
+
+def read_frames_csv(file):
+    """Frame records (FRAME_DTYPE) and coords rows of a video's frame sidecar written by write_frames_csv()"""
+    table = np.loadtxt(file, delimiter=',', skiprows=1, usecols=(1, 2, 3), ndmin=2)
+    frames = np.empty(table.shape[0], dtype=FRAME_DTYPE)
+    frames['frame'] = table[:, 0]
+    frames['capture_time'] = table[:, 1]
+    return frames, table[:, 2].astype('int64')
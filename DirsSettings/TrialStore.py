@@ -0,0 +1,86 @@
+# coding=utf-8
+
+"""Columnar binary store of trial records: one typed .npy per column plus a JSON manifest"""
+
+import os
+import json
+import numpy as np
+
+
+# A trial saved as [NAME] is stored in the directory [NAME]_Store
+STORE_SUFFIX = '_Store'
+MANIFEST_FILE = 'manifest.json'
+STORE_VERSION = 1
+
+
+def save_trial_store(save_name, data, metadata):
+    """Saves each field of a structured record array as its own .npy, with a manifest describing them"""
+    directory = save_name + STORE_SUFFIX
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    columns = {}
+    for name in data.dtype.names:
+        np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(data[name]))
+        columns[name] = data.dtype[name].str
+    manifest = {
+        'version': STORE_VERSION,
+        'num_records': int(data.shape[0]),
+        'columns': columns,
+        'column_order': list(data.dtype.names),
+        'metadata': metadata
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+    return directory
+
+
+class TrialStore(object):
+    """Read access to a trial store. Columns are memory mapped on first access, so loading is near instant"""
+    def __init__(self, path):
+        # Accept either the store directory or the trial save name it was created from
+        if not os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            path = path + STORE_SUFFIX
+        self.path = path
+        with open(os.path.join(self.path, MANIFEST_FILE), 'r') as f:
+            manifest = json.load(f)
+        self.num_records = manifest['num_records']
+        self.column_order = manifest['column_order']
+        self.column_types = manifest['columns']
+        self.metadata = manifest['metadata']
+        self._columns = {}
+
+    def __len__(self):
+        return self.num_records
+
+    def __contains__(self, name):
+        return name in self.column_types
+
+    def __getitem__(self, name):
+        """Returns a read-only memory mapped column"""
+        if name not in self._columns:
+            if name not in self.column_types:
+                raise KeyError('[{}] is not a column of {}'.format(name, self.path))
+            self._columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def columns(self):
+        """Names of all stored columns, in original record order"""
+        return list(self.column_order)
+
+    def records(self):
+        """Reassembles all columns into a (in-memory) structured record array"""
+        dtype = np.dtype([(name, self.column_types[name]) for name in self.column_order])
+        records = np.empty(self.num_records, dtype=dtype)
+        for name in self.column_order:
+            records[name] = self[name]
+        return records
+
+
+def find_trial_stores(root_dir):
+    """Walks root_dir and returns a TrialStore for every trial store found, e.g. for batch analysis of sessions"""
+    stores = []
+    for directory, subdirs, files in os.walk(root_dir):
+        if directory.endswith(STORE_SUFFIX) and MANIFEST_FILE in files:
+            stores.append(TrialStore(directory))
+            subdirs[:] = []
+    return sorted(stores, key=lambda store: store.path)
@@ -5,9 +5,9 @@
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
 from Misc.GlobalVars import *
+from Misc.IPC import proc_handler_queue
 from DirsSettings.Settings import SingleTargetArea
 from Misc.CustomClasses import NewMessage
-from GUI.DataDisplays.SendRecvProtocols import PixmapWithArray
 
 
 # Custom Objects
@@ -78,10 +78,10 @@ class GuiInteractiveDisplay(qg.QGraphicsView):
     boundsSetSignal = qc.pyqtSignal(list)
     targLocSetSignal = qc.pyqtSignal(tuple)
 
-    def __init__(self, dirs, cv2_gui_mp_array, update_interval_ms):
+    def __init__(self, dirs):
         super(GuiInteractiveDisplay, self).__init__()
         self.dirs = dirs
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         # Tracking Boundaries
         self.creating_bounds = False
         self.bounding_coords = self.dirs.settings.bounding_coords
@@ -95,14 +95,13 @@ class GuiInteractiveDisplay(qg.QGraphicsView):
         self.setMaximumSize(642, 482)
         self.setHorizontalScrollBarPolicy(qc.Qt.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(qc.Qt.ScrollBarAlwaysOff)
-        # Init Objects and Timers
-        self.init_scene_objs(cv2_gui_mp_array)
-        self.init_update_timer(update_interval_ms)
+        # Init Objects
+        self.init_scene_objs()
 
-    def init_scene_objs(self, cv2_gui_mp_array):
+    def init_scene_objs(self):
         """Set up objects and add to scene"""
-        # Main Pixmap
-        self.cv2img = PixmapWithArray(self.scene, cv2_gui_mp_array)
+        # Main Pixmap; updated with the CV2 panel of the composite
+        self.cv2img = qg.QGraphicsPixmapItem(scene=self.scene)
         # Indicators
         self.targ_center_indicator = GuiTargetAreaIndicator(self.scene,
                                                             self.dirs.settings.last_targ_areas.areas[0])
@@ -116,12 +115,6 @@ class GuiInteractiveDisplay(qg.QGraphicsView):
         # Connect Signals
         self.connect_child_signals()
 
-    def init_update_timer(self, update_interval_ms):
-        """Refreshes camera display"""
-        timer = qc.QTimer(self)
-        timer.timeout.connect(self.cv2img.update_display)
-        timer.start(update_interval_ms)
-
     # pyqtSignal Handling
     def connect_child_signals(self):
         """Sets up internal signals. For the same signal, order of connection = order of calling when signal emits"""
@@ -141,6 +134,7 @@ class GuiInteractiveDisplay(qg.QGraphicsView):
             radius = self.dirs.settings.target_area_radius
             center = self.targ_center_indicator.x, self.targ_center_indicator.y
             self.msg_proch(cmd=CMD_TARG_DRAW, val=(center, radius))
+            self.msg_proch(cmd=CMD_TARG_REGIONS, val=self.dirs.settings.extra_target_regions)
         else:
             self.msg_proch(cmd=CMD_TARG_DRAW, val=None)
 
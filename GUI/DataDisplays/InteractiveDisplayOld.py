@@ -6,6 +6,7 @@ from collections import deque
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
 from Misc.GlobalVars import *
+from Misc.IPC import proc_handler_queue
 from Misc.CustomClasses import *
 from DirsSettings.Settings import SingleTargetArea
 from GUI.DataDisplays.SendRecvProtocols import PixmapWithArray
@@ -295,7 +296,7 @@ class GuiInteractiveDisplay(qg.QGraphicsView):
     def __init__(self, dirs, cv2_gui_mp_array, update_interval_ms):
         super(GuiInteractiveDisplay, self).__init__()
         self.dirs = dirs
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         # Tracking Boundaries
         self.creating_bounds = False
         self.bounding_coords = self.dirs.settings.bounding_coords
@@ -4,24 +4,36 @@
 
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
-from Misc.GlobalVars import VID_DIM
+from Concurrency.Compositor import PANELS, PANEL_SLICES, PANEL_CV2GUI, PANEL_PATHING, PANEL_HEATMAP, \
+    PANEL_GRADIENT, PANEL_PROGBAR
 from GUI.DataDisplays.InteractiveDisplay import GuiInteractiveDisplay
-from GUI.DataDisplays.SendRecvProtocols import LabelWithArray, PixmapWithArray
+from GUI.DataDisplays.SendRecvProtocols import CompositeReader
 
 
 class GuiProgressBarDisplay(qg.QGraphicsView):
     """Displays progress bar; progress bar generated in Coords processor"""
-    def __init__(self, mp_array, update_interval_ms):
+    def __init__(self, shape):
         super(GuiProgressBarDisplay, self).__init__()
         self.scene = qg.QGraphicsScene()
         self.setScene(self.scene)
-        self.pixmap = PixmapWithArray(self.scene, mp_array=mp_array)
-        shape = self.pixmap.np_array.shape
+        self.pixmap = qg.QGraphicsPixmapItem(scene=self.scene)
         self.setMinimumSize(shape[1]+2, shape[0]+2)
         self.setMaximumSize(shape[1]+2, shape[0]+2)
-        timer = qc.QTimer(self)
-        timer.timeout.connect(self.pixmap.update_display)
-        timer.start(update_interval_ms)
+
+
+def panel_shape(panel):
+    """Rows, cols of a panel of the composite"""
+    rows, cols = PANEL_SLICES[panel]
+    return rows.stop - (rows.start or 0), cols.stop - (cols.start or 0)
+
+
+def panel_label(panel):
+    """QLabel sized to fit panel"""
+    label = qg.QLabel()
+    rows, cols = panel_shape(panel)
+    label.setMinimumSize(cols, rows)
+    label.setMaximumSize(cols, rows)
+    return label
 
 
 class DataDisplays(qg.QGroupBox):
@@ -32,14 +44,27 @@ class DataDisplays(qg.QGroupBox):
         self.grid = qg.QGridLayout()
         self.setLayout(self.grid)
 
-    def render_widgets(self, cv2gui_mp_array, heatmap_mp_array,
-                       pathing_mp_array, gradient_mp_array, progbar_mp_array):
-        """Generate and add widgets to grid"""
-        self.cmr_disp = GuiInteractiveDisplay(self.dirs, cv2gui_mp_array, update_interval_ms=5)
-        pathing = LabelWithArray(pathing_mp_array, update_interval_ms=5)
-        heatmap = LabelWithArray(heatmap_mp_array, update_interval_ms=5)
-        gradient = LabelWithArray(gradient_mp_array, update_interval_ms=5)
-        progbar = GuiProgressBarDisplay(progbar_mp_array, update_interval_ms=5)
+    def render_widgets(self, composite_mp_array, dirty_flags):
+        """Generate and add widgets to grid. All displays are panels of the compositor's composite"""
+        self.cmr_disp = GuiInteractiveDisplay(self.dirs)
+        pathing = panel_label(PANEL_PATHING)
+        heatmap = panel_label(PANEL_HEATMAP)
+        gradient = panel_label(PANEL_GRADIENT)
+        progbar = GuiProgressBarDisplay(panel_shape(PANEL_PROGBAR))
+        # One timer updates all displays
+        self.composite = CompositeReader(composite_mp_array, dirty_flags)
+        displays = {
+            PANEL_CV2GUI: self.cmr_disp.cv2img.setPixmap,
+            PANEL_PATHING: pathing.setPixmap,
+            PANEL_HEATMAP: heatmap.setPixmap,
+            PANEL_GRADIENT: gradient.setPixmap,
+            PANEL_PROGBAR: progbar.pixmap.setPixmap
+        }
+        for index, panel in enumerate(PANELS):
+            self.composite.add_panel(index, PANEL_SLICES[panel], displays[panel])
+        timer = qc.QTimer(self)
+        timer.timeout.connect(self.composite.update_display)
+        timer.start(5)
         # Add to Grid
         self.grid.addWidget(pathing, 0, 0)
         self.grid.addWidget(heatmap, 1, 0)
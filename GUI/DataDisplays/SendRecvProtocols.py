@@ -1,57 +1,11 @@
 # coding=utf-8
 
-"""Simplifies the way images are sent between processes"""
+"""Qt displays of images sent between processes (see Misc.SharedArrays)"""
 
 import numpy as np
-import multiprocessing as mp
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
-
-
-class SyncableMPArray(object):
-    """Sharable MP Array with Built in Sync Event"""
-    def __init__(self, dims):
-        self.array = mp.Array('B', int(np.prod(dims)), lock=mp.Lock())
-        self.array_dims = dims
-        self.sync_event = mp.Event()
-        self.sync_event.clear()
-
-    def generate_np_array(self):
-        """Create an NP Array referencing self.mp_array"""
-        return SyncableNPArray(self)
-
-
-class SyncableNPArray(np.ndarray):
-    """Numpy array that references supplied mp_array"""
-    def __new__(cls, mp_array):
-        array = np.frombuffer(mp_array.array.get_obj(), dtype='uint8').reshape(mp_array.array_dims).view(cls)
-        array.array_dims = mp_array.array_dims
-        array.sync_event = mp_array.sync_event
-        return array
-
-    def __array_finalize__(self, array):
-        self.array_dims = getattr(array, 'array_dims', None)
-        self.sync_event = getattr(array, 'sync_event', None)
-
-    def send_img(self, data):
-        """Sends an image to the mp array"""
-        self[:] = data
-
-    def can_send_img(self):
-        """Report if receiving party is ready for new frame"""
-        return not self.sync_event.is_set()
-
-    def set_can_send_img(self):
-        """Set ready to receive to True"""
-        self.sync_event.clear()
-
-    def can_recv_img(self):
-        """report if image has been sent by sending party"""
-        return self.sync_event.is_set()
-
-    def set_can_recv_img(self):
-        """set img sent to True"""
-        self.sync_event.set()
+from Misc.SharedArrays import SyncableMPArray, SyncableNPArray
 
 
 class PixmapWithArray(qg.QGraphicsPixmapItem):
@@ -91,3 +45,32 @@ class LabelWithArray(qg.QLabel):
             img = qg.QImage(self.np_array.data, self.np_array.shape[1], self.np_array.shape[0], qg.QImage.Format_RGB888)
             self.setPixmap(qg.QPixmap.fromImage(img))
             self.np_array.set_can_send_img()
+
+
+class CompositeReader(object):
+    """Displays the panels of a shared BGR composite (see Concurrency.Compositor). Needs to be updated using external
+    timer; each panel's display function is given a new QPixmap only when that panel changed"""
+    def __init__(self, composite_mp_array, dirty_flags):
+        self.np_array = composite_mp_array.generate_np_array()
+        self.lock = composite_mp_array.array.get_lock()
+        self.dirty_flags = dirty_flags
+        self.panels = []
+
+    def add_panel(self, index, panel_slice, display):
+        """display(QPixmap) is called with the region panel_slice of the composite whenever flag index is set"""
+        self.panels.append((index, panel_slice, display))
+
+    def update_display(self):
+        """Update all changed panels"""
+        if not self.np_array.can_recv_img():
+            return
+        images = []
+        with self.lock:
+            self.np_array.set_can_send_img()
+            for index, panel_slice, display in self.panels:
+                if self.dirty_flags[index]:
+                    self.dirty_flags[index] = 0
+                    images.append((display, np.ascontiguousarray(self.np_array[panel_slice][..., ::-1])))
+        for display, rgb in images:
+            img = qg.QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0], qg.QImage.Format_RGB888)
+            display(qg.QPixmap.fromImage(img))
@@ -9,6 +9,7 @@ import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
 from GUI.MiscWidgets import *
 from Misc.GlobalVars import *
+from Misc.IPC import proc_handler_queue
 from Misc.CustomFunctions import format_secs
 from Misc.CustomClasses import NewMessage
 from DirsSettings.Settings import TargetAreas
@@ -103,7 +104,7 @@ class GuiTargetAreaConfigs(qg.QGroupBox):
     def __init__(self, dirs):
         super(GuiTargetAreaConfigs, self).__init__('Mouse Target Region')
         self.dirs = dirs
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         self.grid = qg.QGridLayout()
         self.setLayout(self.grid)
         self.init_radius_widget()
@@ -203,7 +204,7 @@ class GuiStartStopControls(qg.QGroupBox):
     def __init__(self, dirs):
         super(GuiStartStopControls, self).__init__('Experiment Controls')
         self.dirs = dirs
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         self.grid = qg.QGridLayout()
         self.setLayout(self.grid)
         self.render_set_time()
@@ -358,7 +359,7 @@ class GuiVideoOperations(qg.QWidget):
         super(GuiVideoOperations, self).__init__()
         self.dirs = dirs
         self.is_enabled = True
-        self.output_msgs = PROC_HANDLER_QUEUE
+        self.output_msgs = proc_handler_queue()
         self.init_btns()
 
     def set_enabled(self, enable):
@@ -4,15 +4,24 @@
 
 import sys
 import time
+import multiprocessing as mp
 from DirsSettings.Directories import Directories
 from Concurrency.CV2Proc import CV2Processor
 from Concurrency.CmrProc import CameraHandler
 from Concurrency.CoordsProc import CoordinateProcessor
+from Concurrency.Compositor import Compositor, PANEL_CV2GUI, PANEL_PATHING, PANEL_HEATMAP, PANEL_GRADIENT, \
+    PANEL_PROGBAR
 from Concurrency.MainHandler import ProcessHandler
-from Concurrency.VidRecProc import VideoRecorder, CV2VideoRecorder
+from Concurrency.VidRecProc import VideoRecorder
+from Concurrency.Transcoder import TranscoderPool
+from Concurrency.SegmentedEncoding import SegmentPool
+from Concurrency.OfflineRender import RenderPool
+from Concurrency.Encoders import ENCODERS
+from DirsSettings.TrialData import RAW_VIDEO_ENDING, CV2_VIDEO_ENDING
 from GUI.DataDisplays.MainContainer import DataDisplays
 from GUI.UserControls.ExpControls import GuiVideoOperations, GuiMainControls
 from Misc.GlobalVars import *
+from Misc.IPC import proc_handler_queue, master_dump_queue
 from Misc.CustomClasses import NewMessage, ReadMessage
 from Misc.CustomFunctions import clear_console
 import queue as Queue
@@ -26,9 +35,20 @@ class MasterGui(qg.QWidget):
         self.setWindowTitle('Mouse Tracking')
         self.setWindowIcon(qg.QIcon('favicon.ico'))
         # Concurrency
-        self.proc_handler_queue = PROC_HANDLER_QUEUE
-        self.master_dump_queue = MASTER_DUMP_QUEUE
+        self.proc_handler_queue = proc_handler_queue()
+        self.master_dump_queue = master_dump_queue()
         self.create_processes()
+        # Compresses unencoded recordings after each trial; started on the first one, see transcode().
+        # Pool processes can't be children of daemonic processes
+        self.transcoder = None
+        # Renders the CV2 video of each saved trial, if it is not encoded live
+        self.renderer = None
+        if self.dirs.settings.render_cv2_offline:
+            encoder = self.dirs.settings.video_encoders[PROC_CV2_VIDREC]
+            # Rendered frames are encoded directly; there is nothing to transcode
+            if ENCODERS[encoder].TRANSCODE:
+                encoder = self.dirs.settings.transcode_encoder
+            self.renderer = RenderPool(self.dirs.settings.render_workers, encoder)
         self.create_msg_parser()
         self.set_msg_polling_timer()
         # Layout and Signals
@@ -37,6 +57,8 @@ class MasterGui(qg.QWidget):
         self.initialize_widgets()
         # Experiment Running?
         self.exp_running = False
+        # Trials that finished recording but are still saving files in the background
+        self.saving_trials = set()
         # Can we exit program safely?
         self.ready_to_exit = False
         # Finalize
@@ -48,28 +70,46 @@ class MasterGui(qg.QWidget):
 
     def create_processes(self):
         """Generate child processes that take over various backend tasks"""
-        self.cv2_proc = CV2Processor(saved_bounds=self.dirs.settings.bounding_coords)
-        self.cmr_proc = CameraHandler(self.cv2_proc.cmrcv2_mp_array)
+        render_offline = self.dirs.settings.render_cv2_offline
+        self.cv2_proc = CV2Processor(saved_bounds=self.dirs.settings.bounding_coords, log_overlay=render_offline)
+        self.cmr_proc = CameraHandler(self.cv2_proc.cmrcv2_mp_array, self.dirs.settings.video_source_speed,
+                                      self.dirs.settings.video_source_start, self.dirs.settings.camera_backend)
         self.coord_proc = CoordinateProcessor(self.cv2_proc.coords_output_queue,
-                                              self.dirs.settings.ttl_time)
+                                              self.dirs.settings.ttl_time,
+                                              self.dirs.settings.summary_bin_width,
+                                              self.dirs.settings.stim_protocol,
+                                              self.dirs.settings.arduino_backend)
+        self.segment_pools = []
         self.cmr_vidrec_proc = VideoRecorder(name=PROC_CMR_VIDREC, is_color=False,
-                                             file_name_ending='_RAW.avi',
+                                             file_name_ending=RAW_VIDEO_ENDING,
+                                             encoder=self.dirs.settings.video_encoders[PROC_CMR_VIDREC],
+                                             segment_pool=self.create_segment_pool(PROC_CMR_VIDREC,
+                                                                                   self.cmr_proc.cmr_cv2_mp_array),
+                                             stop_on_duration=self.dirs.settings.record_wall_clock,
                                              mp_array=self.cmr_proc.cmr_cv2_mp_array,
                                              recording_sync=self.cmr_proc.rec_to_file_sync_event)
-        self.cv2_vidrec_proc = CV2VideoRecorder(name=PROC_CV2_VIDREC, is_color=True,
-                                                file_name_ending='_CV2.avi',
-                                                recording_sync=self.cv2_proc.rec_to_file_sync_event,
-                                                pathing=self.coord_proc.pathing.mp_array,
-                                                heatmap=self.coord_proc.heatmap.mp_array,
-                                                gradient=self.coord_proc.gradient.mp_array,
-                                                progbar=self.coord_proc.progbar.mp_array,
-                                                cv2gui=self.cv2_proc.cv2gui_mp_array)
+        self.compositor_proc = Compositor({PANEL_CV2GUI: self.cv2_proc.cv2gui_mp_array,
+                                           PANEL_PATHING: self.coord_proc.pathing.mp_array,
+                                           PANEL_HEATMAP: self.coord_proc.heatmap.mp_array,
+                                           PANEL_GRADIENT: self.coord_proc.gradient.mp_array,
+                                           PANEL_PROGBAR: self.coord_proc.progbar.mp_array})
+        # Rendered offline, the CV2 video is not encoded live
+        cv2_encoder = None if render_offline else self.dirs.settings.video_encoders[PROC_CV2_VIDREC]
+        self.cv2_vidrec_proc = VideoRecorder(name=PROC_CV2_VIDREC, is_color=True,
+                                             file_name_ending=CV2_VIDEO_ENDING,
+                                             encoder=cv2_encoder,
+                                             segment_pool=None if render_offline else self.create_segment_pool(
+                                                 PROC_CV2_VIDREC, self.compositor_proc.composite_mp_array),
+                                             stop_on_duration=self.dirs.settings.record_wall_clock,
+                                             mp_array=self.compositor_proc.composite_mp_array,
+                                             recording_sync=self.compositor_proc.rec_to_file_sync_event)
         # Main handler for children
         self.proc_handler = ProcessHandler(self.cmr_proc.input_msgs,
                                            self.cv2_proc.input_msgs,
                                            self.coord_proc.input_msgs,
                                            self.cmr_vidrec_proc.input_msgs,
                                            self.cv2_vidrec_proc.input_msgs,
+                                           self.compositor_proc.input_msgs,
                                            # Message receipt pipes
                                            self.coord_proc.parent_pipe,
                                            self.cmr_vidrec_proc.parent_pipe,
@@ -78,10 +118,22 @@ class MasterGui(qg.QWidget):
         self.cmr_proc.start()
         self.cv2_proc.start()
         self.coord_proc.start()
+        self.compositor_proc.start()
         self.cmr_vidrec_proc.start()
         self.cv2_vidrec_proc.start()
         self.proc_handler.start()
 
+    def create_segment_pool(self, recorder, mp_array):
+        """Starts encoder processes for recorder if set to encode in parallel segments. Created here, as
+        processes can't be children of (daemonic) recorder processes"""
+        workers = self.dirs.settings.segment_workers.get(recorder, 0)
+        if not workers:
+            return None
+        pool = SegmentPool(mp_array.array_dims, workers)
+        pool.start()
+        self.segment_pools.append(pool)
+        return pool
+
     def render_widgets(self):
         """Add widgets to main window"""
         # Grid
@@ -89,11 +141,8 @@ class MasterGui(qg.QWidget):
         self.setLayout(self.grid)
         # Widgets
         self.data_displays = DataDisplays(self.dirs)
-        self.data_displays.render_widgets(cv2gui_mp_array=self.cv2_proc.cv2gui_mp_array,
-                                          heatmap_mp_array=self.coord_proc.heatmap.mp_array,
-                                          pathing_mp_array=self.coord_proc.pathing.mp_array,
-                                          gradient_mp_array=self.coord_proc.gradient.mp_array,
-                                          progbar_mp_array=self.coord_proc.progbar.mp_array)
+        self.data_displays.render_widgets(composite_mp_array=self.compositor_proc.composite_mp_array,
+                                          dirty_flags=self.compositor_proc.dirty_flags)
         self.vid_cntrls = GuiVideoOperations(self.dirs)
         self.exp_cntrls = GuiMainControls(self.dirs)
         # Connect Signals
@@ -163,24 +212,28 @@ class MasterGui(qg.QWidget):
         self.exp_cntrls.curr_exp_config.start_btn.setEnabled(True)
         self.exp_cntrls.curr_exp_config.start_btn.toggle_state('STOP')
 
-    def experiment_finished(self, saving):
-        """This runs when the experiment is finished"""
-        # output files/videos are still finishing saving
-        if saving:
-            self.exp_cntrls.curr_exp_config.start_btn.setEnabled(False)
-            self.exp_cntrls.curr_exp_config.start_btn.toggle_state('SAVING_VIDEOS')
-        else:
-            self.vid_cntrls.bounds_frm.setEnabled(True)
-            self.vid_cntrls.vidsrc_frm.setEnabled(True)
-            self.vid_cntrls.recalib_frm.setEnabled(True)
-            self.data_displays.cmr_disp.setEnabled(True)
-            self.exp_cntrls.targ_area_config.setEnabled(True)
-            self.data_displays.cmr_disp.targ_center_indicator.show()
-            self.exp_cntrls.curr_exp_config.name_entry.setEnabled(True)
-            self.exp_cntrls.curr_exp_config.start_btn.setEnabled(True)
-            self.exp_cntrls.curr_exp_config.start_btn.toggle_state('START')
-            self.exp_running = False
-            print('Finished Experiment')
+    def experiment_finished(self, trial):
+        """This runs when the experiment is finished recording. Output files/videos are still finishing
+        saving in the background, but we can already start the next trial"""
+        self.saving_trials.add(trial)
+        self.vid_cntrls.bounds_frm.setEnabled(True)
+        self.vid_cntrls.vidsrc_frm.setEnabled(True)
+        self.vid_cntrls.recalib_frm.setEnabled(True)
+        self.data_displays.cmr_disp.setEnabled(True)
+        self.exp_cntrls.targ_area_config.setEnabled(True)
+        self.data_displays.cmr_disp.targ_center_indicator.show()
+        self.exp_cntrls.curr_exp_config.name_entry.setEnabled(True)
+        self.exp_cntrls.curr_exp_config.start_btn.setEnabled(True)
+        self.exp_cntrls.curr_exp_config.start_btn.toggle_state('START')
+        self.exp_running = False
+        print('Finished Experiment')
+
+    def trial_saved(self, trial):
+        """This runs when all output files of a trial have been saved"""
+        self.saving_trials.discard(trial)
+        print('Finished Saving Files for {}'.format(trial))
+        if self.renderer:
+            self.renderer.submit(trial)
 
     # Communication with proc handler
     def send_message(self, dev=None, cmd=None, val=None):
@@ -196,15 +249,22 @@ class MasterGui(qg.QWidget):
             pass
         else:
             msg = ReadMessage(msg)
-            self.msg_parser[msg.command]()
+            self.msg_parser[msg.command](msg.value)
 
     def create_msg_parser(self):
         self.msg_parser = {
-            MSG_STARTED: self.experiment_started,
-            MSG_VIDREC_SAVING: lambda: self.experiment_finished(saving=True),
-            MSG_VIDREC_FINISHED: lambda: self.experiment_finished(saving=False),
+            MSG_STARTED: lambda val: self.experiment_started(),
+            MSG_VIDREC_SAVING: lambda trial: self.experiment_finished(trial),
+            MSG_VIDREC_FINISHED: lambda trial: self.trial_saved(trial),
+            MSG_TRANSCODE: lambda file: self.transcode(file),
         }
 
+    def transcode(self, file):
+        if self.transcoder is None:
+            self.transcoder = TranscoderPool(self.dirs.settings.transcode_workers,
+                                             self.dirs.settings.transcode_encoder)
+        self.transcoder.submit(file)
+
     def set_msg_polling_timer(self):
         """Create a GUI timer that periodically checks for new messages from queue"""
         timer = qc.QTimer(self)
@@ -238,8 +298,24 @@ class MasterGui(qg.QWidget):
         if self.exp_running:
             qg.QMessageBox.warning(self, 'Warning!', 'Cannot Close While Experiment is Running!', qg.QMessageBox.Close)
             return
+        elif self.saving_trials:
+            qg.QMessageBox.warning(self, 'Warning!', 'Cannot Close While Trials are Still Saving!',
+                                   qg.QMessageBox.Close)
+            return
+        elif self.transcoder and self.transcoder.pending:
+            qg.QMessageBox.warning(self, 'Warning!', 'Cannot Close While Videos are Transcoding!', qg.QMessageBox.Close)
+            return
+        elif self.renderer and self.renderer.pending:
+            qg.QMessageBox.warning(self, 'Warning!', 'Cannot Close While Videos are Rendering!', qg.QMessageBox.Close)
+            return
         else:
             self.send_message(cmd=CMD_EXIT)
+            if self.transcoder:
+                self.transcoder.close()
+            if self.renderer:
+                self.renderer.close()
+            for pool in self.segment_pools:
+                pool.close()
             print('---------------------------------------------')
             start_time = time.perf_counter()
             while not (len(mp.active_children()) == 0) and not (time.perf_counter()-start_time > 5):
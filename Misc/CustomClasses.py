@@ -2,9 +2,26 @@
 
 """Usefl reimplementations of many classes"""
 
+import sys
 import time
 import numpy as np
+import threading as thr
 import multiprocessing as mp
+from collections import deque
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Policies of bounded buffers when full
+BLOCK = 'block'  # wait for space
+DROP_OLDEST = 'drop_oldest'  # discard the oldest item to make space
+DROP_NEWEST = 'drop_newest'  # discard the item being added
+BUFFER_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+# Buffer stats, as saved with each trial
+BUFFER_STATS_HEADER = ('Process', 'Buffer', 'Policy', 'Capacity', 'Items In', 'Dropped', 'High Water', 'Depth',
+                       'Blocked (s)')
 
 
 class StoppableProcess(mp.Process):
@@ -75,3 +92,226 @@ def NewMessage(dev=None, cmd=None, val=None):
 def ReadMessage(process_message_tuple):
     """Converts a packaged ProcessMessage tuple into a ProcessMessage object"""
     return ProcessMessage(*process_message_tuple)
+
+
+# Data Containers
+class RecordBuffer(object):
+    """Preallocated structured numpy array of records; grows in chunks if capacity is exceeded.
+    Once max_capacity records are held, further records are dropped (and counted)"""
+    def __init__(self, dtype, capacity, chunk_size, max_capacity=None, name='records'):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = int(chunk_size)
+        self.max_capacity = max_capacity
+        self.name = name
+        self.array = np.zeros(int(capacity), dtype=self.dtype)
+        self.size = 0
+        self.drops = 0
+
+    def __len__(self):
+        return self.size
+
+    def reset(self, capacity=None, max_capacity=None):
+        """Empties buffer; reallocates if a larger capacity is requested"""
+        if capacity and int(capacity) > self.array.shape[0]:
+            self.array = np.zeros(int(capacity), dtype=self.dtype)
+        if max_capacity:
+            self.max_capacity = int(max_capacity)
+        self.size = 0
+        self.drops = 0
+
+    def append(self, *fields):
+        """Writes one record into the next free row. Returns False if the record was dropped"""
+        if self.size >= self.array.shape[0]:
+            if self.max_capacity and self.size >= self.max_capacity:
+                self.drops += 1
+                return False
+            self.grow()
+        self.array[self.size] = fields
+        self.size += 1
+        return True
+
+    def grow(self):
+        """Extends capacity by one chunk (up to max_capacity), keeping existing records"""
+        capacity = self.array.shape[0] + self.chunk_size
+        if self.max_capacity:
+            capacity = min(capacity, self.max_capacity)
+        grown = np.zeros(capacity, dtype=self.dtype)
+        grown[:self.size] = self.array[:self.size]
+        self.array = grown
+
+    @property
+    def data(self):
+        """View of all records written so far"""
+        return self.array[:self.size]
+
+    def stats(self):
+        """Counters for BUFFER_STATS_HEADER. Records are never removed, so depth is the high water mark"""
+        return (self.name, DROP_NEWEST, self.max_capacity, self.size + self.drops, self.drops, self.size, self.size,
+                0.0)
+
+
+class BoundedBuffer(object):
+    """Thread safe FIFO holding at most maxsize items, with a policy for when it is full.
+    Counts items put, drops, the high water mark of its depth and time spent blocked"""
+    def __init__(self, maxsize, policy=BLOCK, name='buffer'):
+        if policy not in BUFFER_POLICIES:
+            raise ValueError('[{}] is not a valid buffer policy!'.format(policy))
+        self.maxsize = int(maxsize)
+        self.policy = policy
+        self.name = name
+        self.items = deque()
+        self.cond = thr.Condition()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.items)
+
+    def reset_stats(self):
+        with self.cond:
+            self.puts = 0
+            self.drops = 0
+            self.high_water = len(self.items)
+            self.blocked_secs = 0.0
+
+    def put(self, item, force=False):
+        """Adds item, applying the policy if full. force adds even if full (e.g. end of stream markers).
+        Returns False if an item was dropped"""
+        with self.cond:
+            self.puts += 1
+            dropped = False
+            if not force and len(self.items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.drops += 1
+                    return False
+                elif self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.drops += 1
+                    dropped = True
+                else:
+                    blocked = time.perf_counter()
+                    while len(self.items) >= self.maxsize:
+                        self.cond.wait()
+                    self.blocked_secs += time.perf_counter() - blocked
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.cond.notify_all()
+            return not dropped
+
+    def put_nowait(self, item):
+        """Same as put; a full buffer never raises, it applies the policy instead"""
+        return self.put(item)
+
+    def get(self, timeout=None):
+        """Removes and returns the oldest item. Raises Queue.Empty if none arrives within timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout):
+                raise Queue.Empty
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def stats(self):
+        """Counters for BUFFER_STATS_HEADER"""
+        with self.cond:
+            return (self.name, self.policy, self.maxsize, self.puts, self.drops, self.high_water, len(self.items),
+                    round(self.blocked_secs, 4))
+
+
+class FramePool(object):
+    """Fixed set of preallocated frame buffers. Buffers are acquired, filled, and released once consumed.
+    When every buffer is in use, acquire returns None (and counts a drop) rather than allocating"""
+    def __init__(self, shape, dtype, size, name='frame_pool'):
+        self.name = name
+        self.size = int(size)
+        self.free = deque(np.zeros(shape, dtype=dtype) for _ in range(self.size))
+        self.lock = thr.Lock()
+        self.acquires = 0
+        self.drops = 0
+        self.high_water = 0
+
+    def acquire(self):
+        """Returns a free buffer (contents are stale), or None if the pool is exhausted"""
+        with self.lock:
+            self.acquires += 1
+            if not self.free:
+                self.drops += 1
+                return None
+            buffer = self.free.popleft()
+            self.high_water = max(self.high_water, self.size - len(self.free))
+            return buffer
+
+    def release(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
+
+    def reset_stats(self):
+        with self.lock:
+            self.acquires = 0
+            self.drops = 0
+            self.high_water = self.size - len(self.free)
+
+    def stats(self):
+        """Counters for BUFFER_STATS_HEADER; depth is the number of buffers in use"""
+        with self.lock:
+            return (self.name, DROP_NEWEST, self.size, self.acquires, self.drops, self.high_water,
+                    self.size - len(self.free), 0.0)
+
+
+class FrameRing(object):
+    """Preallocated ring of frames, written by one thread and read by another, each frame with a tuple of tags.
+    When every frame is unread, the oldest is overwritten (and counted as skipped) rather than blocking the writer"""
+    def __init__(self, shape, dtype, size, name='frame_ring'):
+        self.name = name
+        self.size = int(size)
+        self.frames = np.zeros((self.size,) + tuple(shape), dtype=dtype)
+        self.tags = [None] * self.size
+        self.cond = thr.Condition()
+        # Frames written and read so far; slot of frame n is n % size
+        self.written = 0
+        self.read_count = 0
+        self.reset_stats()
+
+    def __len__(self):
+        return self.written - self.read_count
+
+    def write(self, frame, tags):
+        """Copies frame into the next slot. Returns False if an unread frame was overwritten"""
+        with self.cond:
+            skipped = len(self) >= self.size
+            if skipped:
+                self.read_count += 1
+                self.skips += 1
+            slot = self.written % self.size
+            self.frames[slot] = frame
+            self.tags[slot] = tags
+            self.written += 1
+            self.writes += 1
+            self.high_water = max(self.high_water, len(self))
+            self.cond.notify_all()
+            return not skipped
+
+    def read(self, out, timeout=None):
+        """Copies the oldest unread frame into out and returns its tags; None if none arrives within timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self), timeout):
+                return None
+            slot = self.read_count % self.size
+            out[:] = self.frames[slot]
+            self.read_count += 1
+            return self.tags[slot]
+
+    def clear(self):
+        """Discards unread frames, without counting them as skipped"""
+        with self.cond:
+            self.read_count = self.written
+
+    def reset_stats(self):
+        with self.cond:
+            self.writes = 0
+            self.skips = 0
+            self.high_water = len(self)
+
+    def stats(self):
+        """Counters for BUFFER_STATS_HEADER"""
+        with self.cond:
+            return self.name, DROP_OLDEST, self.size, self.writes, self.skips, self.high_water, len(self), 0.0
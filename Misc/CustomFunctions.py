@@ -4,7 +4,7 @@
 
 import os
 from datetime import datetime
-from Misc.GlobalVars import *
+from Misc.CoreVars import *
 
 
 def format_secs(time_in_secs, option='norm'):
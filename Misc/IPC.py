@@ -0,0 +1,34 @@
+# coding=utf-8
+
+"""Queues and events shared by all processes. Each is created on first use rather than on import, so processes
+importing the modules that use them do not each create their own. Get them in the process that starts the others
+(the GUI), before starting them; child processes receive them with the objects they are passed to"""
+
+import threading as thr
+import multiprocessing as mp
+
+
+_channels = {}
+_lock = thr.Lock()
+
+
+def _channel(name, create):
+    with _lock:
+        if name not in _channels:
+            _channels[name] = create()
+        return _channels[name]
+
+
+def master_dump_queue():
+    """Messages from the process handler to the GUI"""
+    return _channel('master_dump_queue', mp.Queue)
+
+
+def proc_handler_queue():
+    """Messages from the GUI and all processes to the process handler"""
+    return _channel('proc_handler_queue', mp.Queue)
+
+
+def exp_start_event():
+    """Set once every process has confirmed the start of a trial"""
+    return _channel('exp_start_event', mp.Event)
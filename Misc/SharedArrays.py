@@ -0,0 +1,65 @@
+# coding=utf-8
+
+"""Images shared between processes. Free of Qt, so processes and headless tools can use them; Qt displays of them
+are in GUI.DataDisplays.SendRecvProtocols"""
+
+import numpy as np
+import multiprocessing as mp
+
+
+class SyncableMPArray(object):
+    """Sharable MP Array with Built in Sync Event"""
+    def __init__(self, dims):
+        self.array = mp.Array('B', int(np.prod(dims)), lock=mp.Lock())
+        self.array_dims = dims
+        self.sync_event = mp.Event()
+        self.sync_event.clear()
+        # Camera frame sequence number and capture time (time.perf_counter()) of the image
+        self.frame_info = mp.Array('d', (-1, float('nan')), lock=False)
+
+    def generate_np_array(self):
+        """Create an NP Array referencing self.mp_array"""
+        return SyncableNPArray(self)
+
+
+class SyncableNPArray(np.ndarray):
+    """Numpy array that references supplied mp_array"""
+    def __new__(cls, mp_array):
+        array = np.frombuffer(mp_array.array.get_obj(), dtype='uint8').reshape(mp_array.array_dims).view(cls)
+        array.array_dims = mp_array.array_dims
+        array.sync_event = mp_array.sync_event
+        array.frame_info = mp_array.frame_info
+        return array
+
+    def __array_finalize__(self, array):
+        self.array_dims = getattr(array, 'array_dims', None)
+        self.sync_event = getattr(array, 'sync_event', None)
+        self.frame_info = getattr(array, 'frame_info', None)
+
+    def send_img(self, data):
+        """Sends an image to the mp array"""
+        self[:] = data
+
+    def set_frame_info(self, seq, timestamp):
+        """Sets camera frame sequence number and capture time of the image; set before set_can_recv_img()"""
+        self.frame_info[0], self.frame_info[1] = seq, timestamp
+
+    def get_frame_info(self):
+        """Camera frame sequence number (-1 if unknown) and capture time of the image"""
+        return int(self.frame_info[0]), self.frame_info[1]
+
+    def can_send_img(self):
+        """Report if receiving party is ready for new frame"""
+        return not self.sync_event.is_set()
+
+    def set_can_send_img(self):
+        """Set ready to receive to True"""
+        self.sync_event.clear()
+
+    def can_recv_img(self):
+        """report if image has been sent by sending party"""
+        return self.sync_event.is_set()
+
+    def set_can_recv_img(self):
+        """set img sent to True"""
+        self.sync_event.set()
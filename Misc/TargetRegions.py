@@ -0,0 +1,79 @@
+# coding=utf-8
+
+"""Target region shapes and a rasterised membership mask, so checking which regions contain a point is one lookup"""
+
+import cv2
+import numpy as np
+
+
+# Region shapes. A region is a tuple of (shape, params):
+# (REGION_CIRCLE, (cx, cy, radius)), (REGION_RECT, (x1, y1, x2, y2)), (REGION_POLYGON, ((x, y), (x, y), ...))
+REGION_CIRCLE = 'circle'
+REGION_RECT = 'rect'
+REGION_POLYGON = 'polygon'
+# Membership of each pixel is stored as a bitmask; bit i set = inside region i
+MASK_DTYPE = np.dtype('uint16')
+MAX_REGIONS = MASK_DTYPE.itemsize * 8
+
+
+def as_region(region):
+    """Region as hashable tuples, e.g. from lists loaded from JSON"""
+    shape, params = region
+    if shape == REGION_POLYGON:
+        return shape, tuple(tuple(point) for point in params)
+    return shape, tuple(params)
+
+
+def draw_region(img, region, color, thickness):
+    """Draws region onto img with cv2. A negative thickness fills the region"""
+    shape, params = region
+    if shape == REGION_CIRCLE:
+        cx, cy, radius = params
+        cv2.circle(img, (int(cx), int(cy)), int(radius), color, thickness)
+    elif shape == REGION_RECT:
+        x1, y1, x2, y2 = params
+        cv2.rectangle(img, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+    elif shape == REGION_POLYGON:
+        points = np.array(params, dtype='int32').reshape((-1, 1, 2))
+        if thickness < 0:
+            cv2.fillPoly(img, [points], color)
+        else:
+            cv2.polylines(img, [points], True, color, thickness)
+    else:
+        raise ValueError('[{}] is not a valid region shape!'.format(shape))
+
+
+def rasterise_regions(regions, dims):
+    """Returns a (rows, cols) bitmask array; bit i of a pixel is set if the pixel is inside regions[i]"""
+    if len(regions) > MAX_REGIONS:
+        raise ValueError('At most {} target regions are supported, got {}'.format(MAX_REGIONS, len(regions)))
+    mask = np.zeros(dims, dtype=MASK_DTYPE)
+    layer = np.zeros(dims, dtype='uint8')
+    for i, region in enumerate(regions):
+        layer.fill(0)
+        draw_region(layer, region, color=1, thickness=-1)
+        mask |= layer.astype(MASK_DTYPE) << i
+    return mask
+
+
+def region_bits(mask, region_num):
+    """Bools of whether region region_num is set in an array of bitmasks"""
+    return (np.asarray(mask) >> region_num) & 1 == 1
+
+
+class TargetRegionMask(object):
+    """Membership of points in N target regions. Rasterised once per change of regions"""
+    def __init__(self, dims):
+        self.dims = dims
+        self.regions = []
+        self.mask = np.zeros(dims, dtype=MASK_DTYPE)
+
+    def set_regions(self, regions):
+        self.regions = list(regions)
+        self.mask = rasterise_regions(self.regions, self.dims)
+
+    def lookup(self, x, y):
+        """Bitmask of the regions containing (x, y); 0 if outside all regions or not a valid coordinate"""
+        if x is None or y is None or not (0 <= y < self.dims[0] and 0 <= x < self.dims[1]):
+            return 0
+        return int(self.mask[y, x])